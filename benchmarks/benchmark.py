@@ -0,0 +1,363 @@
+# Benchmarks of create_sample and its stages on synthetic TIMA exports.
+#
+# Every case generates a synthetic project (see tima_mindif_processor.synthetic) and
+# times metadata parsing, field decoding, compositing, legend drawing, every output
+# writer and complete create_sample runs at full resolution and as a reduced preview.
+# The time of a stage is the best of --repeat runs, its peak memory is the peak of the
+# Python and NumPy allocations traced by tracemalloc during one more run.
+#
+# The results are compared against a stored baseline, a stage that got slower or bigger
+# than the baseline by more than the tolerance is reported and makes the run fail:
+#
+#   python benchmarks/benchmark.py                    # small and medium cases
+#   python benchmarks/benchmark.py --cases large
+#   python benchmarks/benchmark.py --save-baseline    # after an intended change
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from loguru import logger
+from PIL import Image
+from tima_mindif_processor import tima_mindif_processor as processor
+from tima_mindif_processor.compositing import histogram_to_phase_map
+from tima_mindif_processor.id_array import id_array_dtype, write_id_array
+from tima_mindif_processor.modal import write_modal_tables
+from tima_mindif_processor.png_writer import write_png
+from tima_mindif_processor.pyramid import DeepZoomWriter
+from tima_mindif_processor.synthetic import generate_project
+from tima_mindif_processor.tiff_writer import TiledTiffWriter
+
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+
+# Synthetic exports of increasing size, the field count and field size of medium are
+# those of a typical production sample.
+CASES = {
+    "small": {"field_count": 16, "field_size": 256, "phase_count": 20},
+    "medium": {"field_count": 64, "field_size": 512, "phase_count": 40},
+    "large": {"field_count": 256, "field_size": 1024, "phase_count": 60},
+}
+DEFAULT_CASES = ("small", "medium")
+
+# Slowdowns below this many seconds are noise, whatever the tolerance.
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def measure(repeat: int, run, *args):
+    """Return the best wall time of repeat runs of run(*args) and its peak memory."""
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(*args)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    tracemalloc.start()
+    try:
+        run(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": round(seconds, 4), "peak_mb": round(peak / (1024 * 1024), 2)}
+
+
+class Case:
+    """A synthetic sample and the canvases composited from it."""
+
+    def __init__(self, root: str, name: str, field_count, field_size, phase_count):
+        self.root = root
+        self.project_path, self.mindif_root, samples = generate_project(
+            root,
+            name,
+            field_count=field_count,
+            field_size=field_size,
+            phase_count=phase_count,
+        )
+        self.guid, self.sample_name = samples[0]
+        self.output_root = os.path.join(root, "output")
+        os.makedirs(self.output_root)
+        self.info = self.read_metadata()
+        self.composite()
+
+    def read_metadata(self):
+        processor.read_project_samples(self.project_path)
+        return processor.read_sample_info(
+            self.mindif_root, self.guid, self.sample_name, True
+        )
+
+    def decode(self):
+        for field_name, _, _ in self.info["fields"]:
+            processor.load_field_images(self.info, field_name, True)
+
+    def composite(self):
+        width, height = self.info["field_size"]
+        id_dtype, self.id_nodata = id_array_dtype(self.info["max_phase_id"])
+        self.canvases = {
+            "classification": np.full((height, width, 3), 255, dtype=np.uint8),
+            "bse": np.full((height, width), 65535, dtype=np.uint16),
+            "id_array": np.full((height, width), self.id_nodata, dtype=id_dtype),
+        }
+        self.field_stats = list(
+            processor.composite_fields(
+                self.info, self.info["fields"], self.canvases, True, True
+            )
+        )
+
+    def draw_legend(self):
+        phase_map = self.phase_map()
+        histogram_to_phase_map(phase_map, self.sample_histogram())
+        entries = sorted(
+            ((key, value) for key, value in phase_map.items() if value["histogram"]),
+            key=lambda entry: entry[1]["histogram"],
+            reverse=True,
+        )
+        layout = processor.legend_layout()
+        image = Image.new("RGB", (800, self.info["field_size"][1]), (255, 255, 255))
+        processor.draw_legend(
+            image,
+            layout,
+            self.sample_name,
+            entries,
+            int(self.sample_histogram().sum()),
+            True,
+            30,
+            780,
+        )
+
+    def phase_map(self):
+        return {key: dict(value) for key, value in self.info["phase_map"].items()}
+
+    def sample_histogram(self):
+        histogram = np.zeros(self.info["max_phase_id"] + 1, dtype=np.int64)
+        for _, stats in self.field_stats:
+            histogram[: len(stats.histogram)] += stats.histogram
+        return histogram
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.output_root, name)
+
+    def write_classification_png(self):
+        write_png(self.path("classification.png"), self.canvases["classification"])
+
+    def write_bse_png(self):
+        write_png(self.path("bse.png"), self.canvases["bse"])
+
+    def write_tiff(self):
+        writer = TiledTiffWriter(
+            self.path("classification.tif"),
+            self.canvases["classification"],
+            pixel_spacing_um=self.info["pixel_spacing"],
+        )
+        writer.close()
+
+    def write_pyramid(self):
+        DeepZoomWriter(self.path("pyramid"), self.canvases["classification"]).close()
+        shutil.rmtree(self.path("pyramid_files"))
+
+    def write_id_array(self, id_format: str):
+        write_id_array(
+            self.output_root,
+            "id_array",
+            self.canvases["id_array"],
+            self.id_nodata,
+            id_format,
+            {},
+        )
+
+    def write_modal_tables(self):
+        write_modal_tables(
+            self.output_root,
+            "modal",
+            self.sample_name,
+            self.phase_map(),
+            self.field_stats,
+            self.info["pixel_spacing"],
+        )
+
+    def create_sample(self, scale: int):
+        output_root = self.path("create_sample")
+        shutil.rmtree(output_root, ignore_errors=True)
+        processor.create_sample(
+            self.mindif_root,
+            output_root,
+            True,
+            True,
+            False,
+            True,
+            True,
+            (self.guid, self.sample_name),
+            scale=scale,
+        )
+
+
+def run_case(root: str, name: str, repeat: int) -> dict:
+    case = Case(os.path.join(root, name), name, **CASES[name])
+    stages = [
+        ("metadata", case.read_metadata),
+        ("decode", case.decode),
+        ("compositing", case.composite),
+        ("legend", case.draw_legend),
+        ("png_classification", case.write_classification_png),
+        ("png_bse", case.write_bse_png),
+        ("tiff_classification", case.write_tiff),
+        ("pyramid", case.write_pyramid),
+        ("id_array_csv", case.write_id_array, "csv"),
+        ("id_array_npy", case.write_id_array, "npy"),
+        ("modal_tables", case.write_modal_tables),
+        ("create_sample", case.create_sample, 1),
+        ("create_sample_scale4", case.create_sample, 4),
+    ]
+    results = {}
+    for stage in stages:
+        results[stage[0]] = measure(repeat, *stage[1:])
+        logger.info("{} {}: {}", name, stage[0], results[stage[0]])
+    width, height = case.info["field_size"]
+    results["canvas_pixels"] = width * height
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Return (case, stage, measure, baseline, result) for every regression."""
+    regressions = []
+    for case, stages in results["cases"].items():
+        base_stages = baseline.get("cases", {}).get(case)
+        if base_stages is None:
+            continue
+        for stage, result in stages.items():
+            base = base_stages.get(stage)
+            if not isinstance(result, dict) or base is None:
+                continue
+            if (
+                result["seconds"] > base["seconds"] * (1 + tolerance)
+                and result["seconds"] - base["seconds"] > MIN_REGRESSION_SECONDS
+            ):
+                regressions.append(
+                    (case, stage, "seconds", base["seconds"], result["seconds"])
+                )
+            if result["peak_mb"] > base["peak_mb"] * (1 + tolerance) + 1:
+                regressions.append(
+                    (case, stage, "peak_mb", base["peak_mb"], result["peak_mb"])
+                )
+    return regressions
+
+
+def print_table(results: dict, baseline: dict):
+    print(
+        "{:<8} {:<20} {:>10} {:>10} {:>10} {:>10}".format(
+            "case", "stage", "seconds", "baseline", "peak MB", "baseline"
+        )
+    )
+    for case, stages in results["cases"].items():
+        base_stages = baseline.get("cases", {}).get(case, {})
+        for stage, result in stages.items():
+            if not isinstance(result, dict):
+                continue
+            base = base_stages.get(stage, {})
+            print(
+                "{:<8} {:<20} {:>10.3f} {:>10} {:>10.1f} {:>10}".format(
+                    case,
+                    stage,
+                    result["seconds"],
+                    base.get("seconds", "-"),
+                    result["peak_mb"],
+                    base.get("peak_mb", "-"),
+                )
+            )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark create_sample")
+    parser.add_argument(
+        "--cases",
+        nargs="+",
+        choices=list(CASES),
+        default=list(DEFAULT_CASES),
+        help="Synthetic exports to benchmark",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Timed runs per stage, the best is kept"
+    )
+    parser.add_argument(
+        "--baseline", default=BASELINE_PATH, help="Baseline results to compare with"
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store the results as the new baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Fraction a stage may be slower or bigger than the baseline",
+    )
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    parser.add_argument(
+        "--keep", help="Generate the exports in this folder and keep it"
+    )
+    parser.add_argument("--verbose", "-v", action="store_true")
+    args = parser.parse_args(args)
+
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG" if args.verbose else "WARNING")
+    processor.set_xml_namespace()
+
+    root = args.keep or tempfile.mkdtemp(prefix="tima_benchmark_")
+    try:
+        results = {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cases": {name: run_case(root, name, args.repeat) for name in args.cases},
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+            "max_rss_mb": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                / (1024 * 1024 if sys.platform == "darwin" else 1024),
+                1,
+            ),
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        baseline.update(
+            {key: value for key, value in results.items() if key != "cases"}
+        )
+        baseline.setdefault("cases", {}).update(results["cases"])
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=2)
+        print_table(results, {})
+        print("Baseline saved to {}".format(args.baseline))
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_table(results, baseline)
+    print("Peak RSS: {} MB".format(results["max_rss_mb"]))
+    regressions = compare(results, baseline, args.tolerance)
+    for case, stage, name, base, result in regressions:
+        print("Regression: {} {} {} {} -> {}".format(case, stage, name, base, result))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
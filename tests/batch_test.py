@@ -0,0 +1,70 @@
+import json
+import os
+import pytest
+from tima_mindif_processor import batch
+
+
+def test_batch_runs_every_project_on_one_pool(tmp_path, make_job):
+    small, small_samples = make_job("Small", field_count=4)
+    large, large_samples = make_job("Large", field_count=9)
+    broken = {
+        "project_path": str(tmp_path / "Missing"),
+        "mindif_root": str(tmp_path / "Missing_MinDif"),
+        "output": str(tmp_path / "Missing_output"),
+    }
+    manifest_path = str(tmp_path / "jobs.json")
+    with open(manifest_path, "w") as file:
+        json.dump({"jobs": [small, broken, large]}, file)
+    results_path = str(tmp_path / "results.json")
+
+    # Replacing the workers after every sample must not lose any of them.
+    status = batch.main(
+        [manifest_path, "--processes", "2", "--max-tasks-per-child", "1"]
+        + ["--results", results_path]
+    )
+    assert status == 1
+    with open(results_path) as file:
+        results = json.load(file)["results"]
+    assert [result["job"] for result in results] == [0, 0, 1, 2, 2]
+    assert results[2]["status"] == "failed" and "error" in results[2]
+    for job, samples in ((small, small_samples), (large, large_samples)):
+        job_results = [r for r in results if r["project_path"] == job["project_path"]]
+        assert [(r["guid"], r["sample_name"]) for r in job_results] == samples
+        assert all(r["status"] == "ok" for r in job_results)
+        for _, sample_name in samples:
+            assert os.path.exists(os.path.join(job["output"], sample_name + ".png"))
+            assert os.path.exists(
+                os.path.join(job["output"], sample_name + ".modal.csv")
+            )
+
+    # Everything is up to date now, a batch of the good jobs succeeds.
+    results = batch.run_batch([small, large], processes=2)
+    assert {result["status"] for result in results} == {"skipped"}
+    assert not batch.batch_failed(results)
+
+
+def test_manifest_rejects_batch_options(tmp_path):
+    manifest_path = str(tmp_path / "jobs.json")
+    with open(manifest_path, "w") as file:
+        json.dump(
+            [
+                {
+                    "project_path": "a",
+                    "mindif_root": "b",
+                    "output": "c",
+                    "options": {"processes": 4},
+                }
+            ],
+            file,
+        )
+    with pytest.raises(ValueError):
+        batch.read_manifest(manifest_path)
+
+
+def test_manifest_rejects_validation_options(tmp_path):
+    manifest_path = str(tmp_path / "jobs.json")
+    job = {"project_path": "a", "mindif_root": "b", "output": "c"}
+    with open(manifest_path, "w") as file:
+        json.dump([dict(job, options={"validate": True, "fail_fast": True})], file)
+    with pytest.raises(ValueError, match="fail_fast, validate of a"):
+        batch.read_manifest(manifest_path)
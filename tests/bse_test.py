@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from tima_mindif_processor import Sample
+from tima_mindif_processor import tima_mindif_processor as processor
+from tima_mindif_processor.bse import field_levels, to_bit_depth
+
+
+@pytest.fixture
+def export(make_export):
+    mindif_root, guid, sample_name = make_export(field_count=4)
+    return mindif_root, guid, sample_name, Sample.load(mindif_root, guid, sample_name)
+
+
+def rewrite_bse(sample, convert):
+    """Replace the bse.png of every field of sample by convert(index, bse)."""
+    for index, (field_name, _, _) in enumerate(sample.fields):
+        path = sample.info["field_path_format"].format(field_name, "bse.png")
+        Image.fromarray(convert(index, np.asarray(Image.open(path)))).save(path)
+
+
+def test_8_bit_sources_give_an_8_bit_mosaic(tmp_path, export):
+    mindif_root, guid, sample_name, sample = export
+    rewrite_bse(sample, lambda index, bse: (bse // 257).astype(np.uint8))
+    sample = Sample.load(mindif_root, guid, sample_name)
+    assert sample.bse_dtype == np.uint8 and sample.bse.dtype == np.uint8
+    field_name, field_x, field_y = sample.fields[0]
+    source = np.asarray(
+        Image.open(sample.info["field_path_format"].format(field_name, "bse.png"))
+    )
+    height, width = source.shape
+    window = sample.bse[field_y : field_y + height, field_x : field_x + width]
+    assert (window == source).all()
+
+    output_root = str(tmp_path / "output")
+    processor.create_sample(
+        mindif_root, output_root, True, True, False, False, True, (guid, sample_name)
+    )
+    bse = Image.open(os.path.join(output_root, sample_name + "_bse.png"))
+    assert bse.mode == "L" and (np.asarray(bse) == sample.bse).all()
+
+    # A 16-bit field among 8-bit ones is brought down to 8 bits.
+    assert (to_bit_depth(np.array([0, 257, 65535]), np.uint8) == [0, 1, 255]).all()
+    assert (to_bit_depth(np.array([1, 255], np.uint8), np.uint16) == [257, 65535]).all()
+
+
+def test_normalisation_evens_out_the_field_levels(tmp_path, export):
+    mindif_root, guid, sample_name, sample = export
+    # Every field gets a contrast and brightness of its own.
+    rewrite_bse(
+        sample,
+        lambda index, bse: (bse // 4 * (1 + index % 2) + 5000 * index).astype(
+            np.uint16
+        ),
+    )
+
+    def mosaic_levels(sample):
+        levels = []
+        for field_name, field_x, field_y in sample.fields:
+            path = sample.info["field_path_format"].format(field_name, "mask.png")
+            mask = np.asarray(Image.open(path))
+            height, width = mask.shape
+            window = sample.bse[field_y : field_y + height, field_x : field_x + width]
+            levels.append(field_levels(window, mask != 0))
+        return np.array(levels)
+
+    raw = mosaic_levels(Sample.load(mindif_root, guid, sample_name))
+    normalised = Sample.load(mindif_root, guid, sample_name, bse_normalise=True)
+    levels = mosaic_levels(normalised)
+    assert np.ptp(raw, axis=0).min() > 5000
+    assert np.ptp(levels, axis=0).max() <= 2
+    assert (levels.mean(axis=0) > raw.min(axis=0)).all()
+    assert all(stats.bse_levels is not None for _, stats in normalised.field_stats)
+
+    # create_sample normalises the same way, also when streaming tiled TIFFs.
+    output_root = str(tmp_path / "output")
+    processor.create_sample(
+        mindif_root,
+        output_root,
+        True,
+        True,
+        False,
+        False,
+        True,
+        (guid, sample_name),
+        mosaic_format="tiff",
+        bse_normalise=True,
+    )
+    bse = np.asarray(Image.open(os.path.join(output_root, sample_name + "_bse.tif")))
+    assert (bse == normalised.bse).all()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import mock
+import pytest
+from tima_mindif_processor import cache
+from tima_mindif_processor import tima_mindif_processor as processor
+
+dirname = os.path.dirname(__file__)
+PHASES_XML = os.path.join(
+    dirname,
+    "test_data",
+    "STA_Test_MinDif",
+    "1ff0813f-1dd2-4596-8ad3-b6e3e88e2df2",
+    "phases.xml",
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    processor.set_xml_namespace()
+    cache.init_cache()
+    yield
+    cache.init_cache()
+
+
+def test_phase_tables_are_parsed_once_per_content(tmp_path):
+    calls = []
+
+    def parse(data):
+        calls.append(data)
+        return processor.parse_phases(data)
+
+    copy = str(tmp_path / "phases.xml")
+    shutil.copy(PHASES_XML, copy)
+    first = cache.phase_table(PHASES_XML, parse)
+    assert cache.phase_table(copy, parse) is first
+    assert len(calls) == 1
+
+    with open(copy, "ab") as file:
+        file.write(b"\n")
+    assert cache.phase_table(copy, parse) == first
+    assert len(calls) == 2
+
+
+def test_colour_luts_fonts_and_text_widths_are_shared():
+    phase_map = {1: {"colour": (1, 2, 3)}, 4: {"colour": (4, 5, 6)}}
+    colour_lut, known_lut = cache.colour_lut(phase_map, processor.build_colour_lut)
+    assert (colour_lut[4] == (4, 5, 6)).all() and known_lut[1] and not known_lut[2]
+    # The same colours in another sample get the same read-only tables.
+    other = {4: {"colour": (4, 5, 6), "histogram": 7}, 1: {"colour": (1, 2, 3)}}
+    assert cache.colour_lut(other, processor.build_colour_lut)[0] is colour_lut
+    with pytest.raises(ValueError):
+        colour_lut[0] = 0
+
+    layout = processor.legend_layout()
+    assert processor.legend_layout()["font"] is layout["font"]
+    font = layout["font"]
+    assert cache.text_width(font, "Quartz") == font.getbbox("Quartz")[2]
+    assert cache.cache_sizes() == {
+        "fonts": 2,
+        "phase_tables": 0,
+        "colour_luts": 1,
+        "text_widths": 1,
+    }
+
+    # The pool initializer starts every worker with an empty cache.
+    with mock.patch("signal.signal"):
+        processor.set_global(processor.logger)
+    assert set(cache.cache_sizes().values()) == {0}
@@ -0,0 +1,123 @@
+import numpy as np
+from tima_mindif_processor.compositing import (
+    block_mean,
+    block_mode,
+    build_colour_lut,
+    composite_field,
+)
+
+phase_map = {
+    0: {"colour": (0, 0, 0)},
+    3: {"colour": (255, 0, 0)},
+    7: {"colour": (0, 128, 255)},
+}
+
+
+def reference_composite(phases, mask, field_x, field_y, exclude_unclassified, canvas):
+    histogram = {}
+    for y in range(phases.shape[0]):
+        for x in range(phases.shape[1]):
+            phase_index = int(phases[y, x])
+            if (phase_index != 0 or not exclude_unclassified) and mask[y, x] != 0:
+                if phase_index not in phase_map:
+                    continue
+                canvas[y + field_y, x + field_x] = phase_map[phase_index]["colour"]
+                histogram[phase_index] = histogram.get(phase_index, 0) + 1
+    return histogram
+
+
+def test_composite_field_matches_pixel_loop():
+    rng = np.random.default_rng(42)
+    phases = rng.choice([0, 3, 7, 9], size=(20, 30)).astype(np.int32)
+    mask = rng.choice([0, 255], size=(20, 30)).astype(np.uint8)
+    colour_lut, known_lut = build_colour_lut(phase_map)
+
+    for exclude_unclassified in (True, False):
+        expected = np.full((40, 50, 3), 255, dtype=np.uint8)
+        histogram = reference_composite(
+            phases, mask, 5, 10, exclude_unclassified, expected
+        )
+
+        canvas = np.full((40, 50, 3), 255, dtype=np.uint8)
+        stats = composite_field(
+            phases,
+            mask,
+            5,
+            10,
+            (30, 20),
+            colour_lut,
+            known_lut,
+            exclude_unclassified,
+            canvas,
+        )
+
+        assert np.array_equal(canvas, expected)
+        assert stats.classified_count == sum(histogram.values())
+        for phase_id, count in histogram.items():
+            assert stats.histogram[phase_id] == count
+        assert stats.unknown_ids == (9,)
+        assert stats.unclassified_count == np.count_nonzero((phases == 0) & (mask != 0))
+
+
+def test_composite_field_clips_to_canvas():
+    phases = np.full((10, 10), 3, dtype=np.int32)
+    mask = np.full((10, 10), 255, dtype=np.uint8)
+    colour_lut, known_lut = build_colour_lut(phase_map)
+    canvas = np.full((15, 15, 3), 255, dtype=np.uint8)
+    id_canvas = np.full((12, 12), -1, dtype=np.int32)
+
+    stats = composite_field(
+        phases,
+        mask,
+        8,
+        -2,
+        (10, 10),
+        colour_lut,
+        known_lut,
+        True,
+        canvas,
+        id_canvas=id_canvas,
+    )
+
+    assert stats.classified_count == 7 * 8
+    assert stats.bbox == (8, 0, 14, 7)
+    assert (id_canvas[0:8, 8:12] == 3).all()
+    assert (id_canvas[8:, :] == -1).all()
+
+
+def test_block_mode_aligns_blocks_to_the_canvas():
+    labels = np.array([[3, 3, 7], [3, 7, 7], [-1, -1, -1]])
+    # The window starts at column 1, so its first column is the right half of a block.
+    dst = (slice(0, 3), slice(1, 4))
+    reduced, scaled_dst = block_mode(labels, dst, 2)
+    assert scaled_dst == (slice(0, 2), slice(0, 2))
+    assert np.array_equal(reduced, [[3, 7], [-1, -1]])
+
+
+def test_block_mean_ignores_padding():
+    image = np.array([[10, 20, 30], [30, 40, 50]], dtype=np.uint16)
+    reduced, _ = block_mean(image, (slice(0, 2), slice(0, 3)), 2)
+    assert reduced.dtype == np.uint16
+    assert np.array_equal(reduced, [[25, 40]])
+
+
+def test_composite_field_preview_keeps_full_resolution_stats():
+    rng = np.random.default_rng(7)
+    phases = rng.choice([3, 7], size=(20, 30)).astype(np.int32)
+    mask = np.full((20, 30), 255, dtype=np.uint8)
+    colour_lut, known_lut = build_colour_lut(phase_map)
+
+    full = np.full((40, 50, 3), 255, dtype=np.uint8)
+    full_stats = composite_field(
+        phases, mask, 5, 10, (30, 20), colour_lut, known_lut, True, full
+    )
+    preview = np.full((10, 13, 3), 255, dtype=np.uint8)
+    preview_stats = composite_field(
+        phases, mask, 5, 10, (30, 20), colour_lut, known_lut, True, preview, scale=4
+    )
+
+    assert np.array_equal(preview_stats.histogram, full_stats.histogram)
+    assert preview_stats.classified_count == full_stats.classified_count
+    # Field covers full resolution columns 5 to 34 and rows 10 to 29.
+    assert (preview[2:8, 1:9] != 255).any(axis=2).all()
+    assert (preview[:2] == 255).all() and (preview[:, 9:] == 255).all()
@@ -0,0 +1,40 @@
+import pytest
+from tima_mindif_processor.synthetic import generate_project
+
+
+@pytest.fixture
+def make_job(tmp_path):
+    """Generate a synthetic project and return a manifest job for it and its samples."""
+
+    def make(name, sample_count=2, field_count=4):
+        project_path, mindif_root, samples = generate_project(
+            str(tmp_path),
+            name,
+            sample_count=sample_count,
+            field_count=field_count,
+            field_size=32,
+            phase_count=4,
+        )
+        return {
+            "project_path": project_path,
+            "mindif_root": mindif_root,
+            "output": str(tmp_path / (name + "_output")),
+            "options": {"generate_bse": False, "modal_tables": True},
+        }, samples
+
+    return make
+
+
+@pytest.fixture
+def make_export(tmp_path):
+    """Generate a synthetic export, returning its MinDif root and the guid and name of
+    its first sample."""
+
+    def make(field_count):
+        _, mindif_root, samples = generate_project(
+            str(tmp_path), field_count=field_count, field_size=40, phase_count=4
+        )
+        guid, sample_name = samples[0]
+        return mindif_root, guid, sample_name
+
+    return make
@@ -0,0 +1,44 @@
+import zlib
+import numpy as np
+import pytest
+from PIL import Image
+from tima_mindif_processor.encoding import ENCODING_PROFILES
+from tima_mindif_processor.png_writer import BAND_ROWS, adler32_combine, write_png
+from tima_mindif_processor.tiff_writer import TiledTiffWriter
+
+
+def test_adler32_combine():
+    first, second = b"classification" * 100, b"bse" * 333
+    assert adler32_combine(
+        zlib.adler32(first), zlib.adler32(second), len(second)
+    ) == zlib.adler32(first + second)
+
+
+@pytest.mark.parametrize(
+    "shape, dtype",
+    [((BAND_ROWS * 3 + 17, 50, 3), np.uint8), ((BAND_ROWS * 2 + 1, 70), np.uint16)],
+)
+def test_png_bands_compressed_in_threads(tmp_path, shape, dtype):
+    array = (np.random.default_rng(0).integers(0, 30, shape) * 1000).astype(dtype)
+    sizes = {}
+    for threads in (1, 3):
+        path = str(tmp_path / "{}.png".format(threads))
+        write_png(path, array, 6, threads)
+        assert np.array_equal(np.asarray(Image.open(path)), array)
+        sizes[threads] = len(open(path, "rb").read())
+    # The bands do not share a dictionary, that costs little.
+    assert sizes[3] < sizes[1] * 1.1
+
+
+@pytest.mark.parametrize("profile", list(ENCODING_PROFILES))
+def test_tiff_profiles_store_the_same_pixels(tmp_path, profile):
+    array = np.random.default_rng(1).integers(0, 255, (300, 520, 3)).astype(np.uint8)
+    path = str(tmp_path / "mosaic.tif")
+    writer = TiledTiffWriter(
+        path,
+        array,
+        compress_level=ENCODING_PROFILES[profile]["tiff_compress_level"],
+        threads=2,
+    )
+    writer.close()
+    assert np.array_equal(np.asarray(Image.open(path)), array)
@@ -0,0 +1,12 @@
+import gzip
+import numpy as np
+from tima_mindif_processor.id_array import id_array_dtype, write_id_array
+
+
+def test_csv_keeps_ids_beyond_int32(tmp_path):
+    dtype, nodata = id_array_dtype(2 ** 31 + 5)
+    assert dtype == np.uint32
+    id_array = np.array([[1, 2 ** 31 + 5], [nodata, 7]], dtype=dtype)
+    path = write_id_array(str(tmp_path), "S", id_array, nodata, "csv", {})
+    with gzip.open(path, "rt") as file:
+        assert file.read().split() == ["1,2147483653", "-1,7"]
@@ -0,0 +1,112 @@
+import os
+import json
+import numpy as np
+import pytest
+import mock
+from PIL import Image
+from tima_mindif_processor import tima_mindif_processor as processor
+from tima_mindif_processor.atomic import PARTIAL_PREFIX
+
+dirname = os.path.dirname(__file__)
+mindif_root = os.path.join(dirname, "test_data", "STA_Test_MinDif")
+sample = ("1ff0813f-1dd2-4596-8ad3-b6e3e88e2df2", "STA-107B")
+
+
+@pytest.fixture(autouse=True)
+def xml_namespace():
+    processor.set_xml_namespace()
+
+
+def run_sample(output_root, generate_bse=False, **kwargs):
+    processor.create_sample(
+        mindif_root,
+        str(output_root),
+        True,
+        True,
+        False,
+        False,
+        generate_bse,
+        sample,
+        **kwargs
+    )
+
+
+def test_finished_sample_is_skipped(tmp_path):
+    run_sample(tmp_path)
+    mtime = os.stat(tmp_path / "STA-107B.png").st_mtime_ns
+    run_sample(tmp_path)
+    assert os.stat(tmp_path / "STA-107B.png").st_mtime_ns == mtime
+
+
+def test_new_output_only_generates_that_output(tmp_path):
+    run_sample(tmp_path)
+    mtime = os.stat(tmp_path / "STA-107B.png").st_mtime_ns
+    run_sample(tmp_path, generate_bse=True)
+    assert os.stat(tmp_path / "STA-107B.png").st_mtime_ns == mtime
+    assert os.path.exists(tmp_path / "STA-107B_bse.png")
+    with open(tmp_path / "STA-107B.manifest.json") as file:
+        assert set(json.load(file)["outputs"]) == {"classification", "bse"}
+
+
+def test_truncated_output_without_manifest_is_regenerated(tmp_path):
+    with open(tmp_path / "STA-107B.png", "wb") as file:
+        file.write(b"\x89PNG")
+    run_sample(tmp_path)
+    Image.open(tmp_path / "STA-107B.png").load()
+
+
+def test_changed_option_regenerates_output(tmp_path):
+    run_sample(tmp_path)
+    with open(tmp_path / "STA-107B.manifest.json") as file:
+        key = json.load(file)["outputs"]["classification"]["key"]
+    processor.create_sample(
+        mindif_root, str(tmp_path), True, False, False, False, False, sample
+    )
+    with open(tmp_path / "STA-107B.manifest.json") as file:
+        assert json.load(file)["outputs"]["classification"]["key"] != key
+
+
+def test_killed_run_resumes_from_checkpoint(tmp_path):
+    expected_root = tmp_path / "expected"
+    run_sample(expected_root, generate_bse=True)
+    expected = np.asarray(Image.open(expected_root / "STA-107B.png"))
+
+    output_root = tmp_path / "output"
+    composite_field = processor.composite_field
+    calls = []
+
+    def killed_after_five_fields(*args, **kwargs):
+        if len(calls) == 5:
+            raise KeyboardInterrupt()
+        calls.append(1)
+        return composite_field(*args, **kwargs)
+
+    with mock.patch.object(processor, "composite_field", killed_after_five_fields):
+        with pytest.raises(KeyboardInterrupt):
+            run_sample(output_root, generate_bse=True, checkpoint_every=2)
+
+    checkpoint_path = output_root / ".checkpoints" / "STA-107B"
+    with open(checkpoint_path / "checkpoint.json") as file:
+        assert len(json.load(file)["fields"]) == 4
+    assert not os.path.exists(output_root / "STA-107B.png")
+
+    resumed_calls = []
+
+    def counted(*args, **kwargs):
+        resumed_calls.append(1)
+        return composite_field(*args, **kwargs)
+
+    with mock.patch.object(processor, "composite_field", counted):
+        run_sample(output_root, generate_bse=True, checkpoint_every=2)
+
+    field_count = len(
+        processor.read_sample_info(mindif_root, sample[0], sample[1], True)["fields"]
+    )
+    assert len(resumed_calls) == field_count - 4
+    assert np.array_equal(np.asarray(Image.open(output_root / "STA-107B.png")), expected)
+    assert np.array_equal(
+        np.asarray(Image.open(output_root / "STA-107B_bse.png")),
+        np.asarray(Image.open(expected_root / "STA-107B_bse.png")),
+    )
+    assert not os.path.exists(checkpoint_path)
+    assert not [name for name in os.listdir(output_root) if name.startswith(PARTIAL_PREFIX)]
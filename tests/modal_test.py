@@ -0,0 +1,49 @@
+import csv
+import numpy as np
+from tima_mindif_processor.compositing import FieldStats
+from tima_mindif_processor.modal import modal_tables, write_modal_tables
+
+PHASE_MAP = {1: {"mineral_name": "Quartz"}, 2: {"mineral_name": "Pyrite"}}
+
+
+def field_stats(histogram, unclassified_count, unknown_count=0):
+    histogram = np.array(histogram, dtype=np.int64)
+    return FieldStats(
+        histogram, int(histogram.sum()), unclassified_count, unknown_count, (), None
+    )
+
+
+def test_unclassified_fields_keep_their_counts(tmp_path):
+    stats = [
+        ("A01", field_stats([0, 30, 10], 5)),
+        ("A02", field_stats([0, 0, 0], 64, unknown_count=2)),
+    ]
+    sample_rows, field_rows = modal_tables("S", PHASE_MAP, stats, 2.0)
+    assert [row["phase_id"] for row in sample_rows] == [1, 2]
+    assert sample_rows[0]["unclassified_pixels"] == 69
+    assert sample_rows[0]["skipped_pixels"] == 2
+    empty = [row for row in field_rows if row["field_name"] == "A02"]
+    assert empty == [
+        {
+            "sample_name": "S",
+            "field_name": "A02",
+            "phase_id": None,
+            "mineral_name": None,
+            "pixel_count": 0,
+            "area_um2": 0.0,
+            "percent": None,
+            "classified_pixels": 0,
+            "unclassified_pixels": 64,
+            "skipped_pixels": 2,
+        }
+    ]
+
+    # A sample without any classified pixels still gets a row.
+    sample_path, field_path = write_modal_tables(
+        str(tmp_path), "S", "S", PHASE_MAP, stats[1:], 2.0
+    )
+    for path in (sample_path, field_path):
+        with open(path) as file:
+            rows = list(csv.DictReader(file))
+        assert len(rows) == 1
+        assert rows[0]["phase_id"] == "" and rows[0]["unclassified_pixels"] == "64"
@@ -0,0 +1,109 @@
+import os
+import mock
+import pytest
+from tima_mindif_processor import tima_mindif_processor as processor
+from tima_mindif_processor.project_index import ProjectIndex, cached_dataset
+
+dirname = os.path.dirname(__file__)
+project_path = os.path.join(dirname, "test_data", "STA_Test")
+mindif_root = os.path.join(dirname, "test_data", "STA_Test_MinDif")
+
+SURVEYS_XML = """<?xml version="1.0" encoding="utf-8"?>
+<Surveys>
+  <Survey>
+    <Replicate caption="Sample A">
+      <Dataset guid="{1ff0813f-1dd2-4596-8ad3-b6e3e88e2df2}" />
+    </Replicate>
+  </Survey>
+</Surveys>
+"""
+
+
+@pytest.fixture(autouse=True)
+def xml_namespace():
+    processor.set_xml_namespace()
+
+
+def test_project_samples_are_cached_until_the_project_changes(tmp_path):
+    index = ProjectIndex(str(tmp_path / "index.json"))
+    samples = index.samples(project_path, processor.read_project_samples)
+    assert ("1ff0813f-1dd2-4596-8ad3-b6e3e88e2df2", "STA-107B") in samples
+    index.save()
+
+    read_samples = mock.Mock(side_effect=processor.read_project_samples)
+    index = ProjectIndex(str(tmp_path / "index.json"))
+    assert index.samples(project_path, read_samples) == samples
+    read_samples.assert_not_called()
+
+
+def test_tima_14_project_is_indexed(tmp_path):
+    project = tmp_path / "Old"
+    surveys = project / "Old.timaproj.Surveys"
+    surveys.mkdir(parents=True)
+    (surveys / "Surveys.xml").write_text(SURVEYS_XML)
+
+    index = ProjectIndex(str(tmp_path / "index.json"))
+    samples = index.samples(str(project), processor.read_project_samples)
+    assert samples == [("1ff0813f-1dd2-4596-8ad3-b6e3e88e2df2", "Sample A")]
+    index.save()
+
+    # Touching Surveys.xml makes the project be read again.
+    stat = os.stat(surveys / "Surveys.xml")
+    os.utime(surveys / "Surveys.xml", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    read_samples = mock.Mock(side_effect=processor.read_project_samples)
+    index = ProjectIndex(str(tmp_path / "index.json"))
+    assert index.samples(str(project), read_samples) == samples
+    read_samples.assert_called_once()
+
+
+def test_indexed_dataset_gives_the_same_sample_info(tmp_path):
+    guid = "1ff0813f-1dd2-4596-8ad3-b6e3e88e2df2"
+    index = ProjectIndex(str(tmp_path / "index.json"))
+    assert index.stale_datasets(mindif_root, [guid]) == [guid]
+    index.update([processor.read_dataset(mindif_root, guid)])
+    assert index.stale_datasets(mindif_root, [guid]) == []
+    index.save()
+
+    dataset = cached_dataset(str(tmp_path / "index.json"), guid)
+    for exclude_unclassified in (True, False):
+        expected = processor.read_sample_info(
+            mindif_root, guid, "STA-107B", exclude_unclassified
+        )
+        assert (
+            processor.sample_info_from_dataset(dataset, "STA-107B", exclude_unclassified)
+            == expected
+        )
+    assert all(
+        files["phases.tif"] and files["mask.png"]
+        for files in expected["field_files"].values()
+    )
+
+
+def test_field_images_are_indexed_until_their_directory_changes(tmp_path, make_export):
+    mindif_root, guid, _ = make_export(field_count=4)
+    index = ProjectIndex(str(tmp_path / "index.json"))
+    assert index.stale_datasets(mindif_root, [guid]) == [guid]
+    dataset = processor.read_dataset(mindif_root, guid)
+    index.update([dataset])
+    assert all(field["files"] == [True, True, True] for field in dataset["fields"])
+    assert index.stale_datasets(mindif_root, [guid]) == []
+
+    field = dataset["fields"][0]
+    field_path = os.path.join(dataset["xml_path"], dataset["field_dir"], field["name"])
+    os.remove(os.path.join(field_path, "bse.png"))
+    os.utime(field_path, ns=(0, field["mtime"] + 10 ** 9))
+    assert index.stale_datasets(mindif_root, [guid]) == [guid]
+    assert processor.read_dataset(mindif_root, guid)["fields"][0]["files"] == [
+        True,
+        True,
+        False,
+    ]
+
+
+def test_missing_dataset_is_indexed(tmp_path):
+    index = ProjectIndex(str(tmp_path / "index.json"))
+    assert index.stale_datasets(str(tmp_path), ["missing"]) == ["missing"]
+    dataset = processor.read_dataset(str(tmp_path), "missing")
+    index.update([dataset])
+    assert index.stale_datasets(str(tmp_path), ["missing"]) == []
+    assert processor.sample_info_from_dataset(dataset, "Missing", True) is None
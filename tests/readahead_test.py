@@ -0,0 +1,73 @@
+import os
+import threading
+import time
+import numpy as np
+from loguru import logger
+from tima_mindif_processor import tima_mindif_processor as processor
+from tima_mindif_processor.readahead import read_ahead
+from tima_mindif_processor.synthetic import generate_project
+
+
+def test_read_ahead_keeps_order_and_budget():
+    lock = threading.Lock()
+    active = [0, 0]
+
+    def read(item):
+        with lock:
+            active[0] += 1
+            active[1] = max(active[1], active[0])
+        time.sleep(0.01 * (item % 3))
+        with lock:
+            active[0] -= 1
+        return item * 2
+
+    results = list(read_ahead(read, range(20), 8, item_bytes=100, byte_budget=300))
+    assert [(item, result) for item, result, _, _ in results] == [
+        (item, item * 2) for item in range(20)
+    ]
+    assert active[1] <= 3
+
+
+def test_missing_images_are_logged_in_field_order(tmp_path):
+    processor.set_xml_namespace()
+    _, mindif_root, samples = generate_project(
+        str(tmp_path), field_count=9, field_size=32, phase_count=3
+    )
+    guid, sample_name = samples[0]
+    fields_path = os.path.join(mindif_root, guid, "fields")
+    os.remove(os.path.join(fields_path, "A02", "phases.tif"))
+    os.remove(os.path.join(fields_path, "B01", "bse.png"))
+    os.remove(os.path.join(fields_path, "C03", "mask.png"))
+    info = processor.read_sample_info(mindif_root, guid, sample_name, True)
+
+    runs = []
+    for depth in (0, 4):
+        width, height = info["field_size"]
+        canvases = {
+            "classification": np.full((height, width, 3), 255, dtype=np.uint8),
+            "bse": np.full((height, width), 65535, dtype=np.uint16),
+            "id_array": None,
+        }
+        messages = []
+        handler = logger.add(messages.append, format="{message}", level="ERROR")
+        try:
+            stats = list(
+                processor.composite_fields(
+                    info, info["fields"], canvases, True, True, read_ahead=depth
+                )
+            )
+        finally:
+            logger.remove(handler)
+        runs.append((messages, stats, canvases))
+
+    (messages, stats, canvases), (ahead_messages, ahead_stats, ahead_canvases) = runs
+    assert [message.strip() for message in messages] == [
+        "Error: {}, {}, field A02 does not have phases.tif".format(guid, sample_name),
+        "Error: {}, {}, field B01 does not have bse.png".format(guid, sample_name),
+        "Error: {}, {}, field C03 does not have mask.png".format(guid, sample_name),
+    ]
+    assert ahead_messages == messages
+    assert [name for name, field_stats in stats if field_stats is None] == ["A02", "C03"]
+    assert [name for name, _ in ahead_stats] == [name for name, _ in stats]
+    for name in ("classification", "bse"):
+        assert np.array_equal(ahead_canvases[name], canvases[name])
@@ -0,0 +1,87 @@
+import os
+import mock
+import numpy as np
+import pytest
+from PIL import Image
+from tima_mindif_processor import Sample
+from tima_mindif_processor import tima_mindif_processor as processor
+from tima_mindif_processor.roi import FieldIndex, roi_box
+
+
+@pytest.fixture
+def export(make_export):
+    return make_export(field_count=16)
+
+
+def test_field_index_finds_the_intersecting_fields():
+    rng = np.random.default_rng(3)
+    fields = [
+        ("F{}".format(i), int(x), int(y))
+        for i, (x, y) in enumerate(rng.integers(-50, 500, (60, 2)))
+    ]
+    index = FieldIndex(fields, (40, 30))
+    for left, top in rng.integers(-60, 520, (50, 2)):
+        box = (int(left), int(top), int(left) + 70, int(top) + 25)
+        expected = [
+            field
+            for field in fields
+            if field[1] < box[2]
+            and box[0] < field[1] + 40
+            and field[2] < box[3]
+            and box[1] < field[2] + 30
+        ]
+        assert index.query(box) == expected
+
+
+def test_roi_composites_only_its_fields(tmp_path, export):
+    mindif_root, guid, sample_name = export
+    sample = Sample.load(mindif_root, guid, sample_name)
+    spacing = sample.pixel_spacing
+    # 50 x 30 µm around a point 20 µm right and 10 µm below the centre.
+    region = (-20.0, 10.0, 50.0, 30.0)
+    left, top, right, bottom = roi_box(sample.info, region)
+
+    read = processor.read_field_images
+    with mock.patch.object(
+        processor, "read_field_images", side_effect=read
+    ) as read_field_images:
+        inclusion = sample.roi(*region)
+        labels = inclusion.labels
+    assert 0 < read_field_images.call_count == len(inclusion.fields) < len(sample.fields)
+    assert inclusion.offset == (left, top)
+    assert inclusion.mosaic_size == (right - left, bottom - top)
+    assert right - left == pytest.approx(50 / spacing, abs=1)
+
+    # The region is the same as that part of the whole mosaic, with its own statistics.
+    assert (labels == sample.labels[top:bottom, left:right]).all()
+    assert (inclusion.rgb == sample.rgb[top:bottom, left:right]).all()
+    assert (inclusion.bse == sample.bse[top:bottom, left:right]).all()
+    counts = np.bincount(labels[labels != inclusion.label_nodata].ravel())
+    assert (inclusion.histogram[: len(counts)] == counts).all()
+    assert inclusion.histogram.sum() < sample.histogram.sum()
+    pixel = sample.roi(left + 10, top + 5, 20, 10, units="px")
+    assert pixel.offset == (left, top)
+
+    with pytest.raises(ValueError):
+        sample.roi(1e6, 0, 10, 10)
+    with pytest.raises(ValueError):
+        inclusion.roi(0, 0, 10, 10)
+
+    # The command line tool writes the region under a name of its own.
+    output_root = str(tmp_path / "output")
+    processor.create_sample(
+        mindif_root,
+        output_root,
+        True,
+        True,
+        False,
+        True,
+        True,
+        (guid, sample_name),
+        id_array_format="npy",
+        roi=region,
+    )
+    name = sample_name + "_roi_-20_10_50x30um"
+    assert (np.load(os.path.join(output_root, name + ".npy")) == labels).all()
+    bse = np.asarray(Image.open(os.path.join(output_root, name + "_bse.png")))
+    assert (bse == inclusion.bse).all()
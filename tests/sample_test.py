@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from tima_mindif_processor import Sample
+from tima_mindif_processor import tima_mindif_processor as processor
+
+
+@pytest.fixture
+def export(make_export):
+    return make_export(field_count=6)
+
+
+def test_sample_arrays_match_the_written_mosaic(tmp_path, export):
+    mindif_root, guid, sample_name = export
+    sample = Sample.load(mindif_root, guid, sample_name)
+    assert sample.labels.shape == sample.rgb.shape[:2] == sample.bse.shape
+    assert sample.mosaic_size == (sample.labels.shape[1], sample.labels.shape[0])
+    # Computed once and cached.
+    assert sample.rgb is sample.rgb
+
+    # Every labelled pixel has the colour of its phase.
+    colours = {phase["id"]: phase["colour"] for phase in sample.phase_table}
+    for phase_id, colour in colours.items():
+        assert (sample.rgb[sample.labels == phase_id] == colour).all()
+    labelled = sample.labels != sample.label_nodata
+    assert sample.histogram.sum() == labelled.sum()
+    assert {row["phase_id"]: row["pixel_count"] for row in sample.modal} == {
+        phase_id: int(count)
+        for phase_id, count in enumerate(sample.histogram)
+        if count
+    }
+
+    # The files of the command line tool hold the same mosaic.
+    output_root = str(tmp_path / "output")
+    processor.create_sample(
+        mindif_root, output_root, True, True, False, True, True, (guid, sample_name)
+    )
+    width, height = sample.mosaic_size
+    mosaic = np.asarray(Image.open(os.path.join(output_root, sample_name + ".png")))
+    assert (mosaic[:, :width] == sample.rgb).all()
+    bse = np.asarray(Image.open(os.path.join(output_root, sample_name + "_bse.png")))
+    assert (bse == sample.bse).all()
+
+
+def test_sample_writes_files_on_request(tmp_path, export):
+    mindif_root, guid, sample_name = export
+    sample = Sample.load(mindif_root, guid, sample_name, bse=False, scale=2)
+    assert sample.bse is None
+    paths = sample.write(str(tmp_path / "api"), id_array_format="npy", modal=True)
+    assert [os.path.basename(path) for path in paths] == [
+        sample_name + ".png",
+        sample_name + ".npy",
+        sample_name + ".modal.csv",
+        sample_name + ".field_modal.csv",
+    ]
+    assert (np.asarray(Image.open(paths[0])) == sample.rgb).all()
+    assert (np.load(paths[1]) == sample.labels).all()
+
+
+def test_missing_dataset_raises(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        Sample.load(str(tmp_path), "missing")
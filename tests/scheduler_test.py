@@ -0,0 +1,76 @@
+import threading
+from tima_mindif_processor import tima_mindif_processor as processor
+from tima_mindif_processor.scheduler import MemoryGate, largest_first
+from tima_mindif_processor.synthetic import generate_project
+
+
+def gate_items(*memories):
+    return [
+        (("guid{}".format(index), "S{}".format(index)), index, memory)
+        for index, memory in enumerate(memories)
+    ]
+
+
+def test_largest_first_keeps_order_of_equal_costs():
+    estimates = [{"cost": 1}, {"cost": 5}, {"cost": 1}, {"cost": 3}]
+    assert largest_first(["a", "b", "c", "d"], estimates) == ["b", "d", "a", "c"]
+
+
+def test_memory_gate_admits_within_budget():
+    gate = MemoryGate(100, 3)
+    items = gate_items(80, 50, 30, 20)
+    admitted = gate.admit(items)
+    # The 50 and 30 MB samples do not fit next to the 80 MB one, the 20 MB one does.
+    assert next(admitted) == 0
+    assert next(admitted) == 3
+    gate.release(items[0][0])
+    assert next(admitted) == 1
+    assert next(admitted) == 2
+    for key, _, _ in items:
+        gate.release(key)
+    assert list(admitted) == []
+
+
+def test_memory_gate_runs_oversized_sample_alone_and_limits_slots():
+    gate = MemoryGate(10, 1)
+    items = gate_items(50, 1)
+    admitted = gate.admit(items)
+    assert next(admitted) == 0
+    result = []
+    thread = threading.Thread(target=lambda: result.append(next(admitted)))
+    thread.start()
+    thread.join(0.2)
+    # The second sample waits for the only slot.
+    assert thread.is_alive() and not result
+    gate.release(items[0][0])
+    thread.join(5)
+    assert result == [1]
+
+
+def test_memory_gate_close_stops_admitting():
+    gate = MemoryGate(100, 1)
+    admitted = gate.admit(gate_items(10, 10))
+    next(admitted)
+    result = []
+    thread = threading.Thread(target=lambda: result.extend(admitted))
+    thread.start()
+    gate.close()
+    thread.join(5)
+    assert not thread.is_alive() and result == []
+
+
+def test_estimate_grows_with_the_sample(tmp_path):
+    processor.set_xml_namespace()
+    estimates = []
+    for field_count in (4, 16):
+        _, mindif_root, samples = generate_project(
+            str(tmp_path / str(field_count)), field_count=field_count, field_size=64
+        )
+        dataset = processor.read_dataset(mindif_root, samples[0][0])
+        estimates.append(processor.estimate_sample(dataset, True, True, True))
+    assert estimates[1]["cost"] > estimates[0]["cost"] > 0
+    assert estimates[1]["memory_mb"] > estimates[0]["memory_mb"]
+    # Canvases beyond the per-worker budget are memory mapped.
+    capped = processor.estimate_sample(dataset, True, True, True, memory_budget_mb=0.01)
+    assert capped["memory_mb"] < estimates[1]["memory_mb"]
+    assert processor.estimate_sample(None, True, True, True)["cost"] == 0
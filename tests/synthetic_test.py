@@ -0,0 +1,66 @@
+import csv
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from tima_mindif_processor import tima_mindif_processor as processor
+from tima_mindif_processor.synthetic import generate_project
+
+
+@pytest.fixture(autouse=True)
+def xml_namespace():
+    processor.set_xml_namespace()
+
+
+def generated_counts(mindif_root, guid):
+    """Pixel count of every phase over the masked pixels of the generated fields."""
+    counts = {}
+    fields_path = os.path.join(mindif_root, guid, "fields")
+    for field_name in os.listdir(fields_path):
+        phases = np.asarray(Image.open(os.path.join(fields_path, field_name, "phases.tif")))
+        mask = np.asarray(Image.open(os.path.join(fields_path, field_name, "mask.png")))
+        ids, field_counts = np.unique(phases[mask != 0], return_counts=True)
+        for phase_id, count in zip(ids.tolist(), field_counts.tolist()):
+            counts[phase_id] = counts.get(phase_id, 0) + count
+    return counts
+
+
+@pytest.mark.parametrize("shape", ["circle", "rectangle"])
+def test_synthetic_export_is_processed(tmp_path, shape):
+    project_path, mindif_root, samples = generate_project(
+        str(tmp_path), field_count=6, field_size=40, phase_count=4, shape=shape
+    )
+    assert processor.read_project_samples(project_path)[0] == samples
+    guid, sample_name = samples[0]
+
+    info = processor.read_sample_info(mindif_root, guid, sample_name, True)
+    assert len(info["fields"]) == 6
+    assert sorted(info["phase_map"]) == [1, 2, 3, 4]
+    # Six fields make a grid of three by two fields.
+    if shape == "rectangle":
+        assert info["field_size"] == (120, 80)
+    else:
+        assert info["field_size"] == (120, 120)
+
+    output_root = str(tmp_path / "output")
+    processor.create_sample(
+        mindif_root,
+        output_root,
+        True,
+        True,
+        False,
+        False,
+        True,
+        samples[0],
+        modal_tables=True,
+    )
+    with open(os.path.join(output_root, sample_name + ".modal.csv")) as file:
+        rows = list(csv.DictReader(file))
+    counts = generated_counts(mindif_root, guid)
+    assert {int(row["phase_id"]): int(row["pixel_count"]) for row in rows} == {
+        phase_id: count for phase_id, count in counts.items() if phase_id != 0
+    }
+    assert int(rows[0]["unclassified_pixels"]) == counts[0]
+    if shape == "circle":
+        # The corners of the grid are outside the sample.
+        assert sum(counts.values()) < 6 * 40 * 40
@@ -0,0 +1,62 @@
+import io
+import numpy as np
+import pytest
+from PIL import Image
+from tima_mindif_processor import Sample
+from tima_mindif_processor.synthetic import generate_project
+from tima_mindif_processor.tiff_reader import decode_image, uncompressed_layout
+
+
+def encoded(array, mode, file_format="TIFF", **options):
+    file = io.BytesIO()
+    Image.fromarray(array, mode).save(file, format=file_format, **options)
+    return file.getvalue()
+
+
+@pytest.mark.parametrize(
+    "mode, dtype", [("I", np.int32), ("I;16", np.uint16), ("I;16B", ">u2")]
+)
+@pytest.mark.parametrize("compression", ["raw", "tiff_lzw"])
+def test_decoded_tiffs_match_pil(mode, dtype, compression):
+    # Large enough for PIL to write several strips.
+    array = (np.arange(300 * 250) % 997).reshape(250, 300).astype(dtype)
+    if mode == "I;16B":
+        image = Image.frombytes(mode, (300, 250), array.tobytes())
+        file = io.BytesIO()
+        image.save(file, format="TIFF", compression=compression)
+        data = file.getvalue()
+    else:
+        data = encoded(array, mode, compression=compression)
+    decoded = decode_image(data)
+    assert (decoded == np.asarray(Image.open(io.BytesIO(data)))).all()
+    assert (decoded == array).all()
+    if compression == "raw":
+        # A view of the file contents, nothing was decoded or copied.
+        assert uncompressed_layout(data) is not None
+        assert not decoded.flags.owndata and not decoded.flags.writeable
+    else:
+        assert uncompressed_layout(data) is None
+
+
+def test_other_images_are_decoded_by_pil():
+    mask = np.eye(8, dtype=np.uint8) * 255
+    assert uncompressed_layout(encoded(mask, "L", "PNG")) is None
+    assert (decode_image(encoded(mask, "L", "PNG")) == mask).all()
+    rgb = np.zeros((4, 4, 3), dtype=np.uint8)
+    assert uncompressed_layout(encoded(rgb, "RGB", compression="raw")) is None
+
+
+def test_uncompressed_exports_composite_the_same(tmp_path):
+    mosaics = []
+    for compression in ("raw", "tiff_lzw"):
+        _, mindif_root, samples = generate_project(
+            str(tmp_path / compression),
+            field_count=4,
+            field_size=40,
+            phase_count=4,
+            tiff_compression=compression,
+        )
+        sample = Sample.load(mindif_root, *samples[0])
+        mosaics.append((sample.labels, sample.rgb, sample.bse))
+    for uncompressed, compressed in zip(*mosaics):
+        assert (uncompressed == compressed).all()
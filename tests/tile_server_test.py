@@ -0,0 +1,87 @@
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
+from PIL import Image
+from tima_mindif_processor import Sample
+from tima_mindif_processor.pyramid import pyramid_max_level
+from tima_mindif_processor.synthetic import generate_project
+from tima_mindif_processor.tile_server import LRUCache, TileSource, make_server
+
+
+@pytest.fixture
+def source(tmp_path):
+    _, mindif_root, samples = generate_project(
+        str(tmp_path), field_count=6, field_size=40, phase_count=4
+    )
+    return TileSource(mindif_root, samples, tile_size=32, field_cache_mb=1)
+
+
+def test_lru_cache_keeps_the_recently_used_values():
+    cache = LRUCache(10)
+    cache.put("a", "A", 4)
+    cache.put("b", "B", 4)
+    assert cache.get("a") == "A"
+    cache.put("c", "C", 4)
+    assert cache.get("b") is None and cache.get("a") == "A" and cache.get("c") == "C"
+    assert cache.size == 8
+    # Too large to be kept at all.
+    assert cache.put("d", "D", 11) == "D" and cache.get("d") is None
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_tiles_match_the_previews(source):
+    sample_name, guid = next(iter(source.guids.items()))
+    sample = Sample.load(source.mindif_root, guid, sample_name)
+    max_level = pyramid_max_level(*sample.mosaic_size)
+    for level in (max_level, max_level - 1, max_level - 3):
+        scale = 2 ** (max_level - level)
+        preview = Sample(sample.info, scale=scale)
+        width, height = preview.mosaic_size
+        for row in range(0, -(-height // 32)):
+            for column in range(0, -(-width // 32)):
+                window = np.s_[row * 32 : row * 32 + 32, column * 32 : column * 32 + 32]
+                tile = (level, column, row)
+                rgb, _ = source.render(sample_name, "classification", *tile)
+                assert (rgb == preview.rgb[window]).all()
+                bse, _ = source.render(sample_name, "bse", *tile)
+                assert (bse == preview.bse[window]).all()
+    # Every field was decoded once.
+    assert len(source.fields) == len(sample.fields)
+
+    legend = source.legend(sample_name)
+    assert legend["modal"] == sample.modal
+    assert legend["field_modal"] == sample.field_modal
+    with pytest.raises(KeyError):
+        source.render(sample_name, "classification", max_level, 99, 0)
+
+
+def test_server_serves_tiles_and_legends(source):
+    server = make_server(source, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = "http://{}:{}/".format(*server.server_address[:2])
+    try:
+        with urllib.request.urlopen(url + "samples.json") as response:
+            samples = json.load(response)
+        sample_name = samples[0]["sample_name"]
+        dzi_url = url + sample_name + "/classification.dzi"
+        with urllib.request.urlopen(dzi_url) as response:
+            assert b'TileSize="32"' in response.read()
+        tile_url = "{}{}/bse_files/{}/0_0.png".format(
+            url, sample_name, samples[0]["max_level"]
+        )
+        with urllib.request.urlopen(tile_url) as response:
+            assert Image.open(io.BytesIO(response.read())).size == (32, 32)
+        with urllib.request.urlopen(url + sample_name + "/legend.json") as response:
+            assert json.load(response)["modal"]
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + sample_name + "/rgb.dzi")
+        assert error.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -1,9 +1,17 @@
 import sys
 import os, shutil
+import csv
+import json
+import numpy as np
+from PIL import Image
 import pytest
 import mock
 from loguru import logger
-from tima_mindif_processor.tima_mindif_processor import tima_mindif_processor
+from tima_mindif_processor.tima_mindif_processor import (
+    field_waves,
+    read_project_samples,
+    tima_mindif_processor,
+)
 
 dirname = os.path.dirname(__file__)
 output_dir = os.path.join(dirname, "test_output")
@@ -100,3 +108,223 @@ def test_16_run_with_id_array(mp_logger, clean_output):
 #             )
 #         except Exception:
 #             pytest.fail("Exception Caught running 1.6 Test")
+
+
+def test_16_run_out_of_core(mp_logger, clean_output, tmp_path):
+    with mock.patch("builtins.input", return_value="yes"):
+        try:
+            tima_mindif_processor(
+                os.path.join(dirname, "test_data", "STA_Test"),
+                os.path.join(dirname, "test_data", "STA_Test_MinDif"),
+                output_dir,
+                create_thumbnail=True,
+                generate_id_array=False,
+                generate_bse=True,
+                scratch_dir=str(tmp_path),
+                memory_budget_mb=0,
+            )
+        except Exception:
+            pytest.fail("Exception Caught running 1.6 Test with memory mapped canvases")
+    assert os.path.exists(os.path.join(output_dir, "STA-107B.png"))
+    assert os.listdir(tmp_path) == []
+
+
+def test_16_run_with_npy_id_array(mp_logger, clean_output):
+    with mock.patch("builtins.input", return_value="yes"):
+        tima_mindif_processor(
+            os.path.join(dirname, "test_data", "STA_Test"),
+            os.path.join(dirname, "test_data", "STA_Test_MinDif"),
+            output_dir,
+            create_thumbnail=False,
+            generate_id_array=True,
+            generate_bse=False,
+            id_array_format="npy",
+        )
+    with open(os.path.join(output_dir, "STA-107B.id_array.json")) as file:
+        sidecar = json.load(file)
+    id_array = np.load(os.path.join(output_dir, "STA-107B.npy"), mmap_mode="r")
+    assert id_array.dtype == np.uint8
+    assert sidecar["nodata"] == 255
+    assert list(id_array.shape) == sidecar["shape"]
+    assert (id_array != sidecar["nodata"]).any()
+
+
+def test_21_run_field_parallel(mp_logger, clean_output):
+    with mock.patch("builtins.input", return_value="yes"):
+        try:
+            tima_mindif_processor(
+                os.path.join(dirname, "test_data", "ERD_21_Test"),
+                os.path.join(dirname, "test_data", "ERD_21_Test_MinDif"),
+                output_dir,
+                create_thumbnail=False,
+                generate_id_array=False,
+                generate_bse=True,
+                parallelism="field",
+                processes=2,
+            )
+        except Exception:
+            pytest.fail("Exception Caught running 2.1 Test in parallel over fields")
+    assert os.path.exists(os.path.join(output_dir, "GXDD0103-49.png"))
+    assert os.path.exists(os.path.join(output_dir, "GXDD0103-49_bse.png"))
+
+
+def test_field_waves_keep_overlapping_fields_in_order():
+    fields = [("A", 0, 0), ("B", 10, 0), ("C", 5, 0), ("D", 100, 100)]
+    waves = field_waves(fields, (8, 8), 4)
+    wave_of = {chunk[0][0]: level for level, wave in enumerate(waves) for _, chunk in wave}
+    assert wave_of["A"] == 0 and wave_of["B"] == 0 and wave_of["D"] == 0
+    assert wave_of["C"] == 1
+
+
+def test_16_run_tiff_mosaic(mp_logger, clean_output):
+    with mock.patch("builtins.input", return_value="yes"):
+        tima_mindif_processor(
+            os.path.join(dirname, "test_data", "STA_Test"),
+            os.path.join(dirname, "test_data", "STA_Test_MinDif"),
+            output_dir,
+            create_thumbnail=False,
+            generate_id_array=False,
+            generate_bse=True,
+            mosaic_format="tiff",
+        )
+    classification = Image.open(os.path.join(output_dir, "STA-107B.tif"))
+    bse = Image.open(os.path.join(output_dir, "STA-107B_bse.tif"))
+    assert classification.mode == "RGB"
+    assert classification.size == bse.size
+    assert json.loads(classification.tag_v2[270])["pixel_spacing_um"] > 0
+    assert os.path.exists(os.path.join(output_dir, "STA-107B.legend.png"))
+
+
+def test_16_run_pyramid(mp_logger, clean_output):
+    with mock.patch("builtins.input", return_value="yes"):
+        tima_mindif_processor(
+            os.path.join(dirname, "test_data", "STA_Test"),
+            os.path.join(dirname, "test_data", "STA_Test_MinDif"),
+            output_dir,
+            create_thumbnail=False,
+            generate_id_array=False,
+            generate_bse=True,
+            pyramid=True,
+        )
+    for name in ("STA-107B", "STA-107B_bse"):
+        assert os.path.exists(os.path.join(output_dir, name + ".dzi"))
+        top = Image.open(os.path.join(output_dir, name + "_files", "0", "0_0.png"))
+        assert top.size == (1, 1)
+    # The full resolution level is a copy of the mosaic.
+    mosaic = np.asarray(Image.open(os.path.join(output_dir, "STA-107B.png")))
+    max_level = str(len(os.listdir(os.path.join(output_dir, "STA-107B_files"))) - 1)
+    tile = np.asarray(Image.open(os.path.join(output_dir, "STA-107B_files", max_level, "0_0.png")))
+    assert np.array_equal(tile, mosaic[:256, :256])
+
+
+def test_16_run_preview_scale(mp_logger, clean_output):
+    with mock.patch("builtins.input", return_value="yes"):
+        tima_mindif_processor(
+            os.path.join(dirname, "test_data", "STA_Test"),
+            os.path.join(dirname, "test_data", "STA_Test_MinDif"),
+            output_dir,
+            create_thumbnail=False,
+            generate_id_array=True,
+            generate_bse=True,
+            id_array_format="npy",
+            scale=4,
+        )
+    ids = np.load(os.path.join(output_dir, "STA-107B_scale4.npy"))
+    with open(os.path.join(output_dir, "STA-107B_scale4.id_array.json")) as file:
+        sidecar = json.load(file)
+    assert sidecar["scale"] == 4
+    bse = Image.open(os.path.join(output_dir, "STA-107B_scale4_bse.png"))
+    assert bse.size == (ids.shape[1], ids.shape[0])
+    assert not os.path.exists(os.path.join(output_dir, "STA-107B.png"))
+
+
+def test_16_run_modal_tables(mp_logger, clean_output):
+    with mock.patch("builtins.input", return_value="yes"):
+        tima_mindif_processor(
+            os.path.join(dirname, "test_data", "STA_Test"),
+            os.path.join(dirname, "test_data", "STA_Test_MinDif"),
+            output_dir,
+            create_thumbnail=False,
+            generate_id_array=True,
+            generate_bse=False,
+            id_array_format="npy",
+            modal_tables=True,
+        )
+    with open(os.path.join(output_dir, "STA-107B.modal.csv")) as file:
+        sample_rows = list(csv.DictReader(file))
+    with open(os.path.join(output_dir, "STA-107B.field_modal.csv")) as file:
+        field_rows = list(csv.DictReader(file))
+
+    # Fields overlap, so only the per-field counts add up to the sample counts.
+    for row in sample_rows:
+        field_total = sum(
+            int(field_row["pixel_count"])
+            for field_row in field_rows
+            if field_row["phase_id"] == row["phase_id"]
+        )
+        assert field_total == int(row["pixel_count"])
+    assert abs(sum(float(row["percent"]) for row in sample_rows) - 100) < 0.01
+
+    ids = np.load(os.path.join(output_dir, "STA-107B.npy"))
+    assert {int(row["phase_id"]) for row in sample_rows} >= set(
+        np.unique(ids[ids != np.iinfo(ids.dtype).max]).tolist()
+    )
+    # Metrics are only written on request.
+    assert not [name for name in os.listdir(output_dir) if name.endswith(".jsonl")]
+
+
+def test_21_run_writes_metrics(mp_logger, clean_output, tmp_path):
+    metrics_path = str(tmp_path / "run.metrics.jsonl")
+    with mock.patch("builtins.input", return_value="yes"):
+        tima_mindif_processor(
+            os.path.join(dirname, "test_data", "ERD_21_Test"),
+            os.path.join(dirname, "test_data", "ERD_21_Test_MinDif"),
+            output_dir,
+            generate_id_array=False,
+            generate_bse=True,
+            parallelism="field",
+            processes=2,
+            metrics_path=metrics_path,
+        )
+    with open(metrics_path) as file:
+        records = [json.loads(line) for line in file]
+
+    run = records[-1]
+    samples = records[:-1]
+    assert run["type"] == "run"
+    assert run["samples"] == len(samples) > 0
+    sample = samples[0]
+    assert sample["status"] == "completed"
+    for stage in ("metadata", "decode", "compositing", "legend", "write_bse"):
+        assert sample["stages"][stage]["calls"] > 0
+    # The fields were composited by the workers.
+    assert sample["workers"] and str(sample["pid"]) not in sample["workers"]
+    assert sample["stages"]["decode"]["calls"] == sample["fields"] + sample["missing_fields"]
+    assert sample["bytes_read"] > 0 and sample["bytes_written"] > 0
+    assert run["pixels"] == sum(record["pixels"] for record in samples)
+
+
+def test_16_run_within_pool_memory(mp_logger, clean_output, tmp_path):
+    metrics_path = str(tmp_path / "run.metrics.jsonl")
+    project_path = os.path.join(dirname, "test_data", "STA_Test")
+    with mock.patch("builtins.input", return_value="yes"):
+        # A budget smaller than any sample makes them run one at a time.
+        tima_mindif_processor(
+            project_path,
+            os.path.join(dirname, "test_data", "STA_Test_MinDif"),
+            output_dir,
+            generate_id_array=False,
+            generate_bse=False,
+            parallelism="sample",
+            processes=2,
+            project_index=False,
+            metrics_path=metrics_path,
+            pool_memory_mb=1,
+        )
+    with open(metrics_path) as file:
+        samples = [json.loads(line) for line in file][:-1]
+    # The records keep the order of the project, whatever order the samples ran in.
+    assert [(sample["guid"], sample["sample_name"]) for sample in samples] == (
+        read_project_samples(project_path)[0]
+    )
+    assert all(sample["status"] == "completed" for sample in samples)
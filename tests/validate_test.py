@@ -0,0 +1,99 @@
+import json
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from tima_mindif_processor.synthetic import generate_project
+from tima_mindif_processor.tima_mindif_processor import (
+    read_sample_info,
+    set_xml_namespace,
+    tima_mindif_processor,
+)
+from tima_mindif_processor.validate import ValidationError, validate_fields
+
+FIELD_IMAGES = ("phases.tif", "mask.png", "bse.png")
+
+
+@pytest.fixture
+def broken_export(tmp_path):
+    """A project of four samples: one fine, one with a few pixels of an unknown phase,
+    one with a field without mask.png and one with many unknown pixels."""
+    project_path, mindif_root, samples = generate_project(
+        str(tmp_path),
+        sample_count=4,
+        field_count=4,
+        field_size=32,
+        phase_count=4,
+        shape="rectangle",
+    )
+
+    def field_path(sample, name):
+        return os.path.join(mindif_root, samples[sample][0], "fields", "A01", name)
+
+    for sample, unknown_pixels in ((1, 3), (3, 100)):
+        phases = np.array(Image.open(field_path(sample, "phases.tif")))
+        phases.ravel()[:unknown_pixels] = 999
+        Image.fromarray(phases, "I").save(field_path(sample, "phases.tif"))
+    os.remove(field_path(2, "mask.png"))
+    return project_path, mindif_root, samples
+
+
+def test_fields_are_checked(broken_export):
+    _, mindif_root, samples = broken_export
+    set_xml_namespace()
+    results = []
+    for guid, sample_name in samples:
+        info = read_sample_info(mindif_root, guid, sample_name, False)
+        results.append(validate_fields(info, info["fields"], FIELD_IMAGES, False))
+    assert all(not result["issues"] for result in results[0])
+    # Unclassified pixels count with exclude_unclassified off.
+    assert 0 in results[0][0]["phase_ids"] and 999 not in results[0][0]["phase_ids"]
+
+    unknown = results[1][0]
+    assert unknown["unknown_count"] == 3
+    assert [item["level"] for item in unknown["issues"]] == ["warning"]
+    assert "[999]" in unknown["issues"][0]["detail"]
+    assert results[2][0]["issues"] == [
+        {"level": "warning", "field_name": "A01", "detail": "mask.png is missing"}
+    ]
+    assert [item["level"] for item in results[3][0]["issues"]] == ["error"]
+
+
+def test_failed_samples_are_not_processed(broken_export, tmp_path):
+    project_path, mindif_root, samples = broken_export
+    output = str(tmp_path / "output")
+    report_path = str(tmp_path / "validation.json")
+    options = dict(
+        generate_bse=False, generate_id_array=False, wait_for_enter=False, processes=1
+    )
+    with pytest.raises(ValidationError):
+        tima_mindif_processor(
+            project_path,
+            mindif_root,
+            output,
+            validate=True,
+            fail_fast=True,
+            validation_path=report_path,
+            **options
+        )
+    assert not any(name.endswith(".png") for name in os.listdir(output))
+
+    tima_mindif_processor(
+        project_path,
+        mindif_root,
+        output,
+        validate=True,
+        validation_path=report_path,
+        **options
+    )
+    with open(report_path) as file:
+        reports = json.load(file)
+    assert [report["status"] for report in reports] == [
+        "ok",
+        "warning",
+        "warning",
+        "error",
+    ]
+    for (_, sample_name), report in zip(samples, reports):
+        written = os.path.exists(os.path.join(output, sample_name + ".png"))
+        assert written == (report["status"] != "error")
@@ -0,0 +1,117 @@
+import os
+import shutil
+import threading
+import time
+import mock
+from tima_mindif_processor.synthetic import generate_project
+from tima_mindif_processor.tima_mindif_processor import read_dataset
+from tima_mindif_processor.watch import ExportWatcher, watch_project
+
+
+def synthetic_project(root, sample_count):
+    return generate_project(
+        str(root),
+        "Watch",
+        sample_count=sample_count,
+        field_count=4,
+        field_size=32,
+        phase_count=4,
+    )
+
+
+def wait_for(condition, timeout_s=60):
+    deadline = time.monotonic() + timeout_s
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_exports_are_ready_once_settled(tmp_path):
+    _, mindif_root, samples = synthetic_project(tmp_path, 1)
+    guid = samples[0][0]
+    mask_path = os.path.join(mindif_root, guid, "fields", "A01", "mask.png")
+    os.rename(mask_path, mask_path + ".part")
+
+    watcher = ExportWatcher(mindif_root, settle_s=0.2)
+    assert watcher.ready(guid) is None
+    os.rename(mask_path + ".part", mask_path)
+    # Complete, but not settled yet.
+    assert watcher.ready(guid) is None
+    time.sleep(0.25)
+    assert watcher.ready(guid)["guid"] == guid
+    assert watcher.ready(guid) is None
+
+    # A new export of the dataset is ready again once it settles.
+    fields_xml = os.path.join(mindif_root, guid, "fields.xml")
+    os.utime(fields_xml, ns=(0, os.stat(fields_xml).st_mtime_ns + 10**9))
+    assert watcher.ready(guid) is None
+    time.sleep(0.25)
+    assert watcher.ready(guid)["guid"] == guid
+
+
+def test_exports_are_parsed_again_only_when_they_change(tmp_path):
+    _, mindif_root, samples = synthetic_project(tmp_path, 1)
+    guid = samples[0][0]
+    field_path = os.path.join(mindif_root, guid, "fields", "A01")
+    watcher = ExportWatcher(mindif_root, settle_s=0.2)
+    with mock.patch(
+        "tima_mindif_processor.watch.read_dataset", wraps=read_dataset
+    ) as read:
+        for _ in range(3):
+            assert watcher.ready(guid) is None
+        assert read.call_count == 1
+
+        # An image still being written in place holds the export back.
+        with open(os.path.join(field_path, "bse.png"), "ab") as file:
+            file.write(b"more")
+        time.sleep(0.25)
+        assert watcher.ready(guid) is None
+        time.sleep(0.25)
+        assert watcher.ready(guid)["guid"] == guid
+        assert read.call_count == 1
+
+        # A new export of the dataset is read again.
+        fields_xml = os.path.join(mindif_root, guid, "fields.xml")
+        os.utime(fields_xml, ns=(0, os.stat(fields_xml).st_mtime_ns + 10**9))
+        assert watcher.ready(guid) is None
+        assert read.call_count == 2
+
+
+def test_watch_processes_samples_as_they_land(tmp_path):
+    project_path, mindif_root, samples = synthetic_project(tmp_path, 2)
+    output = str(tmp_path / "output")
+    late_guid, late_name = samples[1]
+    late_path = os.path.join(mindif_root, late_guid)
+    shutil.move(late_path, str(tmp_path / "export"))
+
+    stop = threading.Event()
+    records = []
+    watcher = threading.Thread(
+        target=lambda: records.extend(
+            watch_project(
+                project_path,
+                mindif_root,
+                output,
+                processes=1,
+                poll_s=0.05,
+                settle_s=0.1,
+                stop=stop,
+                generate_bse=False,
+            )
+        )
+    )
+    watcher.start()
+    try:
+        wait_for(
+            lambda: os.path.exists(os.path.join(output, samples[0][1] + ".png"))
+        )
+        assert not os.path.exists(os.path.join(output, late_name + ".png"))
+        shutil.move(str(tmp_path / "export"), late_path)
+        wait_for(lambda: os.path.exists(os.path.join(output, late_name + ".png")))
+    finally:
+        stop.set()
+        watcher.join()
+    assert sorted(record["sample_name"] for record in records) == sorted(
+        name for _, name in samples
+    )
+    assert {record["status"] for record in records} == {"completed"}
@@ -0,0 +1,103 @@
+import json
+import os
+import time
+from tima_mindif_processor import work_queue
+
+
+def test_workers_share_the_queue(tmp_path, make_job):
+    queue_dir = str(tmp_path / "queue")
+    first, first_samples = make_job("First", sample_count=3)
+    second, second_samples = make_job("Second")
+    assert work_queue.enqueue_jobs(queue_dir, [first, second], processes=1) == 5
+    # Queued samples are not queued twice.
+    assert work_queue.enqueue_jobs(queue_dir, [first], processes=1) == 0
+
+    assert work_queue.run_workers(queue_dir, 3, heartbeat_s=0.5, poll_s=0.1) == [0] * 3
+    counts, results = work_queue.queue_status(queue_dir)
+    assert counts == {"pending": 0, "claimed": 0, "done": 5}
+    assert {result["status"] for result in results} == {"ok"}
+    for job, samples in ((first, first_samples), (second, second_samples)):
+        for _, sample_name in samples:
+            assert os.path.exists(os.path.join(job["output"], sample_name + ".png"))
+    assert work_queue.main(["status", queue_dir]) == 0
+
+
+def test_stale_claims_are_reclaimed(tmp_path, make_job):
+    queue_dir = str(tmp_path / "queue")
+    job, samples = make_job("Stale")
+    work_queue.enqueue_jobs(queue_dir, [job], processes=1)
+
+    # A worker claims a sample and dies without a heartbeat.
+    name, _ = work_queue.claim_job(queue_dir, "dead")
+    claimed = work_queue.queue_path(queue_dir, "claimed", name)
+    with work_queue.Heartbeat(claimed, 0.05):
+        os.utime(claimed, (0, 0))
+        time.sleep(0.3)
+    assert time.time() - os.stat(claimed).st_mtime < 5
+    os.utime(claimed, (0, 0))
+
+    results = work_queue.run_worker(queue_dir, "alive", stale_after_s=60, poll_s=0.1)
+    assert [result["sample_name"] for result in results] == [
+        sample_name for _, sample_name in samples
+    ]
+    reclaimed = [result for result in results if result["job_id"] + ".json" == name]
+    assert reclaimed[0]["attempts"] == 1 and reclaimed[0]["status"] == "ok"
+
+    # A sample whose workers keep dying is given up.
+    work_queue.enqueue_jobs(queue_dir, [dict(job, options={"generate_bse": True})], 1)
+    name, _ = work_queue.claim_job(queue_dir, "dead")
+    os.utime(work_queue.queue_path(queue_dir, "claimed", name), (0, 0))
+    assert work_queue.reclaim_stale_jobs(queue_dir, 60, max_attempts=1) == 1
+    with open(work_queue.queue_path(queue_dir, "done", name)) as file:
+        assert json.load(file)["detail"] == "abandoned"
+    assert work_queue.main(["status", queue_dir]) == 1
+
+
+def test_claims_of_long_pending_jobs_are_fresh(tmp_path, make_job, monkeypatch):
+    queue_dir = str(tmp_path / "queue")
+    job, samples = make_job("Waiting")
+    work_queue.enqueue_jobs(queue_dir, [job], processes=1)
+    for name in work_queue.job_names(queue_dir, "pending"):
+        os.utime(work_queue.queue_path(queue_dir, "pending", name), (0, 0))
+
+    # Waiting in pending does not make the claim stale.
+    name, _ = work_queue.claim_job(queue_dir, "first")
+    assert work_queue.reclaim_stale_jobs(queue_dir, 60) == 0
+    work_queue.release_job(queue_dir, name)
+
+    # A worker whose claim is reclaimed before its heartbeat starts skips the job.
+    claim_job = work_queue.claim_job
+    lost = []
+
+    def claim_and_lose(queue_dir, worker_id):
+        claim = claim_job(queue_dir, worker_id)
+        if claim is not None and not lost:
+            lost.append(claim[0])
+            work_queue.release_job(queue_dir, claim[0])
+        return claim
+
+    monkeypatch.setattr(work_queue, "claim_job", claim_and_lose)
+    results = work_queue.run_worker(queue_dir, "alive", poll_s=0.1)
+    assert len(lost) == 1
+    assert sorted(result["sample_name"] for result in results) == sorted(
+        sample_name for _, sample_name in samples
+    )
+    assert {result["status"] for result in results} == {"ok"}
+
+
+def test_reclaimed_jobs_keep_their_new_claim(tmp_path, make_job):
+    queue_dir = str(tmp_path / "queue")
+    job, _ = make_job("Reclaimed", sample_count=1)
+    work_queue.enqueue_jobs(queue_dir, [job], processes=1)
+    name, first = work_queue.claim_job(queue_dir, "slow")
+    os.utime(work_queue.queue_path(queue_dir, "claimed", name), (0, 0))
+    assert work_queue.reclaim_stale_jobs(queue_dir, 60) == 1
+    assert work_queue.claim_job(queue_dir, "fast")[0] == name
+
+    # The slow worker finishes after all, its result is dropped and the claim kept.
+    record = {"status": "completed", "wall_s": 1.0, "cpu_s": 1.0}
+    assert work_queue.finish_job(queue_dir, name, first, record, "slow") is None
+    assert work_queue.claim_owner(queue_dir, name) == "fast"
+    assert work_queue.job_names(queue_dir, "done") == []
+    assert work_queue.finish_job(queue_dir, name, first, record, "fast")["status"] == "ok"
+    assert work_queue.claim_owner(queue_dir, name) is None
@@ -0,0 +1 @@
+from .sample import Sample
@@ -5,7 +5,17 @@ import os
 from loguru import logger
 
 # from .tima_mindif_processor import tima_mindif_processor as tima14
-from .tima_mindif_processor import tima_mindif_processor
+from .tima_mindif_processor import (
+    DEFAULT_READ_AHEAD,
+    DEFAULT_READ_AHEAD_MB,
+    tima_mindif_processor,
+)
+from .id_array import ID_ARRAY_FORMATS
+from .pyramid import RESAMPLING_METHODS
+from .roi import ROI_UNITS, parse_roi
+from .validate import ValidationError
+from .watch import DEFAULT_POLL_S, DEFAULT_SETTLE_S, watch_project
+from .encoding import DEFAULT_ENCODING_PROFILE, ENCODING_PROFILES
 
 
 def parse_args(args):
@@ -43,13 +53,222 @@ def parse_args(args):
         action="store_true",
         help="Generate Rock Type ID Arrays for each sample.",
     )
+    parser.add_argument(
+        "--id-format",
+        dest="id_format",
+        default="csv",
+        choices=ID_ARRAY_FORMATS,
+        help="File format of the Rock Type ID Arrays.",
+    )
     parser.add_argument(
         "--bse",
         "-b",
         action="store_true",
         help="Generate the stitched together BSE image.",
     )
+    parser.add_argument(
+        "--bse-normalise",
+        dest="bse_normalise",
+        action="store_true",
+        help="Even out the brightness and contrast of the fields of the BSE image.",
+    )
     parser.add_argument("--thumbs", action="store_true", help="Create thumbnails.")
+    parser.add_argument(
+        "--mosaic-format",
+        dest="mosaic_format",
+        default="png",
+        choices=("png", "tiff"),
+        help="Write the classification and BSE mosaics as PNG, or as tiled BigTIFF "
+        + "with the legend in a separate image.",
+    )
+    parser.add_argument(
+        "--encoding",
+        default=DEFAULT_ENCODING_PROFILE,
+        choices=list(ENCODING_PROFILES),
+        help="How hard the mosaics are compressed: fast writes larger files quickly "
+        + "(uncompressed TIFF tiles), small writes the smallest files slowly.",
+    )
+    parser.add_argument(
+        "--encode-threads",
+        dest="encode_threads",
+        default=None,
+        type=int,
+        help="Threads compressing each mosaic, defaults to the number of workers when "
+        + "the fields of a sample are processed in parallel and 1 otherwise.",
+    )
+    parser.add_argument(
+        "--pyramid",
+        action="store_true",
+        help="Export Deep Zoom tile pyramids of the classification and BSE mosaics.",
+    )
+    parser.add_argument(
+        "--pyramid-resampling",
+        dest="pyramid_resampling",
+        default="mode",
+        choices=RESAMPLING_METHODS,
+        help="How classification tiles are downsampled, the most common colour or the nearest pixel.",
+    )
+    parser.add_argument(
+        "--modal",
+        "-m",
+        dest="modal_tables",
+        action="store_true",
+        help="Write per-sample and per-field modal mineralogy tables as CSV.",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        dest="checkpoint_every",
+        type=int,
+        default=0,
+        help="Checkpoint samples every N fields so a killed run resumes where it "
+        "stopped. The canvases are then always memory mapped, in the scratch directory "
+        "or OUTPUT/.checkpoints.",
+    )
+    parser.add_argument(
+        "--no-wait",
+        dest="wait_for_enter",
+        action="store_false",
+        help="Exit when the project is processed instead of waiting for Enter.",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Check the field images and phase IDs of every sample before processing, "
+        + "samples that would fail are skipped.",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        dest="fail_fast",
+        action="store_true",
+        help="Exit without processing anything when a sample fails --validate.",
+    )
+    parser.add_argument(
+        "--validation-report",
+        dest="validation_path",
+        default=None,
+        type=str,
+        help="Path of the JSON validation report, defaults to "
+        + "tima_validation_<time>.json in the output folder.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and process every sample as soon as its export to the MinDif "
+        + "root is complete, until Ctrl+C.",
+    )
+    parser.add_argument(
+        "--poll",
+        dest="poll_s",
+        default=DEFAULT_POLL_S,
+        type=float,
+        help="Seconds between the checks for new exports in watch mode.",
+    )
+    parser.add_argument(
+        "--settle",
+        dest="settle_s",
+        default=DEFAULT_SETTLE_S,
+        type=float,
+        help="Seconds the files of an export have to stay unchanged before it is "
+        + "processed in watch mode.",
+    )
+    parser.add_argument(
+        "--no-index",
+        dest="project_index",
+        action="store_false",
+        help="Do not use or update the cached index of the project and its datasets.",
+    )
+    parser.add_argument(
+        "--index",
+        dest="index_path",
+        default=None,
+        help="Path of the project index, defaults to .tima_index.json in the output folder.",
+    )
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=1,
+        help="Generate a preview reduced by this factor, named <sample>_scale<N>. "
+        "Percentages are still computed at full resolution.",
+    )
+    parser.add_argument(
+        "--roi",
+        type=parse_roi,
+        default=None,
+        metavar="X,Y,WIDTH,HEIGHT",
+        help="Only process the region centred on X,Y of every sample, named "
+        + "<sample>_roi_<X>_<Y>_<WIDTH>x<HEIGHT><units>. Only the fields in the region "
+        + "are read.",
+    )
+    parser.add_argument(
+        "--roi-units",
+        dest="roi_units",
+        default="um",
+        choices=ROI_UNITS,
+        help="Units of --roi: um in the stage coordinates of fields.xml, relative to "
+        + "the sample centre, or px of the sample canvas.",
+    )
+    parser.add_argument(
+        "--parallelism",
+        dest="parallelism",
+        default="auto",
+        choices=("auto", "sample", "field"),
+        help="Run samples in parallel, or the fields of one sample at a time. "
+        + "auto picks fields when there are fewer samples than workers.",
+    )
+    parser.add_argument(
+        "--processes",
+        "-p",
+        dest="processes",
+        default=None,
+        type=int,
+        help="Number of worker processes, defaults to the number of cores.",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        dest="memory_budget",
+        default=None,
+        type=float,
+        help="Per-worker memory budget in MB, larger samples are composited in memory mapped files.",
+    )
+    parser.add_argument(
+        "--pool-memory",
+        dest="pool_memory",
+        default=None,
+        type=float,
+        help="Memory the workers may use together in MB, samples are started largest "
+        "first while their estimated memory fits. Defaults to 80%% of the physical "
+        "memory.",
+    )
+    parser.add_argument(
+        "--scratch-dir",
+        dest="scratch_dir",
+        default=None,
+        type=str,
+        help="Directory for the memory mapped canvases, defaults to the system temp directory.",
+    )
+    parser.add_argument(
+        "--read-ahead",
+        dest="read_ahead",
+        default=DEFAULT_READ_AHEAD,
+        type=int,
+        help="Number of fields whose images are read and decoded in threads while a "
+        "field is composited, 0 reads them in turn.",
+    )
+    parser.add_argument(
+        "--read-ahead-mb",
+        dest="read_ahead_mb",
+        default=DEFAULT_READ_AHEAD_MB,
+        type=float,
+        help="Memory the decoded images read ahead may take, per process, in MB.",
+    )
+    parser.add_argument(
+        "--metrics",
+        dest="metrics_path",
+        default=None,
+        type=str,
+        help="Write the stage timings of the run to this JSON lines file, nothing is "
+        "written without it.",
+    )
     return parser.parse_args(args)
 
 
@@ -86,17 +305,70 @@ def main():
     logger.info("Exclude Unclassified: {}", exclude_unclassified)
     logger.info("Show Low Values in Legend: {}", show_low_val)
     logger.info("Generate Rock Type ID Arrays: {}", id_arrays)
+    if id_arrays:
+        logger.info("Rock Type ID Array Format: {}", args.id_format)
+    if args.memory_budget is not None:
+        logger.info("Per-worker Memory Budget: {} MB", args.memory_budget)
+    if args.pool_memory is not None:
+        logger.info("Pool Memory Budget: {} MB", args.pool_memory)
+    if args.roi is not None:
+        logger.info("Region of Interest: {} {}", args.roi, args.roi_units)
 
-    tima_mindif_processor(
-        args.project_path,
-        args.mindif_root,
-        output_root=args.output,
+    options = dict(
         exclude_unclassified=exclude_unclassified,
         show_low_val=show_low_val,
         create_thumbnail=create_thumbnail,
         generate_id_array=id_arrays,
         generate_bse=generate_bse,
+        scratch_dir=args.scratch_dir,
+        memory_budget_mb=args.memory_budget,
+        id_array_format=args.id_format,
+        mosaic_format=args.mosaic_format,
+        pyramid=args.pyramid,
+        pyramid_resampling=args.pyramid_resampling,
+        scale=args.scale,
+        modal_tables=args.modal_tables,
+        checkpoint_every=args.checkpoint_every,
+        project_index=args.project_index,
+        index_path=args.index_path,
+        metrics_path=args.metrics_path,
+        encoding=args.encoding,
+        encode_threads=args.encode_threads,
+        read_ahead=args.read_ahead,
+        read_ahead_mb=args.read_ahead_mb,
+        bse_normalise=args.bse_normalise,
+        roi=args.roi,
+        roi_units=args.roi_units,
     )
+    if args.watch:
+        watch_project(
+            args.project_path,
+            args.mindif_root,
+            args.output,
+            processes=args.processes,
+            poll_s=args.poll_s,
+            settle_s=args.settle_s,
+            **options
+        )
+        return
+
+    try:
+        tima_mindif_processor(
+            args.project_path,
+            args.mindif_root,
+            output_root=args.output,
+            parallelism=args.parallelism,
+            processes=args.processes,
+            validate=args.validate or args.fail_fast,
+            fail_fast=args.fail_fast,
+            validation_path=args.validation_path,
+            pool_memory_mb=args.pool_memory,
+            wait_for_enter=args.wait_for_enter,
+            **options
+        )
+    except ValidationError as error:
+        logger.error("{}", error)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,61 @@
+# Atomic output files.
+#
+# Outputs are first written under a partial name in the same directory and renamed into
+# place once they are complete, so a run that is killed half way never leaves a truncated
+# file behind under the real name. The partial name keeps the extension, PIL picks the
+# image format from it. It holds the host and process ID too: workers of a work queue
+# may write the same output at the same time when a claim was taken for stale, and must
+# not write into each other's partial files.
+
+import json
+import os
+import shutil
+import socket
+
+PARTIAL_PREFIX = ".partial."
+
+
+def partial_path(path: str) -> str:
+    directory, name = os.path.split(path)
+    return os.path.join(
+        directory,
+        "{}{}-{}.{}".format(PARTIAL_PREFIX, socket.gethostname(), os.getpid(), name),
+    )
+
+
+def commit_output(partial: str, path: str):
+    """Move a completed partial file or directory to path, replacing what is there."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    os.replace(partial, path)
+
+
+def discard_output(partial: str):
+    if os.path.isdir(partial) and not os.path.islink(partial):
+        shutil.rmtree(partial, ignore_errors=True)
+    elif os.path.exists(partial):
+        os.remove(partial)
+
+
+def write_atomically(path: str, write, *args, **kwargs):
+    """Call write(partial, *args, **kwargs) and move the partial output to path.
+
+    Returns whatever write returns. If write fails the partial output is removed.
+    """
+    partial = partial_path(path)
+    try:
+        result = write(partial, *args, **kwargs)
+    except BaseException:
+        discard_output(partial)
+        raise
+    commit_output(partial, path)
+    return result
+
+
+def _dump_json(path: str, data):
+    with open(path, "w") as file:
+        json.dump(data, file, indent=2)
+
+
+def write_json(path: str, data):
+    write_atomically(path, _dump_json, data)
@@ -0,0 +1,270 @@
+# Headless batch runs of several projects on one worker pool.
+#
+# tima_mindif_processor handles a single project, builds a pool of its own and waits
+# for Enter when it is done, so a nightly job had to start it once per project and feed
+# it stdin, and the workers went idle at every project boundary. run_batch() plans every
+# job of a manifest up front and puts the samples of all of them through one long-lived
+# pool, largest first and within the pool memory budget. Workers are replaced after a
+# number of samples, which returns whatever memory they accumulated. Nothing waits for
+# input.
+#
+# Every sample gets a result with its status and timings, and the batch exits with 1
+# when any sample or job failed. The manifest is a JSON file with the jobs:
+#
+#   {"jobs": [{"project_path": "...", "mindif_root": "...", "output": "...",
+#              "options": {"generate_bse": false, "modal_tables": true}}]}
+#
+# The options are keyword arguments of tima_mindif_processor, apart from those that
+# belong to the whole batch and those of the validation pre-pass, which batches do not
+# run.
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from loguru import logger
+from .atomic import write_atomically
+from .tima_mindif_processor import (
+    estimate_project,
+    finish_project,
+    plan_project,
+    process_samples,
+    set_global,
+    update_project_index,
+)
+
+# Samples a worker processes before it is replaced by a fresh one.
+DEFAULT_MAX_TASKS_PER_CHILD = 20
+# Options set for the whole batch rather than per job.
+BATCH_OPTIONS = ("processes", "parallelism", "pool_memory_mb", "wait_for_enter")
+# Options of tima_mindif_processor that batches do not support.
+VALIDATION_OPTIONS = ("validate", "fail_fast", "validation_path")
+# Result status of the sample statuses of the metrics records.
+RESULT_STATUS = {
+    "completed": "ok",
+    "skipped": "skipped",
+    "failed": "failed",
+    "missing": "failed",
+}
+
+
+def read_manifest(path: str):
+    """Return the jobs of the batch manifest at path."""
+    with open(path) as file:
+        manifest = json.load(file)
+    jobs = manifest["jobs"] if isinstance(manifest, dict) else manifest
+    for job in jobs:
+        for key in ("project_path", "mindif_root", "output"):
+            if key not in job:
+                raise ValueError("A job of {} has no {}".format(path, key))
+        batch_options = set(job.get("options", {})) & set(BATCH_OPTIONS)
+        if batch_options:
+            raise ValueError(
+                "{} can only be set for the whole batch, not for {}".format(
+                    ", ".join(sorted(batch_options)), job["project_path"]
+                )
+            )
+        validation_options = set(job.get("options", {})) & set(VALIDATION_OPTIONS)
+        if validation_options:
+            raise ValueError(
+                "{} of {} are not supported in batches, validate the project with "
+                "tima-mindif --validate instead".format(
+                    ", ".join(sorted(validation_options)), job["project_path"]
+                )
+            )
+    return jobs
+
+
+def sample_result(job_index: int, job: dict, record: dict) -> dict:
+    result = {
+        "job": job_index,
+        "project_path": job["project_path"],
+        "output": job["output"],
+        "guid": record["guid"],
+        "sample_name": record["sample_name"],
+        "status": RESULT_STATUS[record["status"]],
+        "detail": record["status"],
+        "wall_s": record["wall_s"],
+        "cpu_s": record["cpu_s"],
+    }
+    if "error" in record:
+        result["error"] = record["error"]
+    return result
+
+
+def job_failure(job_index: int, job: dict, error) -> dict:
+    return {
+        "job": job_index,
+        "project_path": job["project_path"],
+        "output": job["output"],
+        "guid": None,
+        "sample_name": None,
+        "status": "failed",
+        "detail": "job",
+        "wall_s": 0.0,
+        "cpu_s": 0.0,
+        "error": repr(error),
+    }
+
+
+def run_batch(
+    jobs,
+    processes: int = None,
+    pool_memory_mb: float = None,
+    max_tasks_per_child: int = DEFAULT_MAX_TASKS_PER_CHILD,
+):
+    """Process the samples of all jobs on one pool and return their results.
+
+    Every job is a dict with project_path, mindif_root, output and optionally options.
+    A job that cannot be planned gets a single failed result, the others still run.
+    """
+    start = time.time()
+    processes = processes or os.cpu_count() or 1
+    results = []
+    pool = multiprocessing.Pool(
+        processes,
+        initializer=set_global,
+        initargs=(logger,),
+        maxtasksperchild=max_tasks_per_child,
+    )
+    try:
+        plans = []
+        tasks = []
+        estimates = []
+        for job_index, job in enumerate(jobs):
+            try:
+                plan = plan_project(
+                    job["project_path"],
+                    job["mindif_root"],
+                    job["output"],
+                    processes,
+                    parallelism="sample",
+                    **job.get("options", {})
+                )
+                update_project_index(pool, plan)
+                job_estimates = estimate_project(pool, plan)
+            # read_project_samples exits on projects it cannot read, which must not end
+            # the batch.
+            except (Exception, SystemExit) as error:
+                logger.error("Job {} failed: {!r}", job["project_path"], error)
+                results.append(job_failure(job_index, job, error))
+                continue
+            plans.append((job_index, job, plan, len(tasks)))
+            tasks.extend((plan["func"], sample) for sample in plan["samples"])
+            estimates.extend(job_estimates)
+
+        records = process_samples(pool, tasks, estimates, pool_memory_mb, processes)
+        wall_s = time.time() - start
+        for job_index, job, plan, first in plans:
+            job_records = records[first : first + len(plan["samples"])]
+            finish_project(plan, job_records, wall_s, processes)
+            results.extend(
+                sample_result(job_index, job, record) for record in job_records
+            )
+    except KeyboardInterrupt:
+        logger.warning("Caught KeyboardInterrupt, terminating workers")
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    results.sort(key=lambda result: result["job"])
+    return results
+
+
+def batch_failed(results) -> bool:
+    return any(result["status"] == "failed" for result in results)
+
+
+def _dump_results(path: str, results):
+    with open(path, "w") as file:
+        json.dump({"results": results}, file, indent=2)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Process the TIMA projects of a batch manifest on one worker pool."
+    )
+    parser.add_argument("manifest", type=str, help="Path to the JSON batch manifest")
+    parser.add_argument(
+        "--processes",
+        "-p",
+        dest="processes",
+        default=None,
+        type=int,
+        help="Number of worker processes, defaults to the number of cores.",
+    )
+    parser.add_argument(
+        "--pool-memory",
+        dest="pool_memory",
+        default=None,
+        type=float,
+        help="Memory the workers may use together in MB. Defaults to 80%% of the physical memory.",
+    )
+    parser.add_argument(
+        "--max-tasks-per-child",
+        dest="max_tasks_per_child",
+        default=DEFAULT_MAX_TASKS_PER_CHILD,
+        type=int,
+        help="Samples a worker processes before it is replaced.",
+    )
+    parser.add_argument(
+        "--results",
+        dest="results_path",
+        default=None,
+        type=str,
+        help="Path of the JSON file with the result of every sample.",
+    )
+    parser.add_argument(
+        "--verbose", "-v", action="store_true", help="Enables verbose logging"
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
+    logger.remove()
+    logger.add(
+        sys.stdout,
+        enqueue=True,
+        level="INFO" if not args.verbose else "DEBUG",
+        format="<green>{time:HH:mm:ss}</green> | <cyan>{process}</cyan> | <level>{message}</level>",
+    )
+
+    jobs = read_manifest(args.manifest)
+    logger.info("Starting a batch of {} projects from {}", len(jobs), args.manifest)
+    results = run_batch(
+        jobs,
+        processes=args.processes,
+        pool_memory_mb=args.pool_memory,
+        max_tasks_per_child=args.max_tasks_per_child,
+    )
+    if args.results_path:
+        write_atomically(args.results_path, _dump_results, results)
+        logger.info("Results written to {}", args.results_path)
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    logger.info(
+        "Batch complete: {}",
+        ", ".join(
+            "{} {}".format(count, status) for status, count in sorted(counts.items())
+        ),
+    )
+    for result in results:
+        if result["status"] == "failed":
+            logger.error(
+                "Failed: {} {} ({})",
+                result["project_path"],
+                result["sample_name"] or "",
+                result.get("error", result["detail"]),
+            )
+    return 1 if batch_failed(results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
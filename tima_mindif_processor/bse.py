@@ -0,0 +1,123 @@
+# Bit depth and cross-field normalisation of the BSE mosaic.
+#
+# TIMA writes 16-bit bse.png files, but 8-bit ones turn up in older and converted
+# exports. The mosaic keeps the bit depth of the first bse.png of a sample: an 8-bit
+# export gives an 8-bit mosaic rather than a nearly black 16-bit one. Fields of the
+# other depth are rescaled to it, by 257 up and by a rounded division by 257 down.
+#
+# The brightness and contrast of the fields drift during a measurement, which shows as
+# seams in the mosaic. When normalisation is asked for, composite_field takes the 1st
+# and 99th percentile of the BSE values under the mask of every field from a histogram
+# and records the box of the canvas it wrote the field to. normalise_bse() then maps the
+# levels of every field linearly onto the median levels of all fields, a band of canvas
+# rows at a time. Where fields overlap, the pixels belong to the field written last, as
+# they do on the canvas.
+
+from typing import Optional, Tuple
+import numpy as np
+from PIL import Image
+
+# Percentiles of the BSE values of a field taken as its black and white levels.
+LEVEL_PERCENTILES = (1, 99)
+# Canvas rows normalised at a time.
+NORMALISE_BAND_ROWS = 512
+
+
+def bse_dtype(info: dict) -> np.dtype:
+    """dtype of the BSE mosaic of a sample: uint8 if its first bse.png is 8-bit."""
+    for field_name, _, _ in info["fields"]:
+        try:
+            with Image.open(
+                info["field_path_format"].format(field_name, "bse.png")
+            ) as image:
+                mode = image.mode
+        except Exception:
+            continue
+        return np.dtype(np.uint8 if mode == "L" else np.uint16)
+    return np.dtype(np.uint16)
+
+
+def bse_nodata(dtype) -> int:
+    """Value of the BSE mosaic outside the fields, white."""
+    return int(np.iinfo(dtype).max)
+
+
+def to_bit_depth(bse: np.ndarray, dtype) -> np.ndarray:
+    """Rescale decoded BSE values to the bit depth of dtype.
+
+    uint8 arrays are 8-bit sources, anything else is 16-bit (PIL decodes 16-bit PNGs to
+    int32). Values already at the right depth are returned as they are.
+    """
+    if bse.dtype == np.uint8:
+        return bse if np.dtype(dtype) == np.uint8 else bse.astype(np.uint16) * 257
+    if np.dtype(dtype) == np.uint8:
+        return ((bse.astype(np.uint32) + 128) // 257).astype(np.uint8)
+    return bse
+
+
+def field_levels(bse: np.ndarray, mask: np.ndarray) -> Optional[Tuple[int, int]]:
+    """The LEVEL_PERCENTILES of the BSE values under mask, None if the mask is empty."""
+    values = bse[mask]
+    if not len(values):
+        return None
+    cumulative = np.cumsum(np.bincount(values))
+    low, high = (
+        int(np.searchsorted(cumulative, cumulative[-1] * percentile / 100))
+        for percentile in LEVEL_PERCENTILES
+    )
+    return low, high
+
+
+def level_mapping(field_stats):
+    """The (bse_box, gain, offset) of every field written to the BSE mosaic.
+
+    field_stats are the FieldStats of the fields in compositing order, None for fields
+    with missing images. Fields without levels, or without contrast, keep their values.
+    """
+    written = [
+        stats
+        for stats in field_stats
+        if stats is not None and stats.bse_box is not None
+    ]
+    levels = [stats.bse_levels for stats in written if stats.bse_levels is not None]
+    if not levels:
+        return []
+    target_low, target_high = np.median(np.array(levels, dtype=np.float64), axis=0)
+    mapping = []
+    for stats in written:
+        gain, offset = 1.0, 0.0
+        if stats.bse_levels is not None and stats.bse_levels[1] > stats.bse_levels[0]:
+            low, high = stats.bse_levels
+            gain = (target_high - target_low) / (high - low)
+            offset = target_low - gain * low
+        mapping.append((stats.bse_box, gain, offset))
+    return mapping
+
+
+def normalise_bse(
+    canvas: np.ndarray, field_stats, band_rows: int = NORMALISE_BAND_ROWS
+):
+    """Map the levels of every field of the BSE mosaic canvas onto common levels.
+
+    canvas is changed in place, field_stats are as for level_mapping().
+    """
+    mapping = level_mapping(field_stats)
+    if not mapping:
+        return
+    gains = np.array([1.0] + [gain for _, gain, _ in mapping])
+    offsets = np.array([0.0] + [offset for _, _, offset in mapping])
+    maximum = np.iinfo(canvas.dtype).max
+    for top in range(0, canvas.shape[0], band_rows):
+        bottom = min(top + band_rows, canvas.shape[0])
+        # Index into gains of the field every pixel of the band belongs to, 0 outside.
+        owner = np.zeros((bottom - top, canvas.shape[1]), dtype=np.int32)
+        for index, ((left, box_top, right, box_bottom), _, _) in enumerate(mapping, 1):
+            if box_bottom > top and box_top < bottom:
+                owner[max(box_top, top) - top : box_bottom - top, left:right] = index
+        owned = owner > 0
+        if not owned.any():
+            continue
+        band = canvas[top:bottom]
+        owner = owner[owned]
+        values = band[owned] * gains[owner] + offsets[owner]
+        band[owned] = np.clip(np.rint(values), 0, maximum)
@@ -0,0 +1,80 @@
+# Per-process cache of what the samples of a survey have in common.
+#
+# The samples of a survey usually share their classification scheme, yet every
+# create_sample call loaded the legend fonts again, parsed phases.xml, rebuilt the colour
+# lookup tables and measured every mineral name for the width of the legend. This cache
+# keeps all of them for the life of the process: fonts by path and size, parsed phase
+# tables by the SHA-1 of their phases.xml, colour lookup tables by the colours of the
+# phases and legend text widths by font and text. The pool initializer set_global starts
+# it afresh in every worker, other processes start it on first use.
+#
+# Cached values are shared between samples and must not be modified, the lookup tables
+# are read-only arrays.
+
+import hashlib
+from PIL import ImageFont
+
+_cache = {}
+
+
+def init_cache():
+    """Start with an empty cache."""
+    _cache.clear()
+    _cache.update(fonts={}, phase_tables={}, colour_luts={}, text_widths={})
+
+
+def _section(name: str) -> dict:
+    if not _cache:
+        init_cache()
+    return _cache[name]
+
+
+def cache_sizes() -> dict:
+    """Number of entries in every part of the cache."""
+    if not _cache:
+        init_cache()
+    return {name: len(section) for name, section in _cache.items()}
+
+
+def truetype_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    fonts = _section("fonts")
+    key = (path, size)
+    if key not in fonts:
+        fonts[key] = ImageFont.truetype(path, size)
+    return fonts[key]
+
+
+def text_width(font: ImageFont.FreeTypeFont, text: str) -> int:
+    widths = _section("text_widths")
+    key = (font.path, font.size, text)
+    if key not in widths:
+        widths[key] = font.getbbox(text)[2]
+    return widths[key]
+
+
+def phase_table(path: str, parse):
+    """Return parse(data) for the contents of the phases.xml at path.
+
+    parse is only called for contents that were not seen before.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    tables = _section("phase_tables")
+    key = hashlib.sha1(data).hexdigest()
+    if key not in tables:
+        tables[key] = parse(data)
+    return tables[key]
+
+
+def colour_lut(phase_map: dict, build):
+    """Return build(phase_map), the colour lookup tables of the phases in phase_map."""
+    luts = _section("colour_luts")
+    key = tuple(
+        (phase_id, phase["colour"]) for phase_id, phase in sorted(phase_map.items())
+    )
+    if key not in luts:
+        tables = build(phase_map)
+        for table in tables:
+            table.setflags(write=False)
+        luts[key] = tables
+    return luts[key]
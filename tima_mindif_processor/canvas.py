@@ -0,0 +1,186 @@
+# Allocation of the sample canvases.
+#
+# Small samples are composited in ordinary in-memory arrays. When the canvases of a sample
+# would not fit into the per-worker memory budget they are backed by np.memmap scratch
+# files instead, so the resident memory of a worker stays at roughly one field plus
+# whatever the page cache decides to keep.
+#
+# When the fields of one sample are composited by several processes the canvases have to
+# be visible to all of them. Memory mapped canvases already are, in-memory canvases are
+# then placed in multiprocessing.shared_memory blocks. Either kind is described by a small
+# picklable tuple that the workers hand to attach_canvas().
+#
+# Checkpointed samples keep their memory mapped canvases in a fixed directory instead of a
+# temporary one, so a later run can reopen them and carry on where the last one stopped.
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from multiprocessing import shared_memory
+
+FILL_ROWS = 1024
+
+
+def canvas_nbytes(shape, dtype) -> int:
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+
+def _fill(canvas: np.ndarray, fill_value):
+    # Fill in bands so a memory mapped canvas never has to be resident at once.
+    for start in range(0, canvas.shape[0], FILL_ROWS):
+        canvas[start : start + FILL_ROWS] = fill_value
+
+
+class CanvasStore:
+    """Hands out the canvases for one sample.
+
+    If scratch_dir is None the canvases are plain arrays, or shared memory blocks when
+    shared is set. Otherwise they are memory mapped files in a private directory below
+    scratch_dir, or directly in path if that is given. Everything is released again by
+    close().
+    """
+
+    def __init__(
+        self,
+        scratch_dir: str = None,
+        prefix: str = "tima_",
+        shared: bool = False,
+        path: str = None,
+    ):
+        self.scratch_path = None
+        self.shared = shared
+        self.canvases = []
+        self.descriptors = {}
+        self.shared_blocks = []
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self.scratch_path = path
+        elif scratch_dir is not None:
+            os.makedirs(scratch_dir, exist_ok=True)
+            self.scratch_path = tempfile.mkdtemp(prefix=prefix, dir=scratch_dir)
+
+    @property
+    def out_of_core(self) -> bool:
+        return self.scratch_path is not None
+
+    def full(self, name: str, shape, fill_value, dtype, reuse: bool = False) -> np.ndarray:
+        """Return a new canvas filled with fill_value.
+
+        With reuse set a memory mapped canvas left behind by an earlier store with the same
+        path is opened as it is.
+        """
+        dtype = np.dtype(dtype)
+        if self.out_of_core:
+            path = os.path.join(self.scratch_path, name + ".raw")
+            if (
+                reuse
+                and os.path.exists(path)
+                and os.path.getsize(path) == canvas_nbytes(shape, dtype)
+            ):
+                canvas = np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+            else:
+                canvas = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+                # np.memmap creates the file zeroed.
+                if np.any(np.asarray(fill_value) != 0):
+                    _fill(canvas, fill_value)
+            self.descriptors[name] = ("memmap", path, shape, dtype.str)
+        elif self.shared:
+            block = shared_memory.SharedMemory(
+                create=True, size=max(1, canvas_nbytes(shape, dtype))
+            )
+            self.shared_blocks.append(block)
+            canvas = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            _fill(canvas, fill_value)
+            self.descriptors[name] = ("shm", block.name, shape, dtype.str)
+        else:
+            return np.full(shape, fill_value, dtype=dtype)
+
+        self.canvases.append(canvas)
+        return canvas
+
+    def describe(self, name: str):
+        """Return the descriptor other processes use to attach to canvas name."""
+        return self.descriptors[name]
+
+    def flush(self):
+        """Write the memory mapped canvases back to their files."""
+        for canvas in self.canvases:
+            if isinstance(canvas, np.memmap):
+                canvas.flush()
+
+    def close(self, remove: bool = True):
+        """Release the shared memory and remove the scratch files.
+
+        The caller must have dropped its own references to the canvases first, otherwise
+        the mappings stay alive (and on Windows the files cannot be removed). With remove
+        unset the scratch files are left for a later run.
+        """
+        self.canvases = []
+        self.descriptors = {}
+        for block in self.shared_blocks:
+            block.close()
+            block.unlink()
+        self.shared_blocks = []
+        if self.scratch_path is not None and remove:
+            shutil.rmtree(self.scratch_path, ignore_errors=True)
+        self.scratch_path = None
+
+
+def share_canvases_with_workers():
+    """Prepare this process for sharing canvases with worker processes it starts.
+
+    Must be called before the pool is created. On POSIX shared memory blocks are tracked
+    by the resource tracker, which the workers only share with this process if it is
+    already running when they start. Otherwise each worker would run its own tracker and
+    unlink the blocks it attached to when it exits.
+    """
+    if os.name == "posix":
+        from multiprocessing import resource_tracker
+
+        resource_tracker.ensure_running()
+
+
+def attach_canvas(descriptor):
+    """Attach to a canvas created by another process.
+
+    Returns the array and the handle that keeps it alive. Once every reference to the
+    array has been dropped the handle must be passed to detach_canvas().
+    """
+    kind, location, shape, dtype = descriptor
+    if kind == "memmap":
+        canvas = np.memmap(location, dtype=np.dtype(dtype), mode="r+", shape=shape)
+        return canvas, None
+
+    try:
+        block = shared_memory.SharedMemory(name=location, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block again with the resource
+        # tracker. That is harmless as long as the workers share the tracker of the
+        # parent, see share_canvases_with_workers().
+        block = shared_memory.SharedMemory(name=location)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf), block
+
+
+def detach_canvas(handle):
+    # Memory mapped canvases share the page cache with every other process, dropping the
+    # array is enough for them.
+    if handle is not None:
+        handle.close()
+
+
+def open_canvas_store(
+    canvas_bytes: int,
+    memory_budget_mb: float = None,
+    scratch_dir: str = None,
+    prefix="tima_",
+    shared: bool = False,
+) -> CanvasStore:
+    """Create the CanvasStore for a sample whose canvases take canvas_bytes.
+
+    The canvases are memory mapped when they exceed memory_budget_mb. scratch_dir defaults
+    to the system temporary directory.
+    """
+    if memory_budget_mb is None or canvas_bytes <= memory_budget_mb * 1024 * 1024:
+        return CanvasStore(prefix=prefix, shared=shared)
+    return CanvasStore(scratch_dir or tempfile.gettempdir(), prefix=prefix, shared=shared)
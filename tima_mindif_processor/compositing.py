@@ -0,0 +1,281 @@
+# Array based compositing of MinDif fields onto the sample canvases.
+#
+# Every field is handled as a whole block: the phase IDs are mapped to colours through a
+# lookup table, the mask and the exclude_unclassified rule become boolean arrays, and the
+# result is written into the canvas by slicing. The statistics that used to be accumulated
+# pixel by pixel (histogram, unclassified count, unknown phase count and bounding box)
+# are computed with np.bincount and array reductions.
+#
+# For previews the fields can be block reduced by an integer scale before they are placed:
+# every scale x scale block of the canvas gets the most common class of the field pixels
+# in it (pixels that would not be drawn count as a class of their own) and the mean BSE
+# value. The blocks are aligned to the canvas, not to the field, so neighbouring fields
+# still line up. The statistics are always computed at full resolution.
+#
+# BSE fields are kept at the bit depth of the BSE canvas and can have their levels
+# measured on the way, for the normalisation in bse.py.
+
+from typing import NamedTuple, Optional, Tuple
+import numpy as np
+from .bse import field_levels, to_bit_depth
+
+# Number of pixels with a phase ID missing from phases.xml that a single field may
+# contain before the whole sample is abandoned.
+MAX_UNKNOWN_PHASE_PIXELS = 25
+
+
+class FieldStats(NamedTuple):
+    histogram: np.ndarray
+    classified_count: int
+    unclassified_count: int
+    unknown_count: int
+    unknown_ids: Tuple[int, ...]
+    bbox: Optional[Tuple[int, int, int, int]]
+    # Black and white levels of the BSE values of the field, if they were measured.
+    bse_levels: Optional[Tuple[int, int]] = None
+    # (left, top, right, bottom) box of the BSE canvas the field was written to.
+    bse_box: Optional[Tuple[int, int, int, int]] = None
+
+
+def build_colour_lut(phase_map: dict):
+    """Build the colour lookup table for the phases in phase_map.
+
+    Returns a (N, 3) uint8 colour table indexed by phase ID and a boolean array flagging
+    which IDs are present in phase_map.
+    """
+    size = max(phase_map.keys(), default=-1) + 1
+    colour_lut = np.zeros((size, 3), dtype=np.uint8)
+    known_lut = np.zeros(size, dtype=bool)
+    for phase_id, phase in phase_map.items():
+        colour_lut[phase_id] = phase["colour"]
+        known_lut[phase_id] = True
+    return colour_lut, known_lut
+
+
+def histogram_to_phase_map(phase_map: dict, histogram: np.ndarray):
+    for phase_id, phase in phase_map.items():
+        phase["histogram"] = int(histogram[phase_id])
+
+
+def field_window(field_x: int, field_y: int, field_shape, canvas_shape):
+    """Work out which part of a field lands inside the canvas.
+
+    Returns the (row, column) slices into the field and the matching slices into the
+    canvas, or None if the field lies completely outside of it.
+    """
+    field_h, field_w = field_shape[:2]
+    canvas_h, canvas_w = canvas_shape[:2]
+
+    src_x0 = max(0, -field_x)
+    src_y0 = max(0, -field_y)
+    src_x1 = min(field_w, canvas_w - field_x)
+    src_y1 = min(field_h, canvas_h - field_y)
+    if src_x1 <= src_x0 or src_y1 <= src_y0:
+        return None
+
+    src = (slice(src_y0, src_y1), slice(src_x0, src_x1))
+    dst = (
+        slice(src_y0 + field_y, src_y1 + field_y),
+        slice(src_x0 + field_x, src_x1 + field_x),
+    )
+    return src, dst
+
+
+def clip_window(dst, canvas_shape):
+    """Clip a canvas window to a smaller canvas sharing the same origin.
+
+    Returns the clipped canvas slices and the matching slices relative to the window, or
+    (None, None) when nothing of the window is left.
+    """
+    rows = min(dst[0].stop, canvas_shape[0]) - dst[0].start
+    cols = min(dst[1].stop, canvas_shape[1]) - dst[1].start
+    if rows <= 0 or cols <= 0:
+        return None, None
+    return (
+        (
+            slice(dst[0].start, dst[0].start + rows),
+            slice(dst[1].start, dst[1].start + cols),
+        ),
+        (slice(0, rows), slice(0, cols)),
+    )
+
+
+def align_blocks(block: np.ndarray, dst, scale: int, fill_value):
+    """Pad a window of the full resolution canvas to whole scale x scale blocks.
+
+    Returns the padded window as a (rows, scale, columns, scale) array and the slices of
+    the window on the reduced canvas.
+    """
+    top = dst[0].start % scale
+    left = dst[1].start % scale
+    bottom = -(top + block.shape[0]) % scale
+    right = -(left + block.shape[1]) % scale
+    padded = np.pad(block, ((top, bottom), (left, right)), constant_values=fill_value)
+    rows = padded.shape[0] // scale
+    cols = padded.shape[1] // scale
+    row0 = dst[0].start // scale
+    col0 = dst[1].start // scale
+    return (
+        padded.reshape(rows, scale, cols, scale),
+        (slice(row0, row0 + rows), slice(col0, col0 + cols)),
+    )
+
+
+def block_mode(labels: np.ndarray, dst, scale: int, fill_value: int = -2):
+    """Reduce labels to the most common label of every block, ties go to the lowest.
+
+    Blocks on the edges of the window are padded with fill_value, which is never chosen,
+    so the pixels of the window decide them on their own.
+    """
+    blocks, scaled_dst = align_blocks(labels, dst, scale, fill_value)
+    rows, _, cols, _ = blocks.shape
+    blocks = blocks.transpose(0, 2, 1, 3).reshape(rows * cols, scale * scale)
+    values, inverse = np.unique(blocks, return_inverse=True)
+    inverse = inverse.reshape(blocks.shape) + np.arange(rows * cols)[:, None] * len(values)
+    counts = np.bincount(inverse.ravel(), minlength=rows * cols * len(values))
+    counts = counts.reshape(rows * cols, len(values))
+    counts[:, values == fill_value] = 0
+    choice = counts.argmax(axis=1)
+    return values[choice].reshape(rows, cols), scaled_dst
+
+
+def block_mean(image: np.ndarray, dst, scale: int):
+    """Reduce image to the rounded mean of the pixels of every block."""
+    sums, scaled_dst = align_blocks(image.astype(np.uint64), dst, scale, 0)
+    counts, _ = align_blocks(np.ones(image.shape, dtype=np.uint64), dst, scale, 0)
+    sums = sums.sum(axis=(1, 3))
+    counts = counts.sum(axis=(1, 3))
+    return ((sums + counts // 2) // counts).astype(image.dtype), scaled_dst
+
+
+def composite_field(
+    phases: np.ndarray,
+    mask: np.ndarray,
+    field_x: int,
+    field_y: int,
+    image_size,
+    colour_lut: np.ndarray,
+    known_lut: np.ndarray,
+    exclude_unclassified: bool,
+    rgb_canvas: np.ndarray,
+    id_canvas: Optional[np.ndarray] = None,
+    bse: Optional[np.ndarray] = None,
+    bse_canvas: Optional[np.ndarray] = None,
+    scale: int = 1,
+    bse_levels: bool = False,
+) -> FieldStats:
+    """Composite a single field onto the sample canvases.
+
+    phases, mask and bse are the decoded field images as 2D arrays, image_size is the
+    (width, height) declared in measurement.xml. Only the part of the field covered by
+    both the declared size and the images themselves is used. Pixels that fall outside of
+    the canvas are dropped.
+
+    With a scale above 1 the canvases are a reduced preview: field_x and field_y are still
+    full resolution positions and the canvases cover the full resolution canvas shrunk by
+    scale, rounded up. The statistics are those of the full resolution field, except for
+    the bounding box which is in canvas pixels.
+
+    bse is rescaled to the bit depth of bse_canvas. With bse_levels the levels of the BSE
+    values under the mask are measured as well.
+    """
+    image_width_px, image_height_px = image_size
+    height = min(image_height_px, phases.shape[0], mask.shape[0])
+    width = min(image_width_px, phases.shape[1], mask.shape[1])
+    histogram = np.zeros(len(known_lut), dtype=np.int64)
+
+    full_shape = (rgb_canvas.shape[0] * scale, rgb_canvas.shape[1] * scale)
+    window = field_window(field_x, field_y, (height, width), full_shape)
+    if window is None:
+        return FieldStats(histogram, 0, 0, 0, (), None)
+    src, dst = window
+
+    phase_ids = np.asarray(phases[src], dtype=np.int64)
+    masked = np.asarray(mask[src]) != 0
+
+    unclassified = (phase_ids == 0) & masked
+    candidates = masked if not exclude_unclassified else masked & (phase_ids != 0)
+
+    in_range = (phase_ids >= 0) & (phase_ids < len(known_lut))
+    known = in_range & known_lut[np.where(in_range, phase_ids, 0)]
+    classified = candidates & known
+    unknown = candidates & ~known
+    unknown_count = int(np.count_nonzero(unknown))
+    unknown_ids = tuple(np.unique(phase_ids[unknown]).tolist()) if unknown_count else ()
+
+    levels = bse_box = None
+    if bse is not None and bse_canvas is not None:
+        bse_shape = (min(height, bse.shape[0]), min(width, bse.shape[1]))
+        bse_full_shape = (bse_canvas.shape[0] * scale, bse_canvas.shape[1] * scale)
+        bse_window = field_window(field_x, field_y, bse_shape, bse_full_shape)
+        if bse_window is not None:
+            bse_src, bse_dst = bse_window
+            bse_block = to_bit_depth(np.asarray(bse[bse_src]), bse_canvas.dtype)
+            if bse_levels:
+                levels = field_levels(bse_block, np.asarray(mask[bse_src]) != 0)
+            if scale > 1:
+                bse_block, bse_dst = block_mean(bse_block, bse_dst, scale)
+            bse_canvas[bse_dst] = bse_block
+            bse_box = (
+                bse_dst[1].start,
+                bse_dst[0].start,
+                min(bse_dst[1].stop, bse_canvas.shape[1]),
+                min(bse_dst[0].stop, bse_canvas.shape[0]),
+            )
+
+    classified_ids = phase_ids[classified]
+    classified_count = len(classified_ids)
+    if classified_count:
+        histogram = np.bincount(classified_ids, minlength=len(known_lut))
+
+    if classified_count and scale > 1:
+        phase_ids, dst = block_mode(np.where(classified, phase_ids, -1), dst, scale)
+        classified = phase_ids >= 0
+        classified_ids = phase_ids[classified]
+
+    # Sparse classified pixels may not win any block of a preview.
+    if len(classified_ids):
+        rgb_block = rgb_canvas[dst]
+        rgb_block[classified] = colour_lut[classified_ids]
+
+        if id_canvas is not None:
+            id_dst, id_src = clip_window(dst, id_canvas.shape)
+            if id_dst is not None:
+                id_block = id_canvas[id_dst]
+                id_classified = classified[id_src]
+                id_block[id_classified] = phase_ids[id_src][id_classified]
+
+        rows = np.flatnonzero(classified.any(axis=1))
+        cols = np.flatnonzero(classified.any(axis=0))
+        bbox = (
+            int(cols[0]) + dst[1].start,
+            int(rows[0]) + dst[0].start,
+            int(cols[-1]) + dst[1].start,
+            int(rows[-1]) + dst[0].start,
+        )
+    else:
+        bbox = None
+
+    return FieldStats(
+        histogram,
+        classified_count,
+        int(np.count_nonzero(unclassified)),
+        unknown_count,
+        unknown_ids,
+        bbox,
+        levels,
+        bse_box,
+    )
+
+
+def merge_bbox(bbox, other):
+    if other is None:
+        return bbox
+    if bbox is None:
+        return other
+    return (
+        min(bbox[0], other[0]),
+        min(bbox[1], other[1]),
+        max(bbox[2], other[2]),
+        max(bbox[3], other[3]),
+    )
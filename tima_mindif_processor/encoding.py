@@ -0,0 +1,20 @@
+# Encoding profiles of the mosaics.
+#
+# A profile sets how hard the classification and BSE mosaics are compressed: fast trades
+# disk space for speed (a low deflate level for PNG, uncompressed tiles for TIFF), small
+# compresses as much as deflate can for archiving and balanced is the default. All three
+# store exactly the same pixels.
+
+ENCODING_PROFILES = {
+    "fast": {"png_compress_level": 1, "tiff_compress_level": 0},
+    "balanced": {"png_compress_level": 6, "tiff_compress_level": 6},
+    "small": {"png_compress_level": 9, "tiff_compress_level": 9},
+}
+DEFAULT_ENCODING_PROFILE = "balanced"
+
+
+def encoding_profile(name: str) -> dict:
+    try:
+        return ENCODING_PROFILES[name]
+    except KeyError:
+        raise ValueError("Unknown encoding profile {}".format(name)) from None
@@ -0,0 +1,134 @@
+# Writers for the phase ID arrays.
+#
+# The ID canvas is kept in the smallest unsigned dtype that holds every phase ID listed in
+# phases.xml, with the largest value of that dtype reserved as the nodata value for pixels
+# that have not been classified. The array can be written as the original gzipped CSV
+# (with -1 for nodata), as a raw .npy that can be memory mapped, as a compressed .npz or
+# as a directory of .npy chunks. Every format except CSV gets a JSON sidecar describing
+# the dtype, nodata value, pixel spacing and fields.
+
+import gzip
+import os
+import numpy as np
+from .atomic import write_atomically, write_json
+
+ID_ARRAY_FORMATS = ("csv", "npy", "npz", "chunked")
+CSV_NODATA = -1
+WRITE_ROWS = 1024
+DEFAULT_CHUNK_SIZE = 1024
+
+
+def id_array_dtype(max_phase_id: int):
+    """Return the (dtype, nodata) pair for an ID array holding IDs up to max_phase_id."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        nodata = int(np.iinfo(dtype).max)
+        if max_phase_id < nodata:
+            return np.dtype(dtype), nodata
+    raise ValueError("Phase ID {} is too large for an ID array".format(max_phase_id))
+
+
+def id_array_paths(output_root: str, sample_name: str, id_format: str):
+    """Return every path written for an ID array in id_format."""
+    paths = [id_array_path(output_root, sample_name, id_format)]
+    if id_format != "csv":
+        paths.append(sidecar_path(output_root, sample_name))
+    return paths
+
+
+def id_array_path(output_root: str, sample_name: str, id_format: str) -> str:
+    if id_format == "csv":
+        return os.path.join(output_root, sample_name + ".csv.gz")
+    if id_format == "npy":
+        return os.path.join(output_root, sample_name + ".npy")
+    if id_format == "npz":
+        return os.path.join(output_root, sample_name + ".npz")
+    if id_format == "chunked":
+        return os.path.join(output_root, sample_name + "_id_chunks")
+    raise ValueError("Unknown ID array format {}".format(id_format))
+
+
+def sidecar_path(output_root: str, sample_name: str) -> str:
+    return os.path.join(output_root, sample_name + ".id_array.json")
+
+
+def write_csv(path: str, id_array: np.ndarray, nodata: int):
+    with gzip.open(path, "wt") as file:
+        for start in range(0, id_array.shape[0], WRITE_ROWS):
+            band = id_array[start : start + WRITE_ROWS]
+            rows = band.astype(np.int64)
+            rows[band == nodata] = CSV_NODATA
+            np.savetxt(file, rows, fmt="%d", delimiter=",", newline="\n")
+
+
+def write_npy(path: str, id_array: np.ndarray):
+    output = np.lib.format.open_memmap(
+        path, mode="w+", dtype=id_array.dtype, shape=id_array.shape
+    )
+    for start in range(0, id_array.shape[0], WRITE_ROWS):
+        output[start : start + WRITE_ROWS] = id_array[start : start + WRITE_ROWS]
+    output.flush()
+    del output
+
+
+def write_npz(path: str, id_array: np.ndarray, nodata: int):
+    np.savez_compressed(path, id_array=id_array, nodata=np.array(nodata, id_array.dtype))
+
+
+def write_chunks(path: str, id_array: np.ndarray, nodata: int, chunk_size: int):
+    """Write id_array as chunk_size square .npy files, chunks without data are skipped."""
+    os.makedirs(path, exist_ok=True)
+    chunks = []
+    for row in range(0, id_array.shape[0], chunk_size):
+        for col in range(0, id_array.shape[1], chunk_size):
+            chunk = np.asarray(id_array[row : row + chunk_size, col : col + chunk_size])
+            if (chunk == nodata).all():
+                continue
+            name = "r{}_c{}.npy".format(row // chunk_size, col // chunk_size)
+            np.save(os.path.join(path, name), chunk)
+            chunks.append({"file": name, "row": row, "col": col, "shape": chunk.shape})
+    return chunks
+
+
+def write_id_array(
+    output_root: str,
+    sample_name: str,
+    id_array: np.ndarray,
+    nodata: int,
+    id_format: str,
+    metadata: dict,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+):
+    """Write id_array in id_format and return the path written.
+
+    metadata is stored in the sidecar next to the array together with the layout of the
+    array itself.
+    """
+    path = id_array_path(output_root, sample_name, id_format)
+    if id_format == "csv":
+        write_atomically(path, write_csv, id_array, nodata)
+        return path
+
+    sidecar = dict(metadata)
+    sidecar.update(
+        {
+            "format": id_format,
+            "path": os.path.basename(path),
+            "dtype": id_array.dtype.name,
+            "nodata": nodata,
+            "shape": list(id_array.shape),
+        }
+    )
+    if id_format == "npy":
+        write_atomically(path, write_npy, id_array)
+    elif id_format == "npz":
+        write_atomically(path, write_npz, id_array, nodata)
+    elif id_format == "chunked":
+        sidecar["chunk_size"] = chunk_size
+        sidecar["chunks"] = write_atomically(
+            path, write_chunks, id_array, nodata, chunk_size
+        )
+    else:
+        raise ValueError("Unknown ID array format {}".format(id_format))
+
+    write_json(sidecar_path(output_root, sample_name), sidecar)
+    return path
@@ -0,0 +1,228 @@
+# Run manifests and field checkpoints.
+#
+# Every sample gets a <name>.manifest.json next to its outputs. For every output that was
+# completed it records the files written and a key made from fingerprints of the inputs
+# the output depends on and of the options it was made with. The XML files are
+# fingerprinted by content, the field images by size and modification time. A later run
+# only regenerates the outputs whose key changed or whose files are missing, so
+# re-exported samples are processed again and new outputs can be added to finished
+# samples.
+#
+# A sample whose canvases are memory mapped can also be checkpointed every few fields.
+# The checkpoint sits next to the canvas files and holds the number of fields composited
+# and their statistics, so a killed run picks up after the last checkpoint.
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from loguru import logger
+from .atomic import write_json
+from .compositing import FieldStats
+
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1024 * 1024
+CHECKPOINT_FILE = "checkpoint.json"
+
+FIELD_IMAGE_GROUPS = {"phases": ("phases.tif", "mask.png"), "bse": ("bse.png",)}
+
+# The input groups and options every output depends on.
+OUTPUT_INPUTS = {
+    "classification": ("xml", "phases"),
+    "bse": ("xml", "bse"),
+    "id_array": ("xml", "phases"),
+    "thumbnail": ("xml", "phases"),
+    "pyramid": ("xml", "phases"),
+    "bse_pyramid": ("xml", "bse"),
+    "modal": ("xml", "phases"),
+}
+OUTPUT_OPTIONS = {
+    "classification": ("exclude_unclassified", "show_low_val", "scale", "mosaic_format"),
+    "bse": ("scale", "mosaic_format", "bse_normalise"),
+    "id_array": ("exclude_unclassified", "scale", "id_array_format"),
+    "thumbnail": ("exclude_unclassified", "scale"),
+    "pyramid": ("exclude_unclassified", "scale", "pyramid_resampling"),
+    "bse_pyramid": ("scale", "bse_normalise"),
+    "modal": ("exclude_unclassified",),
+}
+
+
+def manifest_path(output_root: str, output_name: str) -> str:
+    return os.path.join(output_root, output_name + ".manifest.json")
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _stat_entry(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _digest(data) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def input_fingerprints(info: dict) -> dict:
+    """Fingerprint the inputs of a sample, by input group."""
+    xml_path = info["xml_path"]
+    fingerprints = {
+        "xml": _digest(
+            {
+                name: file_digest(os.path.join(xml_path, name))
+                for name in ("phases.xml", "measurement.xml", "fields.xml")
+            }
+        )
+    }
+    for group, image_names in FIELD_IMAGE_GROUPS.items():
+        fingerprints[group] = _digest(
+            [
+                [
+                    field_name,
+                    [
+                        _stat_entry(info["field_path_format"].format(field_name, name))
+                        for name in image_names
+                    ],
+                ]
+                for field_name, _, _ in info["fields"]
+            ]
+        )
+    return fingerprints
+
+
+def output_key(kind: str, fingerprints: dict, options: dict) -> str:
+    return _digest(
+        {
+            "inputs": {group: fingerprints[group] for group in OUTPUT_INPUTS[kind]},
+            "options": {name: options[name] for name in OUTPUT_OPTIONS[kind]},
+        }
+    )
+
+
+def checkpoint_key(fingerprints: dict, options: dict, canvas_layout: dict) -> str:
+    """Key of a checkpoint, it is only resumed from by a run with the same key."""
+    return _digest(
+        {"inputs": fingerprints, "options": options, "canvases": canvas_layout}
+    )
+
+
+class SampleManifest:
+    """The manifest of one sample, saved after every output that is recorded."""
+
+    def __init__(self, output_root: str, output_name: str):
+        self.output_root = output_root
+        self.path = manifest_path(output_root, output_name)
+        self.outputs = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as file:
+                    data = json.load(file)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.outputs = data["outputs"]
+            except (ValueError, KeyError, OSError):
+                logger.warning("Ignoring unreadable manifest {}", self.path)
+
+    def is_current(self, kind: str, key: str) -> bool:
+        record = self.outputs.get(kind)
+        return (
+            record is not None
+            and record["key"] == key
+            and all(
+                os.path.exists(os.path.join(self.output_root, name))
+                for name in record["paths"]
+            )
+        )
+
+    def record(self, kind: str, key: str, paths):
+        self.outputs[kind] = {
+            "key": key,
+            "paths": [os.path.relpath(path, self.output_root) for path in paths],
+            "completed": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        self.save()
+
+    def save(self):
+        if not os.path.exists(self.output_root):
+            os.makedirs(self.output_root)
+        write_json(self.path, {"version": MANIFEST_VERSION, "outputs": self.outputs})
+
+
+def _stats_to_dict(field_name: str, stats):
+    if stats is None:
+        return {"field_name": field_name}
+    return {
+        "field_name": field_name,
+        "histogram": stats.histogram.tolist(),
+        "classified_count": stats.classified_count,
+        "unclassified_count": stats.unclassified_count,
+        "unknown_count": stats.unknown_count,
+        "unknown_ids": list(stats.unknown_ids),
+        "bbox": list(stats.bbox) if stats.bbox is not None else None,
+        "bse_levels": list(stats.bse_levels) if stats.bse_levels is not None else None,
+        "bse_box": list(stats.bse_box) if stats.bse_box is not None else None,
+    }
+
+
+def _stats_from_dict(data):
+    if "histogram" not in data:
+        return data["field_name"], None
+    return (
+        data["field_name"],
+        FieldStats(
+            np.array(data["histogram"], dtype=np.int64),
+            data["classified_count"],
+            data["unclassified_count"],
+            data["unknown_count"],
+            tuple(data["unknown_ids"]),
+            tuple(data["bbox"]) if data["bbox"] is not None else None,
+            tuple(data["bse_levels"]) if data.get("bse_levels") is not None else None,
+            tuple(data["bse_box"]) if data.get("bse_box") is not None else None,
+        ),
+    )
+
+
+def save_checkpoint(directory: str, key: str, field_results):
+    """Record that the fields of field_results, (field_name, FieldStats) pairs, are done."""
+    write_json(
+        os.path.join(directory, CHECKPOINT_FILE),
+        {
+            "key": key,
+            "fields": [_stats_to_dict(name, stats) for name, stats in field_results],
+        },
+    )
+
+
+def load_checkpoint(directory: str, key: str):
+    """Return the (field_name, FieldStats) pairs of a checkpoint made with key.
+
+    Returns None if there is no usable checkpoint.
+    """
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as file:
+            data = json.load(file)
+        if data["key"] != key:
+            return None
+        return [_stats_from_dict(field) for field in data["fields"]]
+    except (ValueError, KeyError, OSError):
+        logger.warning("Ignoring unreadable checkpoint {}", path)
+        return None
+
+
+def discard_checkpoint(directory: str):
+    """Stop the canvases in directory from being resumed from."""
+    try:
+        os.remove(os.path.join(directory, CHECKPOINT_FILE))
+    except FileNotFoundError:
+        pass
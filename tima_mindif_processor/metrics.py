@@ -0,0 +1,203 @@
+# Per-stage timing and resource metrics of a run.
+#
+# create_sample records the wall and CPU time of every stage of a sample (metadata
+# parsing, field decoding, compositing, legend drawing and every writer) with
+# SampleMetrics, together with the bytes read and written, the number of fields and
+# pixels composited and the peak RSS of the process that did the work. Fields composited
+# by the workers of a field-parallel run send their own metrics back with their results,
+# which are merged into those of the sample, so the time of their stages is summed over
+# the workers.
+#
+# The driver logs a summary table of the stages and, when a metrics file is given,
+# writes one JSON line per sample and a final line for the whole run to it. Nothing is
+# written by default, the output folder is left to the images.
+
+import contextlib
+import json
+import os
+import sys
+import time
+from loguru import logger
+from .atomic import write_atomically
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak RSS is then not recorded.
+    resource = None
+
+COUNTERS = ("bytes_read", "bytes_written", "fields", "missing_fields", "pixels")
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, None where it is not known."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    if sys.platform == "darwin":
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+def path_bytes(paths) -> int:
+    """Total size of the files at paths, directories are walked."""
+    total = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                total += sum(
+                    os.path.getsize(os.path.join(directory, name)) for name in names
+                )
+        elif os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+class SampleMetrics:
+    """Stage times and counters of one sample, or of the fields of a pool task."""
+
+    def __init__(self, sample_name: str = None, guid: str = None):
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.record = {
+            "type": "sample",
+            "sample_name": sample_name,
+            "guid": guid,
+            "status": "completed",
+            "stages": {},
+            "workers": {},
+        }
+        self.record.update({name: 0 for name in COUNTERS})
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.add_stage(
+                name, time.perf_counter() - wall, time.process_time() - cpu
+            )
+
+    def add_stage(self, name: str, wall_s: float, cpu_s: float, calls: int = 1):
+        stage = self.record["stages"].setdefault(
+            name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0}
+        )
+        stage["wall_s"] += wall_s
+        stage["cpu_s"] += cpu_s
+        stage["calls"] += calls
+
+    def add(self, counter: str, value: int):
+        self.record[counter] += value
+
+    def worker_record(self) -> dict:
+        """The record of a pool task, to be merged into the sample in the parent."""
+        self.record["workers"][str(os.getpid())] = peak_rss_mb()
+        return self.record
+
+    def merge(self, record: dict):
+        for name, stage in record["stages"].items():
+            self.add_stage(name, stage["wall_s"], stage["cpu_s"], stage["calls"])
+        for counter in COUNTERS:
+            self.record[counter] += record[counter]
+        for pid, peak in record["workers"].items():
+            known = self.record["workers"].get(pid)
+            self.record["workers"][pid] = max(
+                (value for value in (known, peak) if value is not None), default=None
+            )
+
+    def finish(self, status: str = None) -> dict:
+        """Complete the record with the totals of the sample and return it."""
+        if status is not None:
+            self.record["status"] = status
+        wall_s = time.perf_counter() - self.start
+        self.record["wall_s"] = wall_s
+        self.record["cpu_s"] = time.process_time() - self.cpu_start
+        self.record["pid"] = os.getpid()
+        self.record["peak_rss_mb"] = peak_rss_mb()
+        self.record["megapixels_per_s"] = (
+            self.record["pixels"] / wall_s / 1e6 if wall_s > 0 else 0.0
+        )
+        return self.record
+
+
+def run_record(sample_records, wall_s: float, processes: int, parallelism: str) -> dict:
+    """Totals of a run over the records of its samples."""
+    stages = {}
+    for record in sample_records:
+        for name, stage in record["stages"].items():
+            total = stages.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0})
+            for key in total:
+                total[key] += stage[key]
+    record = {
+        "type": "run",
+        "wall_s": wall_s,
+        "processes": processes,
+        "parallelism": parallelism,
+        "samples": len(sample_records),
+        "statuses": {},
+        "stages": stages,
+        "peak_rss_mb": max(
+            (
+                peak
+                for sample in sample_records
+                for peak in [sample.get("peak_rss_mb")]
+                + list(sample["workers"].values())
+                if peak is not None
+            ),
+            default=peak_rss_mb(),
+        ),
+    }
+    for sample in sample_records:
+        record["statuses"][sample["status"]] = (
+            record["statuses"].get(sample["status"], 0) + 1
+        )
+    for counter in COUNTERS:
+        record[counter] = sum(sample[counter] for sample in sample_records)
+    record["megapixels_per_s"] = record["pixels"] / wall_s / 1e6 if wall_s > 0 else 0.0
+    return record
+
+
+def _write_lines(path: str, records):
+    with open(path, "w") as file:
+        for record in records:
+            file.write(json.dumps(record) + "\n")
+
+
+def write_metrics(path: str, sample_records, run: dict):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    write_atomically(path, _write_lines, list(sample_records) + [run])
+
+
+def log_summary(run: dict):
+    """Log a table of the time spent in every stage of the run."""
+    logger.info(
+        "{:<24} {:>10} {:>10} {:>8}", "Stage", "Wall (s)", "CPU (s)", "Calls"
+    )
+    for name, stage in sorted(
+        run["stages"].items(), key=lambda item: item[1]["wall_s"], reverse=True
+    ):
+        logger.info(
+            "{:<24} {:>10.2f} {:>10.2f} {:>8}",
+            name,
+            stage["wall_s"],
+            stage["cpu_s"],
+            stage["calls"],
+        )
+    logger.info(
+        "{} samples, {} fields ({} missing), {:.1f} MB read, {:.1f} MB written",
+        run["samples"],
+        run["fields"],
+        run["missing_fields"],
+        run["bytes_read"] / (1024 * 1024),
+        run["bytes_written"] / (1024 * 1024),
+    )
+    logger.info(
+        "{:.2f} megapixels/s, peak RSS {} MB",
+        run["megapixels_per_s"],
+        run["peak_rss_mb"] if run["peak_rss_mb"] is not None else "unknown",
+    )
@@ -0,0 +1,160 @@
+# Modal mineralogy tables.
+#
+# The phase histograms gathered while compositing are written out as two CSV tables next
+# to the images, one row per phase with a non zero pixel count: <name>.modal.csv for the
+# whole sample and <name>.field_modal.csv with the same columns per field. Percentages are
+# of the classified pixels, the same as in the legend. Every row also carries the
+# classified, unclassified and skipped (unknown phase ID) pixel counts of its sample or
+# field, and the areas use the full resolution pixel spacing. A sample or field without
+# classified pixels gets a single row without a phase, so that its unclassified and
+# skipped counts still show up.
+
+import csv
+import os
+import numpy as np
+from .atomic import write_atomically
+
+MODAL_COLUMNS = [
+    "sample_name",
+    "field_name",
+    "phase_id",
+    "mineral_name",
+    "pixel_count",
+    "area_um2",
+    "percent",
+    "classified_pixels",
+    "unclassified_pixels",
+    "skipped_pixels",
+]
+
+
+def modal_table_paths(output_root: str, output_name: str):
+    return (
+        os.path.join(output_root, output_name + ".modal.csv"),
+        os.path.join(output_root, output_name + ".field_modal.csv"),
+    )
+
+
+def modal_rows(
+    phase_map: dict,
+    histogram: np.ndarray,
+    unclassified_count: int,
+    skipped_count: int,
+    pixel_spacing_um: float,
+    sample_name: str,
+    field_name: str = "",
+):
+    """Return the table rows for one histogram, most common phase first.
+
+    A histogram without classified pixels gives one row whose phase columns are empty.
+    """
+    classified_count = int(histogram.sum())
+    pixel_area = pixel_spacing_um * pixel_spacing_um
+    if classified_count == 0:
+        return [
+            {
+                "sample_name": sample_name,
+                "field_name": field_name,
+                "phase_id": None,
+                "mineral_name": None,
+                "pixel_count": 0,
+                "area_um2": 0.0,
+                "percent": None,
+                "classified_pixels": 0,
+                "unclassified_pixels": unclassified_count,
+                "skipped_pixels": skipped_count,
+            }
+        ]
+    rows = []
+    for phase_id, phase in phase_map.items():
+        count = int(histogram[phase_id]) if phase_id < len(histogram) else 0
+        if count == 0:
+            continue
+        rows.append(
+            {
+                "sample_name": sample_name,
+                "field_name": field_name,
+                "phase_id": phase_id,
+                "mineral_name": phase["mineral_name"],
+                "pixel_count": count,
+                "area_um2": round(count * pixel_area, 3),
+                "percent": round(count / classified_count * 100, 4),
+                "classified_pixels": classified_count,
+                "unclassified_pixels": unclassified_count,
+                "skipped_pixels": skipped_count,
+            }
+        )
+    rows.sort(key=lambda row: row["pixel_count"], reverse=True)
+    return rows
+
+
+def _write_rows(path: str, rows):
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=MODAL_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_modal_table(path: str, rows):
+    write_atomically(path, _write_rows, rows)
+
+
+def modal_tables(
+    sample_name: str, phase_map: dict, field_stats, pixel_spacing_um: float
+):
+    """Return the rows of the sample and of the per field table.
+
+    field_stats are (field_name, FieldStats) pairs of the fields that were composited.
+    """
+    size = max(phase_map.keys(), default=-1) + 1
+    sample_histogram = np.zeros(size, dtype=np.int64)
+    unclassified_count = 0
+    skipped_count = 0
+    field_rows = []
+    for field_name, stats in field_stats:
+        histogram = stats.histogram[:size]
+        sample_histogram[: len(histogram)] += histogram
+        unclassified_count += stats.unclassified_count
+        skipped_count += stats.unknown_count
+        field_rows.extend(
+            modal_rows(
+                phase_map,
+                histogram,
+                stats.unclassified_count,
+                stats.unknown_count,
+                pixel_spacing_um,
+                sample_name,
+                field_name,
+            )
+        )
+
+    sample_rows = modal_rows(
+        phase_map,
+        sample_histogram,
+        unclassified_count,
+        skipped_count,
+        pixel_spacing_um,
+        sample_name,
+    )
+    return sample_rows, field_rows
+
+
+def write_modal_tables(
+    output_root: str,
+    output_name: str,
+    sample_name: str,
+    phase_map: dict,
+    field_stats,
+    pixel_spacing_um: float,
+):
+    """Write the sample and per field tables from (field_name, FieldStats) pairs.
+
+    Returns the paths of the sample and the field table.
+    """
+    sample_path, field_path = modal_table_paths(output_root, output_name)
+    sample_rows, field_rows = modal_tables(
+        sample_name, phase_map, field_stats, pixel_spacing_um
+    )
+    write_modal_table(sample_path, sample_rows)
+    write_modal_table(field_path, field_rows)
+    return sample_path, field_path
@@ -0,0 +1,180 @@
+# Streaming PNG writer for canvases held in NumPy arrays.
+#
+# PIL needs the complete image in its own memory before it can save it, which doubles the
+# memory use of a mosaic and defeats memory mapped canvases. This writer filters and
+# deflates the array in bands of rows, so only one band is ever held in memory.
+#
+# With more than one thread the bands are deflated in parallel, each into a deflate
+# stream of its own that ends on a byte boundary, and the streams are concatenated the way
+# pigz does it. zlib releases the GIL while it compresses, so the threads run on separate
+# cores. The bands do not share a dictionary, which costs a little compression.
+
+import collections
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+BAND_ROWS = 256
+IDAT_SIZE = 1 << 20
+
+# Filter type "Up" from the PNG spec, each byte is stored as the difference to the byte
+# above it. It is cheap to compute for a whole band and works well on both the flat
+# classification colours and the BSE images.
+FILTER_UP = 2
+
+
+def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+    )
+
+
+def png_format(array: np.ndarray):
+    """Return the (bit depth, colour type) of the PNG used to store array."""
+    if array.ndim == 3 and array.shape[2] == 3 and array.dtype == np.uint8:
+        return 8, 2
+    if array.ndim == 2 and array.dtype == np.uint8:
+        return 8, 0
+    if array.ndim == 2 and array.dtype == np.uint16:
+        return 16, 0
+    raise ValueError(
+        "Unsupported array for PNG output: shape {}, dtype {}".format(
+            array.shape, array.dtype
+        )
+    )
+
+
+def band_bytes(band: np.ndarray) -> np.ndarray:
+    """Return the rows of band as big-endian bytes, one row per line."""
+    if band.dtype == np.uint16:
+        band = band.astype(">u2")
+    return np.ascontiguousarray(band).view(np.uint8).reshape(band.shape[0], -1)
+
+
+def filter_band(raw: np.ndarray, previous_row: np.ndarray) -> bytes:
+    """Apply the Up filter to raw and prefix every row with the filter type byte."""
+    filtered = np.empty((raw.shape[0], raw.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = FILTER_UP
+    filtered[0, 1:] = raw[0] - previous_row
+    filtered[1:, 1:] = raw[1:] - raw[:-1]
+    return filtered.tobytes()
+
+
+def adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    """Adler-32 of two pieces of data from the checksums of the pieces, as zlib does it."""
+    base = 65521
+    remainder = length2 % base
+    sum1 = adler1 & 0xFFFF
+    sum2 = (remainder * sum1) % base
+    sum1 += (adler2 & 0xFFFF) + base - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + base - remainder
+    sum1 %= base
+    sum2 %= base
+    return sum1 | (sum2 << 16)
+
+
+def _deflate(array: np.ndarray, compress_level: int):
+    """Yield the zlib stream of the filtered rows of array, compressed band by band."""
+    compressor = zlib.compressobj(compress_level)
+    previous_row = None
+    for start in range(0, array.shape[0], BAND_ROWS):
+        raw = band_bytes(array[start : start + BAND_ROWS])
+        if previous_row is None:
+            previous_row = np.zeros(raw.shape[1], dtype=np.uint8)
+        yield compressor.compress(filter_band(raw, previous_row))
+        previous_row = raw[-1].copy()
+    yield compressor.flush()
+
+
+def _deflate_band(array: np.ndarray, start: int, compress_level: int):
+    """Filter and deflate the band starting at row start into a raw deflate stream.
+
+    Returns the stream with the Adler-32 and the length of the filtered band.
+    """
+    raw = band_bytes(array[start : start + BAND_ROWS])
+    if start:
+        previous_row = band_bytes(array[start - 1 : start])[0]
+    else:
+        previous_row = np.zeros(raw.shape[1], dtype=np.uint8)
+    filtered = filter_band(raw, previous_row)
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    last = start + BAND_ROWS >= array.shape[0]
+    data = compressor.compress(filtered) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+    return data, zlib.adler32(filtered), len(filtered)
+
+
+def _deflate_parallel(array: np.ndarray, compress_level: int, threads: int):
+    """Yield the zlib stream of array with the bands deflated by threads threads."""
+    # The zlib header of a stream at compress_level.
+    yield zlib.compress(b"", compress_level)[:2]
+    adler = 1
+    with ThreadPoolExecutor(threads) as executor:
+        starts = iter(range(0, array.shape[0], BAND_ROWS))
+        # Only a few bands per thread are in flight, so memory stays bounded.
+        in_flight = collections.deque()
+        for start in starts:
+            in_flight.append(
+                executor.submit(_deflate_band, array, start, compress_level)
+            )
+            if len(in_flight) >= threads * 2:
+                break
+        while in_flight:
+            data, band_adler, length = in_flight.popleft().result()
+            start = next(starts, None)
+            if start is not None:
+                in_flight.append(
+                    executor.submit(_deflate_band, array, start, compress_level)
+                )
+            adler = adler32_combine(adler, band_adler, length)
+            yield data
+    yield struct.pack(">I", adler)
+
+
+def encode_png(file, array: np.ndarray, compress_level: int = 6, threads: int = 1):
+    """Write array as a PNG to the binary file object file, see write_png()."""
+    bit_depth, colour_type = png_format(array)
+    height, width = array.shape[:2]
+
+    file.write(PNG_SIGNATURE)
+    file.write(
+        _chunk(
+            b"IHDR",
+            struct.pack(">IIBBBBB", width, height, bit_depth, colour_type, 0, 0, 0),
+        )
+    )
+
+    if threads > 1 and height > BAND_ROWS:
+        stream = _deflate_parallel(array, compress_level, threads)
+    else:
+        stream = _deflate(array, compress_level)
+    pending = []
+    pending_size = 0
+    for data in stream:
+        if data:
+            pending.append(data)
+            pending_size += len(data)
+        if pending_size >= IDAT_SIZE:
+            file.write(_chunk(b"IDAT", b"".join(pending)))
+            pending = []
+            pending_size = 0
+
+    file.write(_chunk(b"IDAT", b"".join(pending)))
+    file.write(_chunk(b"IEND", b""))
+
+
+def write_png(path: str, array: np.ndarray, compress_level: int = 6, threads: int = 1):
+    """Write array to path as a PNG without holding more than a band of it in memory.
+
+    array may be a (H, W, 3) uint8 RGB image, or a (H, W) uint8 or uint16 grayscale image.
+    np.memmap arrays are read band by band. With threads above 1 the bands are compressed
+    in parallel, a few bands per thread are then held in memory.
+    """
+    with open(path, "wb") as file:
+        encode_png(file, array, compress_level, threads)
@@ -0,0 +1,148 @@
+# Cached index of a TIMA project and its MinDif datasets.
+#
+# Finding the samples of a project and walking every dataset for its XML files takes
+# minutes on network mounted exports with thousands of datasets, and used to be repeated
+# on every run and in every worker. The index keeps what was read in a JSON file: the
+# samples of the project and, per dataset, the directory of the XML files, the phase
+# table, the measurement geometry and the fields with the images each of them has.
+# Entries are reused for as long as the files they were read from and the field
+# directories keep their modification times, so a run only reads the datasets that were
+# exported again, and the existence of the field images costs one stat per field.
+
+import json
+import os
+from .atomic import write_atomically
+
+INDEX_VERSION = 2
+INDEX_FILE = ".tima_index.json"
+
+# Indexes already loaded by this process, by path.
+_loaded_indexes = {}
+
+
+def default_index_path(output_root: str) -> str:
+    return os.path.join(output_root, INDEX_FILE)
+
+
+def _mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _dump_compact(path: str, data):
+    with open(path, "w") as file:
+        json.dump(data, file, separators=(",", ":"))
+
+
+class ProjectIndex:
+    """The index stored at path, empty if there is none yet."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.changed = False
+        self.data = {
+            "version": INDEX_VERSION,
+            "project": None,
+            "mindif_root": None,
+            "datasets": {},
+        }
+        if os.path.exists(path):
+            try:
+                with open(path) as file:
+                    data = json.load(file)
+                if data.get("version") == INDEX_VERSION:
+                    self.data = data
+            except (ValueError, OSError):
+                # A broken index is rebuilt.
+                self.changed = True
+
+    def samples(self, project_path: str, read_samples):
+        """Return the (dataset directory, sample name) pairs of the project.
+
+        read_samples(project_path) is only called when the project files changed since
+        they were indexed, it must return the samples and the paths it read.
+        """
+        project_path = os.path.abspath(project_path)
+        project = self.data["project"]
+        if (
+            project is not None
+            and project["path"] == project_path
+            and all(_mtime(path) == mtime for path, mtime in project["files"].items())
+        ):
+            return [tuple(sample) for sample in project["samples"]]
+
+        samples, files = read_samples(project_path)
+        self.data["project"] = {
+            "path": project_path,
+            "files": {path: _mtime(path) for path in files},
+            "samples": [list(sample) for sample in samples],
+        }
+        self.changed = True
+        return samples
+
+    def stale_datasets(self, mindif_root: str, guids):
+        """Return the guids whose dataset is not indexed or changed since."""
+        mindif_root = os.path.abspath(mindif_root)
+        if self.data["mindif_root"] != mindif_root:
+            self.data["mindif_root"] = mindif_root
+            self.data["datasets"] = {}
+            self.changed = True
+        return [
+            guid
+            for guid in dict.fromkeys(guids)
+            if not self._is_current(self.data["datasets"].get(guid))
+        ]
+
+    @staticmethod
+    def _is_current(dataset) -> bool:
+        return dataset is not None and is_current_dataset(dataset)
+
+    def update(self, datasets):
+        for dataset in datasets:
+            self.data["datasets"][dataset["guid"]] = dataset
+        self.changed = True
+
+    def dataset(self, guid: str):
+        return self.data["datasets"].get(guid)
+
+    def save(self):
+        if not self.changed:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        write_atomically(self.path, _dump_compact, self.data)
+        self.changed = False
+
+
+def is_current_dataset(dataset: dict) -> bool:
+    """Whether the files a dataset record was read from are unchanged."""
+    if not dataset["xml_path"]:
+        return dataset["dir_mtime"] == _mtime(dataset["mindif_path"])
+    if not all(
+        _mtime(os.path.join(dataset["xml_path"], name)) == mtime
+        for name, mtime in dataset["mtimes"].items()
+    ):
+        return False
+    field_root = os.path.join(dataset["xml_path"], dataset["field_dir"] or "")
+    return all(
+        _mtime(os.path.join(field_root, field["name"])) == field["mtime"]
+        for field in dataset["fields"] or ()
+    )
+
+
+def cached_dataset(path: str, guid: str):
+    """Return the indexed dataset guid from the index at path, or None.
+
+    The index is loaded once per process and again only when the file changes.
+    """
+    mtime = _mtime(path)
+    if mtime is None:
+        return None
+    loaded = _loaded_indexes.get(path)
+    if loaded is None or loaded[0] != mtime:
+        loaded = (mtime, ProjectIndex(path))
+        _loaded_indexes[path] = loaded
+    return loaded[1].dataset(guid)
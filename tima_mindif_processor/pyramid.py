@@ -0,0 +1,184 @@
+# Deep Zoom tile pyramids for the classification and BSE mosaics.
+#
+# The pyramid is built while the mosaic is streamed out row by row, in the same way as the
+# tiled TIFF writer. Every level only keeps the two rows of tiles it needs to produce one
+# row of tiles of the level above it, so no level is ever held in memory as a whole. The
+# classification mosaic is reduced with the mode of every 2x2 block (or the top left pixel)
+# so phase colours are never blended, the BSE mosaic is averaged.
+#
+# The layout follows the Deep Zoom format: <name>.dzi describes the image and the tiles are
+# stored as <name>_files/<level>/<column>_<row>.png, level 0 being a single pixel. Both are
+# written under partial names and moved into place by close(), the .dzi last.
+
+import math
+import os
+import numpy as np
+from .atomic import commit_output, discard_output, partial_path
+from .png_writer import write_png
+
+DEFAULT_TILE_SIZE = 256
+RESAMPLING_METHODS = ("mode", "nearest")
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" Overlap="0" Format="png">
+    <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+
+def pyramid_max_level(width: int, height: int) -> int:
+    """Level of the full size image in a Deep Zoom pyramid, level 0 is one pixel."""
+    return int(math.ceil(math.log2(max(width, height, 1))))
+
+
+def pyramid_level_size(width: int, height: int, level: int):
+    """(width, height) of level of the Deep Zoom pyramid of a width x height image."""
+    scale = 2 ** (pyramid_max_level(width, height) - level)
+    return (
+        max(1, int(math.ceil(width / scale))),
+        max(1, int(math.ceil(height / scale))),
+    )
+
+
+def _pad_even(band: np.ndarray) -> np.ndarray:
+    pad_rows = band.shape[0] % 2
+    pad_cols = band.shape[1] % 2
+    if not pad_rows and not pad_cols:
+        return band
+    padding = [(0, pad_rows), (0, pad_cols)] + [(0, 0)] * (band.ndim - 2)
+    return np.pad(band, padding, mode="edge")
+
+
+def reduce_mode(band: np.ndarray) -> np.ndarray:
+    """Halve an RGB band, keeping the most frequent colour of every 2x2 block.
+
+    Ties go to the earliest pixel in the block, in the order top left, top right, bottom
+    left, bottom right.
+    """
+    band = _pad_even(band)
+    packed = (
+        band[..., 0].astype(np.uint32) << 16
+        | band[..., 1].astype(np.uint32) << 8
+        | band[..., 2].astype(np.uint32)
+    )
+    candidates = np.stack(
+        [packed[0::2, 0::2], packed[0::2, 1::2], packed[1::2, 0::2], packed[1::2, 1::2]]
+    )
+    counts = (candidates[:, None] == candidates[None, :]).sum(axis=1)
+    choice = np.take_along_axis(candidates, counts.argmax(axis=0)[None], axis=0)[0]
+    reduced = np.empty(choice.shape + (3,), dtype=np.uint8)
+    reduced[..., 0] = choice >> 16
+    reduced[..., 1] = (choice >> 8) & 0xFF
+    reduced[..., 2] = choice & 0xFF
+    return reduced
+
+
+def reduce_nearest(band: np.ndarray) -> np.ndarray:
+    return np.ascontiguousarray(band[0::2, 0::2])
+
+
+def reduce_mean(band: np.ndarray) -> np.ndarray:
+    band = _pad_even(band)
+    total = (
+        band[0::2, 0::2].astype(np.uint32)
+        + band[0::2, 1::2]
+        + band[1::2, 0::2]
+        + band[1::2, 1::2]
+    )
+    return ((total + 2) // 4).astype(band.dtype)
+
+
+class DeepZoomWriter:
+    """Streams a canvas into a Deep Zoom pyramid at base_path.dzi and base_path_files.
+
+    Like TiledTiffWriter, write_rows_until() may be called with the number of rows at the
+    top of the canvas that are final, and close() finishes the pyramid.
+    """
+
+    def __init__(
+        self,
+        base_path: str,
+        canvas: np.ndarray,
+        categorical: bool = True,
+        resampling: str = "mode",
+        tile_size: int = DEFAULT_TILE_SIZE,
+    ):
+        if resampling not in RESAMPLING_METHODS:
+            raise ValueError("Unknown pyramid resampling {}".format(resampling))
+        self.base_path = base_path
+        self.canvas = canvas
+        self.tile_size = tile_size
+        self.height, self.width = canvas.shape[:2]
+        if not categorical:
+            self.reduce = reduce_mean
+        elif resampling == "mode":
+            self.reduce = reduce_mode
+        else:
+            self.reduce = reduce_nearest
+
+        self.max_level = pyramid_max_level(self.width, self.height)
+        self.partial_base_path = partial_path(base_path)
+        self.tiles_path = self.partial_base_path + "_files"
+        # Rows waiting to be reduced into the next level down, per level.
+        self.pending = {}
+        self.rows_done = {}
+        for level in range(self.max_level + 1):
+            os.makedirs(os.path.join(self.tiles_path, str(level)), exist_ok=True)
+            self.pending[level] = None
+            self.rows_done[level] = 0
+        self.rows_written = 0
+
+    def level_size(self, level: int):
+        return pyramid_level_size(self.width, self.height, level)
+
+    def write_rows_until(self, row: int):
+        row = min(row, self.height)
+        while self.rows_written < self.height and (
+            self.rows_written + self.tile_size <= row or row == self.height
+        ):
+            start = self.rows_written
+            band = np.array(self.canvas[start : start + self.tile_size])
+            self.rows_written += band.shape[0]
+            self._add_rows(self.max_level, band)
+
+    def _add_rows(self, level: int, band: np.ndarray):
+        """Write band as the next row of tiles of level and feed it to the level below."""
+        row = self.rows_done[level] // self.tile_size
+        for col in range(0, band.shape[1], self.tile_size):
+            tile_path = os.path.join(
+                self.tiles_path,
+                str(level),
+                "{}_{}.png".format(col // self.tile_size, row),
+            )
+            write_png(tile_path, np.ascontiguousarray(band[:, col : col + self.tile_size]))
+        self.rows_done[level] += band.shape[0]
+
+        if level == 0:
+            return
+
+        # Two rows of tiles of this level make one row of tiles of the next level down.
+        pending = self.pending[level]
+        pending = band if pending is None else np.concatenate([pending, band])
+        level_height = self.level_size(level)[1]
+        if pending.shape[0] >= 2 * self.tile_size or self.rows_done[level] >= level_height:
+            self.pending[level] = None
+            self._add_rows(level - 1, self.reduce(pending))
+        else:
+            self.pending[level] = pending
+
+    def close(self):
+        self.write_rows_until(self.height)
+        self.canvas = None
+        with open(self.partial_base_path + ".dzi", "w") as file:
+            file.write(
+                DZI_TEMPLATE.format(
+                    tile_size=self.tile_size, width=self.width, height=self.height
+                )
+            )
+        commit_output(self.tiles_path, self.base_path + "_files")
+        commit_output(self.partial_base_path + ".dzi", self.base_path + ".dzi")
+
+    def abort(self):
+        self.canvas = None
+        discard_output(self.tiles_path)
+        discard_output(self.partial_base_path + ".dzi")
@@ -0,0 +1,48 @@
+# Bounded read-ahead of field images.
+#
+# Decoding phases.tif, mask.png and bse.png of a field used to happen between compositing
+# one field and the next, and on network mounted exports the worker spent much of its
+# time waiting for the reads. read_ahead() hands the reads of the next few fields to a
+# thread pool, so they are fetched and decoded while the current field is composited.
+# The number of fields in flight is limited both by a count and by a budget for their
+# decoded images.
+
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def timed_read(read, item):
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    result = read(item)
+    return result, time.perf_counter() - wall, time.thread_time() - cpu
+
+
+def read_ahead(read, items, depth: int, item_bytes: int = 0, byte_budget: int = None):
+    """Yield (item, read(item), wall seconds, CPU seconds) for items, in order.
+
+    Up to depth items are read by threads ahead of the one being consumed, fewer if
+    their item_bytes each would exceed byte_budget, but always at least one. The times
+    are those of the read itself, in its thread.
+    """
+    if byte_budget is not None and item_bytes > 0:
+        depth = min(depth, byte_budget // item_bytes)
+    depth = max(1, depth)
+
+    items = iter(items)
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(depth) as executor:
+        for item in items:
+            in_flight.append((item, executor.submit(timed_read, read, item)))
+            if len(in_flight) >= depth:
+                break
+        while in_flight:
+            item, future = in_flight.popleft()
+            result, wall, cpu = future.result()
+            for next_item in items:
+                in_flight.append(
+                    (next_item, executor.submit(timed_read, read, next_item))
+                )
+                break
+            yield item, result, wall, cpu
@@ -0,0 +1,124 @@
+# Regions of interest of a sample.
+#
+# Looking at one inclusion used to mean compositing the whole sample and cutting the
+# mosaic afterwards. A region of interest is given as its centre and size, either in µm
+# in the stage coordinates of fields.xml (relative to the sample centre, +x to the left
+# like TIMA) or in pixels of the sample canvas. roi_box() turns it into a box of the
+# canvas, FieldIndex, a grid over the field rectangles, finds the fields that intersect
+# it, and roi_info() gives the sample info of a canvas the size of the box that holds
+# only those fields. Everything built on the sample info, compositing, the statistics
+# and the manifests, then works on the region alone and reads just its fields.
+
+import math
+
+ROI_UNITS = ("um", "px")
+
+
+class FieldIndex:
+    """Grid index of the canvas rectangles of fields, (field_name, x, y) tuples.
+
+    image_size is the (width, height) of the fields. The grid cells are cell_size
+    pixels, the size of a field by default.
+    """
+
+    def __init__(self, fields, image_size, cell_size: int = None):
+        self.fields = list(fields)
+        self.image_size = image_size
+        self.cell_size = max(1, int(cell_size or max(image_size)))
+        self.cells = {}
+        width, height = image_size
+        for order, (_, x, y) in enumerate(self.fields):
+            for cell in self._cells((x, y, x + width, y + height)):
+                self.cells.setdefault(cell, []).append(order)
+
+    def _cells(self, box):
+        left, top, right, bottom = box
+        size = self.cell_size
+        for row in range(top // size, (bottom - 1) // size + 1):
+            for column in range(left // size, (right - 1) // size + 1):
+                yield column, row
+
+    def query(self, box):
+        """The fields intersecting a (left, top, right, bottom) box, in their order."""
+        left, top, right, bottom = box
+        width, height = self.image_size
+        found = set()
+        for cell in self._cells(box):
+            for order in self.cells.get(cell, ()):
+                _, x, y = self.fields[order]
+                if x < right and left < x + width and y < bottom and top < y + height:
+                    found.add(order)
+        return [self.fields[order] for order in sorted(found)]
+
+
+def field_index(info: dict) -> FieldIndex:
+    """FieldIndex of the fields of a sample."""
+    return FieldIndex(info["fields"], (info["image_width_px"], info["image_height_px"]))
+
+
+def roi_box(info: dict, roi, units: str = "um"):
+    """The (left, top, right, bottom) canvas box of roi, (x, y, width, height).
+
+    x and y are the centre of the region. The box is clipped to the canvas of the
+    sample, a ValueError is raised if nothing of it is left.
+    """
+    if units not in ROI_UNITS:
+        raise ValueError(
+            "Unknown region units {}, use one of {}".format(units, ROI_UNITS)
+        )
+    x, y, width, height = roi
+    if width <= 0 or height <= 0:
+        raise ValueError("The region {} has no area".format(roi))
+    canvas_width, canvas_height = info["field_size"]
+    if units == "um":
+        spacing = info["pixel_spacing"]
+        x = -x / spacing + canvas_width / 2
+        y = y / spacing + canvas_height / 2
+        width /= spacing
+        height /= spacing
+    left = max(0, math.floor(x - width / 2))
+    top = max(0, math.floor(y - height / 2))
+    right = min(canvas_width, math.ceil(x + width / 2))
+    bottom = min(canvas_height, math.ceil(y + height / 2))
+    if right <= left or bottom <= top:
+        raise ValueError(
+            "The region {} {} lies outside of {}".format(
+                roi, units, info["sample_name"]
+            )
+        )
+    return left, top, right, bottom
+
+
+def roi_info(info: dict, box, index: FieldIndex = None) -> dict:
+    """The sample info of the canvas box of the sample of info.
+
+    The fields are those intersecting box, moved to the canvas of the box. index is a
+    FieldIndex of the fields of info, built here if not given.
+    """
+    if "roi" in info:
+        raise ValueError(
+            "{} is a region of its sample already".format(info["sample_name"])
+        )
+    if index is None:
+        index = field_index(info)
+    left, top, right, bottom = box
+    cropped = dict(info)
+    cropped["fields"] = [
+        (field_name, x - left, y - top) for field_name, x, y in index.query(box)
+    ]
+    cropped["field_size"] = (right - left, bottom - top)
+    cropped["roi"] = tuple(box)
+    return cropped
+
+
+def roi_name(sample_name: str, roi, units: str) -> str:
+    """Output name of a region of a sample."""
+    return "{}_roi_{:g}_{:g}_{:g}x{:g}{}".format(sample_name, *roi, units)
+
+
+def parse_roi(text: str):
+    """Parse an X,Y,WIDTH,HEIGHT command line region."""
+    values = [float(value) for value in text.split(",")]
+    if len(values) != 4:
+        raise ValueError("A region is X,Y,WIDTH,HEIGHT, got {}".format(text))
+    return tuple(values)
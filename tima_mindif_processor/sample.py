@@ -0,0 +1,383 @@
+# In-memory access to a composited MinDif sample.
+#
+# create_sample writes everything it composites to files, so notebooks and services that
+# only want the arrays had to write gigabytes and read them back. A Sample holds the
+# metadata of one MinDif dataset and composites its fields on first use into plain
+# NumPy arrays: the classification label array, the RGB mosaic and the BSE mosaic, with
+# the phase table, the histogram and the modal mineralogy derived from them. Everything
+# is computed once and cached on the object, writing files is an optional step on top.
+#
+#   sample = Sample.load(mindif_root, guid, "STA-107B")
+#   sample.labels            # phase ID per pixel, label_nodata outside the fields
+#   sample.modal             # one row per phase, most common first
+#   sample.write("output")
+#   inclusion = sample.roi(-1250, 830, 400, 300)   # only the fields under 400 x 300 µm
+#
+# create_sample composites through Sample.composite() as well, onto its own canvases.
+
+import math
+import os
+import numpy as np
+from .bse import bse_dtype, bse_nodata, normalise_bse
+from .compositing import MAX_UNKNOWN_PHASE_PIXELS
+from .id_array import id_array_dtype, write_id_array
+from .modal import modal_tables, write_modal_tables
+from .png_writer import write_png
+from .roi import field_index, roi_box, roi_info
+from .tima_mindif_processor import (
+    DEFAULT_READ_AHEAD,
+    DEFAULT_READ_AHEAD_MB,
+    SampleError,
+    composite_fields,
+    composite_fields_in_pool,
+    read_sample_info,
+    set_xml_namespace,
+)
+
+WHITE = (255, 255, 255)
+
+
+class Sample:
+    """One MinDif dataset, composited lazily into arrays.
+
+    info is the dict of read_sample_info. With a scale above 1 the arrays are a preview
+    reduced by that factor, the statistics stay those of the full resolution fields.
+    Without bse the BSE mosaic is not composited and bse is None, with bse_normalise the
+    levels of its fields are brought into line.
+    """
+
+    def __init__(
+        self,
+        info: dict,
+        exclude_unclassified: bool = True,
+        scale: int = 1,
+        bse: bool = True,
+        read_ahead: int = DEFAULT_READ_AHEAD,
+        read_ahead_mb: float = DEFAULT_READ_AHEAD_MB,
+        bse_normalise: bool = False,
+    ):
+        if scale < 1:
+            raise ValueError(
+                "The preview scale must be at least 1, got {}".format(scale)
+            )
+        self.info = info
+        self.exclude_unclassified = exclude_unclassified
+        self.scale = scale
+        self.generate_bse = bse
+        self.read_ahead = read_ahead
+        self.read_ahead_mb = read_ahead_mb
+        self.bse_normalise = bse_normalise
+        self._bse_dtype = None
+        self._field_index = None
+        self._canvases = None
+        self._field_stats = None
+
+    @classmethod
+    def load(
+        cls,
+        mindif_root: str,
+        guid: str,
+        sample_name: str = None,
+        exclude_unclassified: bool = True,
+        **options
+    ):
+        """Read the metadata of the dataset guid below mindif_root.
+
+        The options are those of Sample(). Raises FileNotFoundError if the dataset has
+        no phases.xml.
+        """
+        set_xml_namespace()
+        info = read_sample_info(
+            mindif_root, guid, sample_name or guid, exclude_unclassified
+        )
+        if info is None:
+            raise FileNotFoundError(
+                "No phases.xml in {}".format(os.path.join(mindif_root, guid))
+            )
+        return cls(info, exclude_unclassified, **options)
+
+    @property
+    def name(self) -> str:
+        return self.info["sample_name"]
+
+    @property
+    def guid(self) -> str:
+        return self.info["guid"]
+
+    @property
+    def fields(self):
+        """(field_name, x, y) of every field, at full resolution."""
+        return self.info["fields"]
+
+    @property
+    def mosaic_size(self):
+        """(width, height) of the mosaic in pixels, at the scale of the sample."""
+        width, height = self.info["field_size"]
+        return int(math.ceil(width / self.scale)), int(math.ceil(height / self.scale))
+
+    @property
+    def offset(self):
+        """(x, y) of the mosaic on the canvas of the whole sample, in full pixels."""
+        left, top = self.info.get("roi", (0, 0))[:2]
+        return left, top
+
+    @property
+    def pixel_spacing(self) -> float:
+        """Size of a mosaic pixel in µm."""
+        return self.info["pixel_spacing"] * self.scale
+
+    @property
+    def label_dtype(self) -> np.dtype:
+        return id_array_dtype(self.info["max_phase_id"])[0]
+
+    @property
+    def label_nodata(self) -> int:
+        """Label of the pixels outside the fields, their masks or the shown phases."""
+        return id_array_dtype(self.info["max_phase_id"])[1]
+
+    @property
+    def bse_dtype(self) -> np.dtype:
+        """uint8 for samples with 8-bit BSE images, uint16 otherwise."""
+        if self._bse_dtype is None:
+            self._bse_dtype = bse_dtype(self.info)
+        return self._bse_dtype
+
+    @property
+    def bse_nodata(self) -> int:
+        """Value of the BSE mosaic outside the fields."""
+        return bse_nodata(self.bse_dtype)
+
+    @property
+    def phase_table(self):
+        """The shown phases as dicts with their id, mineral name, colour and mass."""
+        return [
+            {
+                "id": phase_id,
+                "mineral_name": phase["mineral_name"],
+                "colour": phase["colour"],
+                "colour_hex": phase["colour_hex"],
+                "mass": phase["mass"],
+            }
+            for phase_id, phase in sorted(self.info["phase_map"].items())
+        ]
+
+    def roi(self, x: float, y: float, width: float, height: float, units="um"):
+        """The region of the sample centred on x, y, as a Sample of its own.
+
+        With units "um" the region is given in the stage coordinates of fields.xml, in
+        µm from the centre of the sample with +x to the left, with "px" in pixels of the
+        full resolution canvas. Only the fields that intersect the region are composited
+        and counted in its statistics. Raises ValueError if the region lies outside the
+        sample, or if this is a region already.
+        """
+        box = roi_box(self.info, (x, y, width, height), units)
+        if self._field_index is None:
+            self._field_index = field_index(self.info)
+        return Sample(
+            roi_info(self.info, box, self._field_index),
+            self.exclude_unclassified,
+            self.scale,
+            self.generate_bse,
+            self.read_ahead,
+            self.read_ahead_mb,
+            self.bse_normalise,
+        )
+
+    def composite(
+        self,
+        canvases: dict,
+        fields=None,
+        metrics=None,
+        field_pool=None,
+        field_processes: int = 1,
+        store=None,
+    ):
+        """Composite fields, all of them by default, onto canvases.
+
+        Yields (field_name, FieldStats) per field, None for fields with missing images.
+        canvases maps "classification", "bse" and "id_array" to arrays of the mosaic
+        size, the last two may be None. With a field_pool the fields are composited by
+        its workers, the canvases then have to come from the shared store. The BSE
+        canvas has the bse_dtype, normalise() it once all the fields are composited.
+        """
+        fields = self.fields if fields is None else fields
+        if field_pool is None:
+            return composite_fields(
+                self.info,
+                fields,
+                canvases,
+                self.exclude_unclassified,
+                self.generate_bse,
+                self.scale,
+                metrics,
+                self.read_ahead,
+                self.read_ahead_mb,
+                self.bse_normalise,
+            )
+        return composite_fields_in_pool(
+            field_pool,
+            field_processes,
+            self.info,
+            fields,
+            store,
+            canvases,
+            self.exclude_unclassified,
+            self.generate_bse,
+            self.scale,
+            metrics,
+            self.read_ahead,
+            self.read_ahead_mb,
+            self.bse_normalise,
+        )
+
+    def normalise(self, bse_canvas: np.ndarray, field_stats):
+        """Normalise the levels of the fields on bse_canvas, if bse_normalise is set.
+
+        field_stats are the FieldStats yielded by composite() for all the fields.
+        """
+        if self.bse_normalise and bse_canvas is not None:
+            normalise_bse(bse_canvas, field_stats)
+
+    def new_canvases(self) -> dict:
+        """Empty in-memory canvases for composite()."""
+        width, height = self.mosaic_size
+        return {
+            "classification": np.full((height, width, 3), WHITE, dtype=np.uint8),
+            "bse": np.full((height, width), self.bse_nodata, dtype=self.bse_dtype)
+            if self.generate_bse
+            else None,
+            "id_array": np.full(
+                (height, width), self.label_nodata, dtype=self.label_dtype
+            ),
+        }
+
+    def _composited(self) -> dict:
+        if self._canvases is None:
+            canvases = self.new_canvases()
+            field_stats = []
+            for field_name, stats in self.composite(canvases):
+                if stats is not None and stats.unknown_count > MAX_UNKNOWN_PHASE_PIXELS:
+                    raise SampleError(
+                        "Field {} of {} has {} pixels of phases missing from {}".format(
+                            field_name,
+                            self.name,
+                            stats.unknown_count,
+                            self.info["phases_xml_path"],
+                        )
+                    )
+                field_stats.append((field_name, stats))
+            self.normalise(canvases["bse"], [stats for _, stats in field_stats])
+            self._canvases = canvases
+            self._field_stats = field_stats
+        return self._canvases
+
+    @property
+    def rgb(self) -> np.ndarray:
+        """The (H, W, 3) uint8 classification mosaic, white outside the fields."""
+        return self._composited()["classification"]
+
+    @property
+    def labels(self) -> np.ndarray:
+        """The (H, W) phase ID of every mosaic pixel."""
+        return self._composited()["id_array"]
+
+    @property
+    def bse(self) -> np.ndarray:
+        """The (H, W) BSE mosaic, bse_nodata outside the fields, or None."""
+        return self._composited()["bse"]
+
+    @property
+    def field_stats(self):
+        """(field_name, FieldStats) of every field, None for missing images."""
+        self._composited()
+        return self._field_stats
+
+    @property
+    def missing_fields(self):
+        return [name for name, stats in self.field_stats if stats is None]
+
+    @property
+    def histogram(self) -> np.ndarray:
+        """Full resolution pixel count of every shown phase, indexed by phase ID."""
+        histogram = np.zeros(self.info["max_phase_id"] + 1, dtype=np.int64)
+        for _, stats in self.field_stats:
+            if stats is not None:
+                histogram[: len(stats.histogram)] += stats.histogram
+        return histogram
+
+    def _modal_tables(self):
+        return modal_tables(
+            self.name,
+            self.info["phase_map"],
+            [(name, stats) for name, stats in self.field_stats if stats is not None],
+            self.info["pixel_spacing"],
+        )
+
+    @property
+    def modal(self):
+        """Rows of the modal mineralogy of the sample, most common phase first."""
+        return self._modal_tables()[0]
+
+    @property
+    def field_modal(self):
+        """Rows of the modal mineralogy of every field."""
+        return self._modal_tables()[1]
+
+    def write(
+        self,
+        output_root: str,
+        output_name: str = None,
+        id_array_format: str = None,
+        modal: bool = False,
+        compress_level: int = 6,
+        threads: int = 1,
+    ):
+        """Write the mosaics, optionally the ID array and modal tables, to output_root.
+
+        The classification mosaic is written without a legend to <output_name>.png, the
+        BSE mosaic to <output_name>_bse.png. output_name defaults to the sample name.
+        Returns the paths written.
+        """
+        output_name = output_name or self.name
+        os.makedirs(output_root, exist_ok=True)
+        paths = [os.path.join(output_root, output_name + ".png")]
+        write_png(paths[0], self.rgb, compress_level, threads)
+        if self.bse is not None:
+            paths.append(os.path.join(output_root, output_name + "_bse.png"))
+            write_png(paths[-1], self.bse, compress_level, threads)
+        if id_array_format is not None:
+            paths.append(
+                write_id_array(
+                    output_root,
+                    output_name,
+                    self.labels,
+                    self.label_nodata,
+                    id_array_format,
+                    {
+                        "sample_name": self.name,
+                        "guid": self.guid,
+                        "pixel_spacing_um": self.pixel_spacing,
+                        "scale": self.scale,
+                        "phases": {
+                            str(phase["id"]): phase["mineral_name"]
+                            for phase in self.phase_table
+                        },
+                    },
+                )
+            )
+        if modal:
+            paths.extend(
+                write_modal_tables(
+                    output_root,
+                    output_name,
+                    self.name,
+                    self.info["phase_map"],
+                    [
+                        (name, stats)
+                        for name, stats in self.field_stats
+                        if stats is not None
+                    ],
+                    self.info["pixel_spacing"],
+                )
+            )
+        return paths
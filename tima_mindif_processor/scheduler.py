@@ -0,0 +1,125 @@
+# Largest-first scheduling of samples on the worker pool under a memory budget.
+#
+# pool.map handed the samples out in project order, without knowing their size. A project
+# that mixes small and large mounts either ran out of memory when several large samples
+# landed on the workers together, or finished with one large sample running long after
+# every other worker went idle. The driver now estimates the cost and the peak memory of
+# every sample from its measurement geometry and field count, orders the samples largest
+# first and feeds them to pool.imap_unordered through a MemoryGate. The gate hands out
+# the next sample only when a worker is free and the estimated memory of the running
+# samples leaves room for it, smaller samples are let past a large one that does not fit
+# yet.
+
+import os
+import threading
+from loguru import logger
+
+# Share of the physical memory the workers may use together when no budget is given.
+DEFAULT_MEMORY_SHARE = 0.8
+
+
+def physical_memory_mb():
+    """Physical memory of the machine in MB, None where it is not known."""
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_pool_memory_mb():
+    memory = physical_memory_mb()
+    return memory * DEFAULT_MEMORY_SHARE if memory is not None else None
+
+
+def largest_first(samples, estimates):
+    """Return the samples ordered by the cost of their estimates, largest first.
+
+    Samples of equal cost keep their order.
+    """
+    return [
+        sample
+        for _, sample in sorted(
+            zip(estimates, samples), key=lambda pair: pair[0]["cost"], reverse=True
+        )
+    ]
+
+
+class MemoryGate:
+    """Admits samples to the pool while they fit into the memory budget.
+
+    At most slots samples run at once, and the estimated memory of the running samples
+    stays within budget_mb unless a single sample needs more, which then runs alone.
+    A budget_mb of None only limits the number of running samples.
+    """
+
+    def __init__(self, budget_mb: float, slots: int):
+        self.budget_mb = budget_mb
+        self.slots = slots
+        self.condition = threading.Condition()
+        # (key, estimated MB) of the samples handed out and not released yet.
+        self.running = []
+        self.closed = False
+
+    def _in_use_mb(self) -> float:
+        return sum(memory for _, memory in self.running)
+
+    def _next(self, pending):
+        """Index of the first pending sample that may start now, or None."""
+        if len(self.running) >= self.slots:
+            return None
+        if not self.running:
+            return 0
+        in_use = self._in_use_mb()
+        for index, (_, _, memory) in enumerate(pending):
+            if self.budget_mb is None or in_use + memory <= self.budget_mb:
+                return index
+        return None
+
+    def admit(self, samples):
+        """Yield the items of samples, (key, item, estimated MB), as they are admitted.
+
+        The second item of a key is the sample name, for the log. Blocks until the next
+        item may start, so it is meant to be consumed by the task thread of a pool.
+        Every admitted key has to be handed to release() once its sample finished.
+        """
+        pending = list(samples)
+        while pending:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        return
+                    index = self._next(pending)
+                    if index is not None:
+                        break
+                    self.condition.wait()
+                key, item, memory = pending.pop(index)
+                if self.budget_mb is not None and memory > self.budget_mb:
+                    logger.warning(
+                        "Sample: {} is estimated to need {:.0f} MB, more than the pool "
+                        + "memory budget of {:.0f} MB, it runs on its own",
+                        key[1],
+                        memory,
+                        self.budget_mb,
+                    )
+                self.running.append((key, memory))
+                logger.debug(
+                    "Sample: {} admitted, estimated {:.0f} MB, {:.0f} MB in use",
+                    key[1],
+                    memory,
+                    self._in_use_mb(),
+                )
+            yield item
+
+    def release(self, key):
+        with self.condition:
+            for index, (running_key, _) in enumerate(self.running):
+                if running_key == key:
+                    del self.running[index]
+                    break
+            self.condition.notify_all()
+
+    def close(self):
+        """Stop admitting samples, admit() then returns."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
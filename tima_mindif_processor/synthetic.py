@@ -0,0 +1,311 @@
+# Synthetic TIMA exports for tests and benchmarks.
+#
+# generate_project() writes a TIMA 1.6+ project (.timaproj.data and .timaproj.struct)
+# and its MinDif root, with phases.xml, measurement.xml, fields.xml and phases.tif,
+# mask.png and bse.png for every field, at whatever size is needed. The fields are laid
+# out edge to edge on a square grid around the centre of the sample. Phases form blocky
+# grains, a few pixels of every field are left unclassified and the mask cuts the
+# corners of the grid off a circular sample. Everything is derived from the seed, so the same
+# arguments always give the same export.
+#
+# python -m tima_mindif_processor.synthetic OUTPUT --fields 100 --field-size 512
+
+import argparse
+import colorsys
+import math
+import os
+import uuid
+import numpy as np
+from PIL import Image
+
+XML_NAMESPACE = "http://www.tescan.cz/tima/1_4"
+ORIGIN = "Synthetic TIMA export"
+SAMPLE_SHAPES = ("circle", "rectangle")
+# Grains are squares of this many pixels.
+GRAIN_SIZE = 8
+# Share of the pixels of a field that are unclassified.
+UNCLASSIFIED_SHARE = 0.02
+
+PHASE_ELEMENT = '        <PrimaryPhase id="{}" name="{}" color="{}" mass="0"/>\n'
+REPLICATE_ELEMENT = '            <Replicate guid="{{{}}}" blockName="{}" caption="{}"/>\n'
+
+
+def phase_table(phase_count: int):
+    """Return the (id, name, colour) of [Unclassified] and phase_count phases."""
+    phases = [(0, "[Unclassified]", "#000000")]
+    for index in range(phase_count):
+        red, green, blue = colorsys.hsv_to_rgb(index / max(1, phase_count), 0.8, 0.9)
+        colour = "#{:02x}{:02x}{:02x}".format(
+            int(red * 255), int(green * 255), int(blue * 255)
+        )
+        phases.append((index + 1, "Phase_{:03d}".format(index + 1), colour))
+    return phases
+
+
+def field_grid(field_count: int):
+    """Return the (name, column, row) of field_count fields on a square grid."""
+    columns = int(math.ceil(math.sqrt(field_count)))
+    fields = []
+    for index in range(field_count):
+        row, column = divmod(index, columns)
+        # Field names are a row letter and a column number, like TIMA's.
+        name = "{}{:02d}".format(_row_name(row), column + 1)
+        fields.append((name, column, row))
+    return fields, columns, int(math.ceil(field_count / float(columns)))
+
+
+def _row_name(row: int) -> str:
+    name = ""
+    row += 1
+    while row:
+        row, remainder = divmod(row - 1, 26)
+        name = chr(ord("A") + remainder) + name
+    return name
+
+
+def _write_xml(path: str, text: str):
+    with open(path, "w", encoding="utf-8") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        file.write(text)
+
+
+def field_images(rng, field_size: int, phase_ids, inside=None):
+    """Generate the phases, mask and bse arrays of one field."""
+    grains = int(math.ceil(field_size / float(GRAIN_SIZE)))
+    grain_phases = rng.choice(phase_ids, size=(grains, grains))
+    phases = np.repeat(np.repeat(grain_phases, GRAIN_SIZE, 0), GRAIN_SIZE, 1)
+    phases = phases[:field_size, :field_size].astype(np.int32)
+    phases[rng.random((field_size, field_size)) < UNCLASSIFIED_SHARE] = 0
+
+    mask = np.full((field_size, field_size), 255, dtype=np.uint8)
+    if inside is not None:
+        mask[~inside] = 0
+
+    bse = (phases.astype(np.uint32) * 397 + rng.integers(0, 2000, phases.shape)) % 65536
+    return phases, mask, bse.astype(np.uint16)
+
+
+def generate_sample(
+    mindif_root: str,
+    guid: str,
+    field_count: int,
+    field_size: int,
+    phase_count: int,
+    shape: str,
+    pixel_spacing_um: float,
+    rng,
+    tiff_compression: str,
+):
+    """Write the MinDif dataset of one sample below mindif_root/guid."""
+    dataset_path = os.path.join(mindif_root, guid)
+    os.makedirs(os.path.join(dataset_path, "fields"), exist_ok=True)
+
+    phases = phase_table(phase_count)
+    _write_xml(
+        os.path.join(dataset_path, "phases.xml"),
+        '<ExportedMeasurementPhases Revision="1" xmlns="{}">\n'
+        "    <Origin>{}</Origin>\n"
+        "    <PrimaryPhases>\n{}"
+        "    </PrimaryPhases>\n"
+        "</ExportedMeasurementPhases>\n".format(
+            XML_NAMESPACE,
+            ORIGIN,
+            "".join(PHASE_ELEMENT.format(*phase) for phase in phases),
+        ),
+    )
+
+    fields, columns, rows = field_grid(field_count)
+    view_field_um = int(round(field_size * pixel_spacing_um))
+    if shape == "circle":
+        diameter_um = max(columns, rows) * view_field_um
+        sample_def = (
+            "        <SampleShape>Circle</SampleShape>\n"
+            "        <SampleDiameter>{}</SampleDiameter>\n".format(diameter_um)
+        )
+    elif shape == "rectangle":
+        sample_def = (
+            "        <SampleShape>Rectangle</SampleShape>\n"
+            "        <SampleWidth>{}</SampleWidth>\n"
+            "        <SampleHeight>{}</SampleHeight>\n".format(
+                columns * view_field_um, rows * view_field_um
+            )
+        )
+    else:
+        raise ValueError("Unknown sample shape {}".format(shape))
+
+    _write_xml(
+        os.path.join(dataset_path, "measurement.xml"),
+        '<ExportedMeasurementData Revision="1" xmlns="{}">\n'
+        "    <Id>{{{}}}</Id>\n"
+        "    <Origin>{}</Origin>\n"
+        "    <ViewField>{}</ViewField>\n"
+        "    <ImageWidth>{}</ImageWidth>\n"
+        "    <ImageHeight>{}</ImageHeight>\n"
+        "    <SampleDef>\n{}    </SampleDef>\n"
+        "</ExportedMeasurementData>\n".format(
+            XML_NAMESPACE,
+            guid,
+            ORIGIN,
+            view_field_um,
+            field_size,
+            field_size,
+            sample_def,
+        ),
+    )
+
+    # Field positions are the offsets of the field centres from the sample centre in
+    # micrometres, TIMA's +x points left.
+    field_nodes = []
+    for name, column, row in fields:
+        x = -(column - (columns - 1) / 2.0) * view_field_um
+        y = (row - (rows - 1) / 2.0) * view_field_um
+        field_nodes.append((name, x, y))
+    _write_xml(
+        os.path.join(dataset_path, "fields.xml"),
+        '<ExportedMeasurementFields Revision="1" xmlns="{}">\n'
+        "    <Origin>{}</Origin>\n"
+        "    <FieldDir>fields</FieldDir>\n"
+        "    <Fields>\n{}"
+        "    </Fields>\n"
+        "</ExportedMeasurementFields>\n".format(
+            XML_NAMESPACE,
+            ORIGIN,
+            "".join(
+                '        <Field name="{}" x="{:g}" y="{:g}"/>\n'.format(*node)
+                for node in field_nodes
+            ),
+        ),
+    )
+
+    phase_ids = [phase[0] for phase in phases[1:]]
+    pixel_offsets = np.arange(field_size) - field_size / 2.0 + 0.5
+    for name, x, y in field_nodes:
+        inside = None
+        if shape == "circle":
+            # Distance of every pixel from the sample centre, in pixels.
+            px = pixel_offsets[None, :] - x / pixel_spacing_um
+            py = pixel_offsets[:, None] + y / pixel_spacing_um
+            radius = max(columns, rows) * field_size / 2.0
+            inside = px * px + py * py <= radius * radius
+        field_phases, mask, bse = field_images(rng, field_size, phase_ids, inside)
+
+        field_path = os.path.join(dataset_path, "fields", name)
+        os.makedirs(field_path, exist_ok=True)
+        Image.fromarray(field_phases, "I").save(
+            os.path.join(field_path, "phases.tif"), compression=tiff_compression
+        )
+        Image.fromarray(mask, "L").save(os.path.join(field_path, "mask.png"))
+        Image.fromarray(bse).save(os.path.join(field_path, "bse.png"))
+
+    return dataset_path
+
+
+def generate_project(
+    output_root: str,
+    project_name: str = "Synthetic",
+    sample_count: int = 1,
+    field_count: int = 16,
+    field_size: int = 256,
+    phase_count: int = 20,
+    shape: str = "circle",
+    pixel_spacing_um: float = 1.0,
+    seed: int = 0,
+    tiff_compression: str = "tiff_lzw",
+):
+    """Write a synthetic TIMA 1.6+ project with sample_count samples.
+
+    Returns the project path, the MinDif root and the (dataset directory, sample name)
+    pairs of the samples.
+    """
+    rng = np.random.default_rng(seed)
+    project_path = os.path.join(output_root, project_name)
+    mindif_root = os.path.join(output_root, project_name + "_MinDif")
+    os.makedirs(project_path, exist_ok=True)
+    os.makedirs(mindif_root, exist_ok=True)
+
+    samples = []
+    datasets = []
+    replicates = []
+    for index in range(sample_count):
+        guid = str(uuid.UUID(bytes=rng.bytes(16), version=4))
+        replicate_guid = str(uuid.UUID(bytes=rng.bytes(16), version=4))
+        sample_name = "{}-{:03d}".format(project_name, index + 1)
+        generate_sample(
+            mindif_root,
+            guid,
+            field_count,
+            field_size,
+            phase_count,
+            shape,
+            pixel_spacing_um,
+            rng,
+            tiff_compression,
+        )
+        samples.append((guid, sample_name))
+        datasets.append(
+            "    <DataSet>\n"
+            "        <DirName>{0}</DirName>\n"
+            "        <GUID>{{{0}}}</GUID>\n"
+            "        <Parent>{{{1}}}</Parent>\n"
+            "        <AnalysisType>Modal analysis</AnalysisType>\n"
+            "    </DataSet>\n".format(guid, replicate_guid)
+        )
+        replicates.append(
+            REPLICATE_ELEMENT.format(replicate_guid, sample_name, sample_name)
+        )
+
+    _write_xml(
+        os.path.join(project_path, project_name + ".timaproj.data"),
+        '<ProjectData revision="1">\n'
+        "    <Origin>{}</Origin>\n{}"
+        "</ProjectData>\n".format(ORIGIN, "".join(datasets)),
+    )
+    _write_xml(
+        os.path.join(project_path, project_name + ".timaproj.struct"),
+        '<ProjectStructure revision="2">\n'
+        '    <SurveyGroup caption="Surveys">\n'
+        '        <Survey caption="Survey">\n{}'
+        "        </Survey>\n"
+        "    </SurveyGroup>\n"
+        "</ProjectStructure>\n".format("".join(replicates)),
+    )
+    return project_path, mindif_root, samples
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic TIMA export")
+    parser.add_argument("output", help="Folder to write the project into")
+    parser.add_argument("--name", default="Synthetic", help="Project name")
+    parser.add_argument("--samples", type=int, default=1, help="Number of samples")
+    parser.add_argument("--fields", type=int, default=16, help="Fields per sample")
+    parser.add_argument(
+        "--field-size",
+        type=int,
+        default=256,
+        help="Width and height of a field in pixels",
+    )
+    parser.add_argument("--phases", type=int, default=20, help="Number of phases")
+    parser.add_argument("--shape", choices=SAMPLE_SHAPES, default="circle")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--tiff-compression",
+        default="tiff_lzw",
+        help="PIL compression of phases.tif, raw writes uncompressed fields",
+    )
+    args = parser.parse_args(args)
+    project_path, mindif_root, samples = generate_project(
+        args.output,
+        args.name,
+        args.samples,
+        args.fields,
+        args.field_size,
+        args.phases,
+        args.shape,
+        seed=args.seed,
+        tiff_compression=args.tiff_compression,
+    )
+    print("Project: {}\nMinDif root: {}".format(project_path, mindif_root))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# Zero-copy reading of uncompressed field TIFFs.
+#
+# TIMA often writes phases.tif uncompressed, the pixels are then rows of plain integers
+# at an offset in the file, yet every field went through PIL, which decodes them into an
+# image of its own that np.asarray() copies once more. decode_image() reads the first
+# IFD of a TIFF itself and, if the pixels are uncompressed single channel integers in
+# strips that follow each other, returns an np.frombuffer() view of the file contents:
+# no decoding and no copy. Anything else, compressed or tiled TIFFs, PNGs, goes through
+# PIL as before.
+#
+# The view is read-only and keeps the bytes of the file alive. The file is still read
+# whole by read_field_images(), in one sequential read in the read-ahead threads, rather
+# than memory mapped, which would move the reads into the compositing thread.
+
+import io
+import struct
+import numpy as np
+from PIL import Image
+
+# struct formats of the TIFF field types used by the tags read here.
+TIFF_TYPES = {1: "B", 3: "H", 4: "I", 16: "Q"}
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PREDICTOR = 317
+TILE_WIDTH = 322
+SAMPLE_FORMAT = 339
+# SampleFormat values and the matching NumPy kinds.
+SAMPLE_KINDS = {1: "u", 2: "i"}
+
+
+def read_first_ifd(data: bytes):
+    """Return the byte order and the {tag: values} of the first IFD of a TIFF.
+
+    Only tags of integer types are kept. Returns None if data is not a TIFF or BigTIFF.
+    """
+    if data[:2] == b"II":
+        byte_order = "<"
+    elif data[:2] == b"MM":
+        byte_order = ">"
+    else:
+        return None
+    (version,) = struct.unpack_from(byte_order + "H", data, 2)
+    if version == 42:
+        (ifd_offset,) = struct.unpack_from(byte_order + "I", data, 4)
+        count_format, entry_format, inline_size = "H", "HHI", 4
+    elif version == 43:
+        (ifd_offset,) = struct.unpack_from(byte_order + "Q", data, 8)
+        count_format, entry_format, inline_size = "Q", "HHQ", 8
+    else:
+        return None
+    offset_format = byte_order + ("I" if version == 42 else "Q")
+
+    (entry_count,) = struct.unpack_from(byte_order + count_format, data, ifd_offset)
+    position = ifd_offset + struct.calcsize(count_format)
+    entry_size = struct.calcsize(byte_order + entry_format) + inline_size
+    tags = {}
+    for _ in range(entry_count):
+        tag, field_type, count = struct.unpack_from(
+            byte_order + entry_format, data, position
+        )
+        value_position = position + entry_size - inline_size
+        position += entry_size
+        if field_type not in TIFF_TYPES:
+            continue
+        value_format = "{}{}{}".format(byte_order, count, TIFF_TYPES[field_type])
+        if struct.calcsize(value_format) > inline_size:
+            (value_position,) = struct.unpack_from(offset_format, data, value_position)
+        tags[tag] = struct.unpack_from(value_format, data, value_position)
+    return byte_order, tags
+
+
+def uncompressed_layout(data: bytes):
+    """(dtype, (height, width), offset) of the pixels of an uncompressed TIFF.
+
+    Returns None unless the first image is single channel 8, 16, 32 or 64-bit integers
+    in uncompressed strips that follow each other without gaps.
+    """
+    try:
+        ifd = read_first_ifd(data)
+    except struct.error:
+        return None
+    if ifd is None:
+        return None
+    byte_order, tags = ifd
+
+    def tag(code, default=None):
+        return tags.get(code, (default,))[0]
+
+    width = tag(IMAGE_WIDTH)
+    height = tag(IMAGE_LENGTH)
+    bits = tag(BITS_PER_SAMPLE, 1)
+    kind = SAMPLE_KINDS.get(tag(SAMPLE_FORMAT, 1))
+    if (
+        not width
+        or not height
+        or kind is None
+        or bits not in (8, 16, 32, 64)
+        or tag(COMPRESSION, 1) != 1
+        or tag(PREDICTOR, 1) != 1
+        or tag(PHOTOMETRIC, 1) != 1
+        or tag(SAMPLES_PER_PIXEL, 1) != 1
+        or TILE_WIDTH in tags
+        or STRIP_OFFSETS not in tags
+    ):
+        return None
+    dtype = np.dtype("{}{}{}".format(byte_order, kind, bits // 8))
+
+    row_bytes = width * dtype.itemsize
+    rows_per_strip = min(tag(ROWS_PER_STRIP, height), height)
+    offsets = tags[STRIP_OFFSETS]
+    counts = tags.get(STRIP_BYTE_COUNTS)
+    if len(offsets) != -(-height // rows_per_strip):
+        return None
+    for strip, offset in enumerate(offsets):
+        strip_bytes = min(rows_per_strip, height - strip * rows_per_strip) * row_bytes
+        if counts is not None and counts[strip] != strip_bytes:
+            return None
+        if offset != offsets[0] + strip * rows_per_strip * row_bytes:
+            return None
+    if offsets[0] + height * row_bytes > len(data):
+        return None
+    return dtype, (height, width), offsets[0]
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    """Decode the contents of an image file into an array.
+
+    Uncompressed TIFFs are returned as a read-only view of data, everything else is
+    decoded by PIL.
+    """
+    layout = uncompressed_layout(data)
+    if layout is not None:
+        dtype, shape, offset = layout
+        return np.frombuffer(
+            data, dtype=dtype, count=shape[0] * shape[1], offset=offset
+        ).reshape(shape)
+    return np.asarray(Image.open(io.BytesIO(data)))
@@ -0,0 +1,190 @@
+# Streaming writer for tiled, compressed BigTIFF mosaics.
+#
+# The mosaic is written one row of tiles at a time while the sample is still being
+# composited, as soon as no remaining field can touch those rows any more. Tiles are
+# deflate compressed independently, so readers can decode any part of the image without
+# loading the rest, and the file is BigTIFF so it is not limited to 4 GB. The IFD is
+# written after the tiles, once all their offsets are known. The file only appears under
+# its real name once close() has finished it. The tiles of a row can be compressed by
+# several threads at once, zlib releases the GIL while it works.
+
+import json
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .atomic import commit_output, discard_output, partial_path
+
+DEFAULT_TILE_SIZE = 256
+
+# TIFF field types
+ASCII = 2
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+LONG8 = 16
+
+TYPE_FORMATS = {ASCII: "s", SHORT: "H", LONG: "I", RATIONAL: "II", LONG8: "Q"}
+
+COMPRESSION_NONE = 1
+COMPRESSION_DEFLATE = 8
+RESOLUTION_UNIT_CM = 3
+
+
+def resolution_rational(pixel_spacing_um: float):
+    """Return the pixels per centimetre for pixel_spacing_um as a TIFF rational."""
+    pixels_per_cm = 10000.0 / pixel_spacing_um
+    return (int(round(pixels_per_cm * 1000)), 1000)
+
+
+class TiledTiffWriter:
+    """Writes a (H, W) grayscale or (H, W, 3) RGB canvas as a tiled BigTIFF.
+
+    write_rows_until() encodes every complete row of tiles of the canvas above the given
+    row, so it must only be called once those rows are final. close() encodes whatever is
+    left and writes the IFD.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        canvas: np.ndarray,
+        tile_size: int = DEFAULT_TILE_SIZE,
+        compress_level: int = 6,
+        pixel_spacing_um: float = None,
+        metadata: dict = None,
+        threads: int = 1,
+    ):
+        self.path = path
+        self.canvas = canvas
+        self.height, self.width = canvas.shape[:2]
+        self.samples = canvas.shape[2] if canvas.ndim == 3 else 1
+        self.dtype = canvas.dtype
+        self.tile_size = tile_size
+        self.compress_level = compress_level
+        self.pixel_spacing_um = pixel_spacing_um
+        self.metadata = metadata
+        self.rows_written = 0
+        self.tile_offsets = []
+        self.tile_byte_counts = []
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.partial_path = partial_path(path)
+        self.file = open(self.partial_path, "wb")
+        # BigTIFF header, the offset of the IFD is filled in by close().
+        self.file.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+
+    def write_rows_until(self, row: int):
+        """Encode every complete row of tiles that ends at or before row."""
+        row = min(row, self.height)
+        while self.rows_written < self.height and (
+            self.rows_written + self.tile_size <= row or row == self.height
+        ):
+            start = self.rows_written
+            self._write_tile_row(self.canvas[start : start + self.tile_size])
+            self.rows_written += self.tile_size
+
+    def _encode_tile(self, block: np.ndarray) -> bytes:
+        tile_shape = (self.tile_size, self.tile_size) + block.shape[2:]
+        if block.shape != tile_shape:
+            # Tiles on the right and bottom edges are padded to the full tile size.
+            padded = np.zeros(tile_shape, dtype=self.dtype)
+            padded[: block.shape[0], : block.shape[1]] = block
+            block = padded
+        data = np.ascontiguousarray(block, dtype=self.dtype.newbyteorder("<")).tobytes()
+        if self.compress_level > 0:
+            data = zlib.compress(data, self.compress_level)
+        return data
+
+    def _write_tile_row(self, band: np.ndarray):
+        blocks = [
+            band[:, col : col + self.tile_size]
+            for col in range(0, self.width, self.tile_size)
+        ]
+        if self.executor is not None:
+            tiles = self.executor.map(self._encode_tile, blocks)
+        else:
+            tiles = map(self._encode_tile, blocks)
+        for data in tiles:
+            self.tile_offsets.append(self.file.tell())
+            self.tile_byte_counts.append(len(data))
+            self.file.write(data)
+
+    def _tags(self):
+        bits = self.dtype.itemsize * 8
+        tags = [
+            (256, LONG, [self.width]),
+            (257, LONG, [self.height]),
+            (258, SHORT, [bits] * self.samples),
+            (
+                259,
+                SHORT,
+                [COMPRESSION_DEFLATE if self.compress_level > 0 else COMPRESSION_NONE],
+            ),
+            (262, SHORT, [2 if self.samples == 3 else 1]),
+            (277, SHORT, [self.samples]),
+            (284, SHORT, [1]),
+            (322, LONG, [self.tile_size]),
+            (323, LONG, [self.tile_size]),
+            (324, LONG8, self.tile_offsets),
+            (325, LONG8, self.tile_byte_counts),
+            (339, SHORT, [1] * self.samples),
+        ]
+        if self.metadata is not None:
+            description = json.dumps(self.metadata).encode("ascii") + b"\0"
+            tags.append((270, ASCII, description))
+        if self.pixel_spacing_um:
+            resolution = resolution_rational(self.pixel_spacing_um)
+            tags.append((282, RATIONAL, [resolution]))
+            tags.append((283, RATIONAL, [resolution]))
+            tags.append((296, SHORT, [RESOLUTION_UNIT_CM]))
+        return sorted(tags, key=lambda tag: tag[0])
+
+    @staticmethod
+    def _pack_value(field_type, values) -> bytes:
+        if field_type == ASCII:
+            return bytes(values)
+        if field_type == RATIONAL:
+            return b"".join(struct.pack("<II", *value) for value in values)
+        return struct.pack("<{}{}".format(len(values), TYPE_FORMATS[field_type]), *values)
+
+    def _shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def close(self):
+        self.write_rows_until(self.height)
+        self.canvas = None
+        self._shutdown()
+        entries = []
+        for tag, field_type, values in self._tags():
+            data = self._pack_value(field_type, values)
+            count = len(values)
+            if len(data) <= 8:
+                value = data.ljust(8, b"\0")
+            else:
+                # Values that do not fit in the entry are stored before the IFD.
+                if self.file.tell() % 2:
+                    self.file.write(b"\0")
+                value = struct.pack("<Q", self.file.tell())
+                self.file.write(data)
+            entries.append(struct.pack("<HHQ", tag, field_type, count) + value)
+
+        if self.file.tell() % 2:
+            self.file.write(b"\0")
+        ifd_offset = self.file.tell()
+        self.file.write(struct.pack("<Q", len(entries)))
+        self.file.write(b"".join(entries))
+        self.file.write(struct.pack("<Q", 0))
+        self.file.seek(8)
+        self.file.write(struct.pack("<Q", ifd_offset))
+        self.file.close()
+        commit_output(self.partial_path, self.path)
+
+    def abort(self):
+        """Close and remove a partially written file."""
+        self.canvas = None
+        self._shutdown()
+        if not self.file.closed:
+            self.file.close()
+        discard_output(self.partial_path)
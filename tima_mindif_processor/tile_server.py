@@ -0,0 +1,438 @@
+# On-demand Deep Zoom tiles of the samples of a project.
+#
+# Pre-rendering the full resolution mosaics and pyramids of every sample takes hours,
+# mostly for samples nobody looks at. The tile server renders a tile when a viewer asks
+# for it, straight from the field images: FieldIndex finds the fields under the tile and
+# composite_field() places them onto a tile sized canvas, block reduced by the scale of
+# the zoom level like the previews of create_sample. A tile of level L and scale
+# s = 2 ** (max_level - L) is the same as the matching part of the preview with scale s.
+#
+# Decoded fields and encoded tiles are kept in two LRU caches bounded by their size in
+# bytes, so panning around a sample reads every field once. The server handles requests
+# in threads, NumPy, zlib and the image decoders release the GIL for most of the work.
+#
+#   GET /samples.json                                 the samples of the project
+#   GET /<sample>/legend.json                         phases and modal mineralogy
+#   GET /<sample>/<kind>.dzi                          kind is classification or bse
+#   GET /<sample>/<kind>_files/<level>/<col>_<row>.png
+#
+# The .dzi and tile URLs follow the Deep Zoom layout of the pyramids written by
+# create_sample, so viewers such as OpenSeadragon open them the same way. The BSE tiles
+# are not normalised, that needs the levels of all the fields of a sample.
+
+import argparse
+import collections
+import io
+import json
+import sys
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+import numpy as np
+from loguru import logger
+from .cache import colour_lut
+from .compositing import build_colour_lut, composite_field
+from .modal import modal_tables
+from .png_writer import encode_png
+from .pyramid import (
+    DEFAULT_TILE_SIZE,
+    DZI_TEMPLATE,
+    pyramid_level_size,
+    pyramid_max_level,
+)
+from .roi import field_index
+from .sample import WHITE, Sample
+from .tima_mindif_processor import (
+    log_missing_images,
+    read_field_images,
+    read_project_samples,
+)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+DEFAULT_FIELD_CACHE_MB = 512
+DEFAULT_TILE_CACHE_MB = 128
+TILE_KINDS = ("classification", "bse")
+# Tiles are compressed quickly, they are rendered while a viewer waits.
+TILE_COMPRESS_LEVEL = 1
+
+
+class LRUCache:
+    """Thread safe least recently used cache of values taking up to max_bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size: int):
+        """Cache value of size bytes, evicting the least recently used values.
+
+        Values larger than the whole cache are not kept. Returns value.
+        """
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            if size > self.max_bytes:
+                return value
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+        return value
+
+
+class TileSource:
+    """Renders the tiles and legends of samples, (guid, sample name) pairs.
+
+    The metadata of a sample is read on its first request. Unknown samples, kinds and
+    tiles raise KeyError, samples without a MinDif dataset FileNotFoundError.
+    """
+
+    def __init__(
+        self,
+        mindif_root: str,
+        samples,
+        exclude_unclassified: bool = True,
+        tile_size: int = DEFAULT_TILE_SIZE,
+        field_cache_mb: float = DEFAULT_FIELD_CACHE_MB,
+        tile_cache_mb: float = DEFAULT_TILE_CACHE_MB,
+    ):
+        self.mindif_root = mindif_root
+        self.guids = {sample_name: guid for guid, sample_name in samples}
+        self.exclude_unclassified = exclude_unclassified
+        self.tile_size = tile_size
+        self.fields = LRUCache(int(field_cache_mb * 1024 * 1024))
+        self.tiles = LRUCache(int(tile_cache_mb * 1024 * 1024))
+        self._samples = {}
+        self._legends = {}
+        self._lock = threading.Lock()
+
+    def sample(self, sample_name: str):
+        """The Sample and the FieldIndex of sample_name."""
+        with self._lock:
+            if sample_name not in self._samples:
+                guid = self.guids[sample_name]
+                sample = Sample.load(
+                    self.mindif_root, guid, sample_name, self.exclude_unclassified
+                )
+                self._samples[sample_name] = (sample, field_index(sample.info))
+            return self._samples[sample_name]
+
+    def sample_list(self):
+        """Name, GUID and tile geometry of every sample that has a MinDif dataset."""
+        samples = []
+        for sample_name, guid in self.guids.items():
+            try:
+                sample, _ = self.sample(sample_name)
+            except FileNotFoundError:
+                continue
+            samples.append(
+                {"sample_name": sample_name, "guid": guid, **self._geometry(sample)}
+            )
+        return samples
+
+    def _geometry(self, sample: Sample) -> dict:
+        width, height = sample.mosaic_size
+        return {
+            "width": width,
+            "height": height,
+            "pixel_spacing_um": sample.pixel_spacing,
+            "tile_size": self.tile_size,
+            "max_level": pyramid_max_level(width, height),
+        }
+
+    def field_images(self, sample: Sample, field_name: str):
+        """Decoded (phases, mask, bse) of a field, phases and mask None if missing."""
+        key = (sample.guid, field_name)
+        images = self.fields.get(key)
+        if images is None:
+            phases, mask, bse, missing, _ = read_field_images(
+                sample.info, field_name, True
+            )
+            log_missing_images(sample.info, field_name, missing)
+            if phases is None or mask is None:
+                phases = mask = bse = None
+            images = (phases, mask, bse)
+            size = sum(image.nbytes for image in images if image is not None)
+            self.fields.put(key, images, size)
+        return images
+
+    def render(self, sample_name: str, kind: str, level: int, column: int, row: int):
+        """Composite a tile, returns its array and (field_name, FieldStats) pairs."""
+        if kind not in TILE_KINDS:
+            raise KeyError(kind)
+        sample, index = self.sample(sample_name)
+        width, height = sample.mosaic_size
+        max_level = pyramid_max_level(width, height)
+        if not 0 <= level <= max_level:
+            raise KeyError(level)
+        level_width, level_height = pyramid_level_size(width, height, level)
+        left = column * self.tile_size
+        top = row * self.tile_size
+        if column < 0 or row < 0 or left >= level_width or top >= level_height:
+            raise KeyError((column, row))
+        tile_width = min(self.tile_size, level_width - left)
+        tile_height = min(self.tile_size, level_height - top)
+        scale = 2 ** (max_level - level)
+
+        rgb_canvas = np.full((tile_height, tile_width, 3), WHITE, dtype=np.uint8)
+        bse_canvas = None
+        if kind == "bse":
+            bse_canvas = np.full(
+                (tile_height, tile_width), sample.bse_nodata, dtype=sample.bse_dtype
+            )
+        luts = colour_lut(sample.info["phase_map"], build_colour_lut)
+        image_size = (sample.info["image_width_px"], sample.info["image_height_px"])
+        # The full resolution box of the tile, its origin is aligned to the blocks of
+        # scale, so the blocks are those of the preview.
+        box = (
+            left * scale,
+            top * scale,
+            (left + tile_width) * scale,
+            (top + tile_height) * scale,
+        )
+        field_stats = []
+        for field_name, field_x, field_y in index.query(box):
+            phases, mask, bse = self.field_images(sample, field_name)
+            if phases is None:
+                continue
+            if kind == "bse":
+                # Nothing is classified under an empty mask, which skips the phases.
+                mask = np.zeros(mask.shape, dtype=np.uint8)
+            stats = composite_field(
+                phases,
+                mask,
+                field_x - box[0],
+                field_y - box[1],
+                image_size,
+                *luts,
+                self.exclude_unclassified,
+                rgb_canvas,
+                bse=bse,
+                bse_canvas=bse_canvas,
+                scale=scale,
+            )
+            field_stats.append((field_name, stats))
+        return rgb_canvas if kind == "classification" else bse_canvas, field_stats
+
+    def tile(self, sample_name: str, kind: str, level: int, column: int, row: int):
+        """The PNG bytes of a tile."""
+        key = (sample_name, kind, level, column, row)
+        data = self.tiles.get(key)
+        if data is None:
+            tile, _ = self.render(sample_name, kind, level, column, row)
+            file = io.BytesIO()
+            encode_png(file, tile, TILE_COMPRESS_LEVEL)
+            data = self.tiles.put(key, file.getvalue(), file.tell())
+        return data
+
+    def dzi(self, sample_name: str, kind: str) -> str:
+        if kind not in TILE_KINDS:
+            raise KeyError(kind)
+        width, height = self.sample(sample_name)[0].mosaic_size
+        return DZI_TEMPLATE.format(tile_size=self.tile_size, width=width, height=height)
+
+    def legend(self, sample_name: str) -> dict:
+        """Geometry, phases and modal mineralogy of a sample, of all its fields.
+
+        The statistics are gathered while the level that fits a single tile is rendered,
+        they are those of the full resolution fields.
+        """
+        with self._lock:
+            legend = self._legends.get(sample_name)
+        if legend is not None:
+            return legend
+        sample, _ = self.sample(sample_name)
+        width, height = sample.mosaic_size
+        level = pyramid_max_level(width, height)
+        while level > 0 and max(pyramid_level_size(width, height, level)) > (
+            self.tile_size
+        ):
+            level -= 1
+        _, field_stats = self.render(sample_name, "classification", level, 0, 0)
+        modal, field_modal = modal_tables(
+            sample.name,
+            sample.info["phase_map"],
+            field_stats,
+            sample.info["pixel_spacing"],
+        )
+        legend = {
+            "sample_name": sample.name,
+            "guid": sample.guid,
+            **self._geometry(sample),
+            "phases": sample.phase_table,
+            "modal": modal,
+            "field_modal": field_modal,
+        }
+        with self._lock:
+            self._legends[sample_name] = legend
+        return legend
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """Serves the TileSource of its server."""
+
+    def _send(self, status, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, value):
+        self._send(HTTPStatus.OK, "application/json", json.dumps(value).encode())
+
+    def do_GET(self):
+        source = self.server.source
+        parts = [unquote(part) for part in urlparse(self.path).path.split("/") if part]
+        try:
+            if parts in ([], ["samples.json"]):
+                self._send_json(source.sample_list())
+            elif len(parts) == 2 and parts[1] == "legend.json":
+                self._send_json(source.legend(parts[0]))
+            elif len(parts) == 2 and parts[1].endswith(".dzi"):
+                self._send(
+                    HTTPStatus.OK,
+                    "application/xml",
+                    source.dzi(parts[0], parts[1][: -len(".dzi")]).encode(),
+                )
+            elif (
+                len(parts) == 4
+                and parts[1].endswith("_files")
+                and parts[3].endswith(".png")
+            ):
+                column, row = parts[3][: -len(".png")].split("_")
+                tile = source.tile(
+                    parts[0],
+                    parts[1][: -len("_files")],
+                    int(parts[2]),
+                    int(column),
+                    int(row),
+                )
+                self._send(HTTPStatus.OK, "image/png", tile)
+            else:
+                raise KeyError(self.path)
+        except (KeyError, ValueError, FileNotFoundError):
+            self._send(HTTPStatus.NOT_FOUND, "text/plain", b"Not found")
+        except Exception:
+            logger.exception("Could not serve {}", self.path)
+            self._send(HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain", b"Error")
+
+    def log_message(self, format, *args):
+        logger.debug("{} {}", self.address_string(), format % args)
+
+
+def make_server(source: TileSource, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+    """A ThreadingHTTPServer serving source, port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), TileRequestHandler)
+    server.daemon_threads = True
+    server.source = source
+    return server
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Serve Deep Zoom tiles of the samples of a TIMA project, rendered "
+        + "from the MinDif fields on request."
+    )
+    parser.add_argument("project_path", type=str, help="Path to the TIMA project")
+    parser.add_argument("mindif_root", type=str, help="Path to the MinDif root")
+    parser.add_argument(
+        "--host",
+        dest="host",
+        default=DEFAULT_HOST,
+        type=str,
+        help="Address to listen on.",
+    )
+    parser.add_argument(
+        "--port", dest="port", default=DEFAULT_PORT, type=int, help="Port to listen on."
+    )
+    parser.add_argument(
+        "--exclude-unclassified",
+        "-u",
+        action="store_true",
+        help="Exclude unclassified rock types from the tiles",
+    )
+    parser.add_argument(
+        "--tile-size",
+        dest="tile_size",
+        default=DEFAULT_TILE_SIZE,
+        type=int,
+        help="Width and height of the tiles in pixels.",
+    )
+    parser.add_argument(
+        "--field-cache-mb",
+        dest="field_cache_mb",
+        default=DEFAULT_FIELD_CACHE_MB,
+        type=float,
+        help="Memory the decoded field images may take, in MB.",
+    )
+    parser.add_argument(
+        "--tile-cache-mb",
+        dest="tile_cache_mb",
+        default=DEFAULT_TILE_CACHE_MB,
+        type=float,
+        help="Memory the encoded tiles may take, in MB.",
+    )
+    parser.add_argument(
+        "--verbose", "-v", action="store_true", help="Enables verbose logging"
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
+    logger.remove()
+    logger.add(
+        sys.stdout,
+        level="INFO" if not args.verbose else "DEBUG",
+        format="<green>{time:HH:mm:ss}</green> | <level>{message}</level>",
+    )
+
+    samples, _ = read_project_samples(args.project_path)
+    source = TileSource(
+        args.mindif_root,
+        samples,
+        args.exclude_unclassified,
+        args.tile_size,
+        args.field_cache_mb,
+        args.tile_cache_mb,
+    )
+    server = make_server(source, args.host, args.port)
+    logger.info(
+        "Serving {} samples on http://{}:{}/",
+        len(samples),
+        *server.server_address[:2],
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,18 +15,85 @@ import os
 import os.path
 import sys
 import math
-import re
-import copy
+import itertools
 import multiprocessing
 import numpy as np
 from functools import partial
 import xml.etree.ElementTree as ET
 from loguru import logger
-from PIL import Image, ImageDraw, ImageFont, ImageColor
+from PIL import Image, ImageDraw
 from pathlib import Path
+from .canvas import (
+    CanvasStore,
+    attach_canvas,
+    canvas_nbytes,
+    detach_canvas,
+    open_canvas_store,
+    share_canvases_with_workers,
+)
+from .png_writer import write_png
+from .encoding import DEFAULT_ENCODING_PROFILE, encoding_profile
+from .readahead import read_ahead as read_fields_ahead, timed_read
+from .tiff_writer import TiledTiffWriter
+from .tiff_reader import decode_image
+from .pyramid import DeepZoomWriter
+from .modal import modal_table_paths, write_modal_tables
+from .id_array import id_array_dtype, id_array_path, id_array_paths, write_id_array
+from .atomic import write_atomically
+from .metrics import (
+    SampleMetrics,
+    log_summary,
+    path_bytes,
+    run_record,
+    write_metrics,
+)
+from .cache import (
+    colour_lut as colour_lut_cache,
+    init_cache,
+    phase_table,
+    text_width,
+    truetype_font,
+)
+from .project_index import ProjectIndex, cached_dataset, default_index_path
+from .scheduler import MemoryGate, default_pool_memory_mb, largest_first
+from .roi import ROI_UNITS, roi_box, roi_info, roi_name
+from .manifest import (
+    SampleManifest,
+    checkpoint_key,
+    discard_checkpoint,
+    input_fingerprints,
+    load_checkpoint,
+    output_key,
+    save_checkpoint,
+)
+from .validate import (
+    ValidationError,
+    VALIDATION_CHUNK_FIELDS,
+    default_report_path,
+    issue,
+    sample_report,
+    validate_field_chunk,
+    write_report,
+)
+from .compositing import (
+    MAX_UNKNOWN_PHASE_PIXELS,
+    build_colour_lut,
+    composite_field,
+    histogram_to_phase_map,
+    merge_bbox,
+)
 
 SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 XML_NAMESPACE = None
+# Smallest font size used for the legend of reduced previews.
+MIN_FONT_SIZE = 10
+DATASET_XML_FILES = ("phases.xml", "measurement.xml", "fields.xml")
+# Fields decoded ahead of the one being composited, and the memory they may take.
+DEFAULT_READ_AHEAD = 2
+DEFAULT_READ_AHEAD_MB = 256
+FIELD_IMAGES = ("phases.tif", "mask.png", "bse.png")
+# Memory of a worker before it allocates anything for a sample, in MB.
+WORKER_BASE_MB = 100
 
 
 class SampleError(Exception):
@@ -39,16 +106,82 @@ def get_percent_text(value):
     return "{:4.2f}".format(value)
 
 
-def set_global(logger_):
+def legend_layout(scale: int = 1) -> dict:
+    """Fonts and line metrics of the legend of a mosaic reduced by scale."""
+    # The legend is scaled down with the mosaic, but kept legible.
+    sample_name_font_size = max(MIN_FONT_SIZE, int(round(36 / scale)))
+    font_size = max(MIN_FONT_SIZE, int(round(24 / scale)))
+    font_path = os.path.join(SCRIPT_PATH, "fonts", "DejaVuSansMono.ttf")
+    sample_name_line_height = int(math.ceil(sample_name_font_size * 1.3))
+    line_height = int(math.ceil(font_size * 1.3))
+    return {
+        "sample_name_font": truetype_font(font_path, sample_name_font_size),
+        "font": truetype_font(font_path, font_size),
+        "font_size": font_size,
+        "text_y_offset": int(math.ceil(sample_name_line_height * 1.5)),
+        "line_height": line_height,
+        "text_x_offset": line_height * 2 - font_size,
+    }
+
+
+def draw_legend(
+    image: Image.Image,
+    layout: dict,
+    sample_name: str,
+    phase_map,
+    classified_pixel_count: int,
+    show_low_val: bool,
+    start_x: int,
+    percent_right_x: int,
+):
+    """Draw the sample name and the (id, phase) entries of phase_map onto image."""
+    black = (0, 0, 0)
+    font = layout["font"]
+    line_height = layout["line_height"]
+    draw = ImageDraw.Draw(image)
+    draw.text(
+        (start_x, 5), sample_name, black, font=layout["sample_name_font"],
+    )
+    y = layout["text_y_offset"]
+    for id, phase_map_entry in phase_map:
+        if not show_low_val and (
+            (float(phase_map_entry["histogram"]) / classified_pixel_count * 100)
+            < 0.01
+        ):
+            continue
+
+        draw.rectangle(
+            [(start_x, y), (start_x + line_height, y + line_height)],
+            fill=phase_map_entry["colour"],
+        )
+        draw.text(
+            (start_x + layout["text_x_offset"], y),
+            phase_map_entry["mineral_name"],
+            black,
+            font=font,
+        )
+        text = get_percent_text(
+            float(phase_map_entry["histogram"]) / classified_pixel_count * 100
+        )
+        draw.text((percent_right_x - text_width(font, text), y), text, black, font=font)
+        y += line_height
+
+
+def set_xml_namespace():
     global XML_NAMESPACE
-    global logger
-    logger = logger_
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
     if not XML_NAMESPACE:
         namespace = "http://www.tescan.cz/tima/1_4"
         XML_NAMESPACE = "{{{0}}}".format(namespace) if namespace else ""
 
 
+def set_global(logger_):
+    global logger
+    logger = logger_
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_xml_namespace()
+    init_cache()
+
+
 def get_suvery_sample_info(survey_group: ET.Element, rep_to_dir: dict):
     if survey_group is None:
         return []
@@ -82,12 +215,407 @@ def tima_mindif_processor(
     show_low_val: bool = True,
     generate_id_array: bool = True,
     generate_bse: bool = True,
+    scratch_dir: str = None,
+    memory_budget_mb: float = None,
+    id_array_format: str = "csv",
+    parallelism: str = "auto",
+    processes: int = None,
+    mosaic_format: str = "png",
+    pyramid: bool = False,
+    pyramid_resampling: str = "mode",
+    scale: int = 1,
+    modal_tables: bool = False,
+    checkpoint_every: int = 0,
+    project_index: bool = True,
+    index_path: str = None,
+    metrics_path: str = None,
+    encoding: str = DEFAULT_ENCODING_PROFILE,
+    encode_threads: int = None,
+    read_ahead: int = DEFAULT_READ_AHEAD,
+    read_ahead_mb: float = DEFAULT_READ_AHEAD_MB,
+    bse_normalise: bool = False,
+    roi=None,
+    roi_units: str = "um",
+    validate: bool = False,
+    fail_fast: bool = False,
+    validation_path: str = None,
+    pool_memory_mb: float = None,
+    wait_for_enter: bool = True,
 ):
     start = time.time()
+    processes = processes or os.cpu_count() or 1
+    plan = plan_project(
+        project_path,
+        mindif_root,
+        output_root,
+        processes,
+        exclude_unclassified=exclude_unclassified,
+        create_thumbnail=create_thumbnail,
+        show_low_val=show_low_val,
+        generate_id_array=generate_id_array,
+        generate_bse=generate_bse,
+        scratch_dir=scratch_dir,
+        memory_budget_mb=memory_budget_mb,
+        id_array_format=id_array_format,
+        parallelism=parallelism,
+        mosaic_format=mosaic_format,
+        pyramid=pyramid,
+        pyramid_resampling=pyramid_resampling,
+        scale=scale,
+        modal_tables=modal_tables,
+        checkpoint_every=checkpoint_every,
+        project_index=project_index,
+        index_path=index_path,
+        metrics_path=metrics_path,
+        encoding=encoding,
+        encode_threads=encode_threads,
+        read_ahead=read_ahead,
+        read_ahead_mb=read_ahead_mb,
+        bse_normalise=bse_normalise,
+        roi=roi,
+        roi_units=roi_units,
+    )
+
+    if plan["parallelism"] == "field":
+        share_canvases_with_workers()
+
+    try:
+        pool = multiprocessing.Pool(
+            processes, initializer=set_global, initargs=(logger,)
+        )
+        update_project_index(pool, plan)
+        if validate:
+            report_path = validation_path or default_report_path(output_root)
+            plan["samples"] = validate_samples(pool, plan, report_path, fail_fast)
+        if plan["parallelism"] == "field":
+            # The samples are handled one at a time by this process while the workers
+            # composite their fields.
+            set_xml_namespace()
+            sample_records = [
+                plan["func"](sample, field_pool=pool, field_processes=processes)
+                for sample in plan["samples"]
+            ]
+        else:
+            sample_records = process_samples(
+                pool,
+                [(plan["func"], sample) for sample in plan["samples"]],
+                estimate_project(pool, plan),
+                pool_memory_mb,
+                processes,
+            )
+        end = time.time()
+        finish_project(plan, sample_records, end - start, processes)
+        hours, rem = divmod(end - start, 3600)
+        minutes, seconds = divmod(rem, 60)
+        logger.info(
+            "Tima MinDif Processor completed in {:0>2}:{:0>2}:{:05.2f}",
+            int(hours),
+            int(minutes),
+            seconds,
+        )
+        if wait_for_enter:
+            logger.warning("Press Enter to terminate")
+            input("")
+    except KeyboardInterrupt:
+        logger.warning("Caught KeyboardInterrupt, terminating workers")
+        pool.terminate()
+    except ValidationError:
+        pool.close()
+        raise
+    else:
+        logger.info("Sample processing complete")
+        pool.close()  # Marks the pool as closed.
+    finally:
+        pool.join()
+
+
+def plan_project(
+    project_path: str,
+    mindif_root: str,
+    output_root: str,
+    processes: int,
+    exclude_unclassified: bool = True,
+    create_thumbnail: bool = False,
+    show_low_val: bool = True,
+    generate_id_array: bool = True,
+    generate_bse: bool = True,
+    scratch_dir: str = None,
+    memory_budget_mb: float = None,
+    id_array_format: str = "csv",
+    parallelism: str = "auto",
+    mosaic_format: str = "png",
+    pyramid: bool = False,
+    pyramid_resampling: str = "mode",
+    scale: int = 1,
+    modal_tables: bool = False,
+    checkpoint_every: int = 0,
+    project_index: bool = True,
+    index_path: str = None,
+    metrics_path: str = None,
+    encoding: str = DEFAULT_ENCODING_PROFILE,
+    encode_threads: int = None,
+    read_ahead: int = DEFAULT_READ_AHEAD,
+    read_ahead_mb: float = DEFAULT_READ_AHEAD_MB,
+    bse_normalise: bool = False,
+    roi=None,
+    roi_units: str = "um",
+) -> dict:
+    """Find the samples of a project and prepare their processing by processes workers.
+
+    Returns a dict with the samples, the parallelism chosen for them, func, which
+    processes one sample, and estimate, which estimates one from its dataset record.
+    With a roi, an (x, y, width, height) region in roi_units, only that region of every
+    sample is processed.
+    """
+    if scale < 1:
+        raise ValueError("The preview scale must be at least 1, got {}".format(scale))
+    if roi_units not in ROI_UNITS:
+        raise ValueError(
+            "Unknown region units {}, use one of {}".format(roi_units, ROI_UNITS)
+        )
+    encoding_profile(encoding)
     proj_path = Path(project_path)
     project_name = proj_path.name
 
     logger.info("Project Name: {}", project_name)
+
+    index = None
+    if project_index:
+        index = ProjectIndex(index_path or default_index_path(output_root))
+        guid_and_sample_name = index.samples(project_path, read_project_samples)
+        logger.info("Using the project index {}", index.path)
+    else:
+        guid_and_sample_name, _ = read_project_samples(project_path)
+
+    parallelism = choose_parallelism(parallelism, len(guid_and_sample_name), processes)
+    logger.info(
+        "Processing {} samples with {} workers, parallel over {}s",
+        len(guid_and_sample_name),
+        processes,
+        parallelism,
+    )
+    if encode_threads is None:
+        # Samples in parallel keep every core busy already, while a sample whose fields
+        # are composited in parallel is encoded by this process alone.
+        encode_threads = processes if parallelism == "field" else 1
+
+    func = partial(
+        create_sample,
+        mindif_root,
+        output_root,
+        exclude_unclassified,
+        show_low_val,
+        create_thumbnail,
+        generate_id_array,
+        generate_bse,
+        scratch_dir=scratch_dir,
+        memory_budget_mb=memory_budget_mb,
+        id_array_format=id_array_format,
+        mosaic_format=mosaic_format,
+        pyramid=pyramid,
+        pyramid_resampling=pyramid_resampling,
+        scale=scale,
+        modal_tables=modal_tables,
+        checkpoint_every=checkpoint_every,
+        index_path=index.path if index is not None else None,
+        encoding=encoding,
+        encode_threads=encode_threads,
+        read_ahead=read_ahead,
+        read_ahead_mb=read_ahead_mb,
+        bse_normalise=bse_normalise,
+        roi=roi,
+        roi_units=roi_units,
+    )
+    estimate = partial(
+        estimate_sample,
+        generate_bse=generate_bse,
+        generate_id_array=generate_id_array,
+        create_thumbnail=create_thumbnail,
+        scale=scale,
+        memory_budget_mb=memory_budget_mb,
+        read_ahead=read_ahead,
+        read_ahead_mb=read_ahead_mb,
+    )
+    return {
+        "project_path": project_path,
+        "mindif_root": mindif_root,
+        "output_root": output_root,
+        "metrics_path": metrics_path,
+        "index": index,
+        "samples": guid_and_sample_name,
+        "parallelism": parallelism,
+        "func": func,
+        "estimate": estimate,
+        "validation": {
+            "exclude_unclassified": exclude_unclassified,
+            "images": FIELD_IMAGES if generate_bse else FIELD_IMAGES[:2],
+            "roi": roi,
+            "roi_units": roi_units,
+        },
+    }
+
+
+def update_project_index(pool, plan: dict):
+    """Read the datasets of the project that are not indexed yet with pool."""
+    index = plan["index"]
+    if index is None:
+        return
+    stale = index.stale_datasets(
+        plan["mindif_root"], [guid for guid, _ in plan["samples"]]
+    )
+    if stale:
+        logger.info("Indexing {} datasets", len(stale))
+        index.update(pool.map(partial(read_dataset, plan["mindif_root"]), stale))
+    index.save()
+
+
+def estimate_project(pool, plan: dict):
+    """Return the estimates of the samples of the project, in their order.
+
+    The dataset records come from the project index, or are read with pool.
+    """
+    guids = list(dict.fromkeys(guid for guid, _ in plan["samples"]))
+    if plan["index"] is not None:
+        datasets = {guid: plan["index"].dataset(guid) for guid in guids}
+    else:
+        datasets = dict(
+            zip(guids, pool.map(partial(read_dataset, plan["mindif_root"]), guids))
+        )
+    return [plan["estimate"](datasets[guid]) for guid, _ in plan["samples"]]
+
+
+def validate_project(pool, plan: dict):
+    """Check the exports of the samples of the project, their fields in chunks on pool.
+
+    The dataset records come from the project index, or are read with pool. Returns the
+    validation report of every sample, in their order.
+    """
+    options = plan["validation"]
+    guids = list(dict.fromkeys(guid for guid, _ in plan["samples"]))
+    if plan["index"] is not None:
+        datasets = {guid: plan["index"].dataset(guid) for guid in guids}
+    else:
+        datasets = dict(
+            zip(guids, pool.map(partial(read_dataset, plan["mindif_root"]), guids))
+        )
+
+    sample_issues = []
+    tasks = []
+    for position, (guid, sample_name) in enumerate(plan["samples"]):
+        issues = []
+        info = sample_info_from_dataset(
+            datasets[guid], sample_name, options["exclude_unclassified"]
+        )
+        if info is None:
+            issues.append(
+                issue("error", "phases.xml was not found in the MinDif dataset")
+            )
+        elif not info["fields"]:
+            issues.append(issue("error", "fields.xml lists no fields"))
+        elif options["roi"] is not None:
+            try:
+                info = roi_info(
+                    info, roi_box(info, options["roi"], options["roi_units"])
+                )
+            except ValueError as error:
+                issues.append(issue("error", str(error)))
+        sample_issues.append(issues)
+        if issues:
+            continue
+        for start in range(0, len(info["fields"]), VALIDATION_CHUNK_FIELDS):
+            fields = info["fields"][start : start + VALIDATION_CHUNK_FIELDS]
+            tasks.append(
+                (
+                    (position, start),
+                    info,
+                    fields,
+                    options["images"],
+                    options["exclude_unclassified"],
+                )
+            )
+
+    chunks = dict(pool.imap_unordered(validate_field_chunk, tasks))
+    return [
+        sample_report(
+            guid,
+            sample_name,
+            [
+                result
+                for key in sorted(key for key in chunks if key[0] == position)
+                for result in chunks[key]
+            ],
+            sample_issues[position],
+        )
+        for position, (guid, sample_name) in enumerate(plan["samples"])
+    ]
+
+
+def validate_samples(pool, plan: dict, report_path: str, fail_fast: bool = False):
+    """Validate the samples of the project and write the report to report_path.
+
+    Returns the samples that passed, those with warnings included. With fail_fast a
+    sample that failed raises ValidationError instead.
+    """
+    reports = validate_project(pool, plan)
+    write_report(report_path, reports)
+    statuses = [report["status"] for report in reports]
+    logger.info(
+        "Validated {} samples: {} ok, {} with warnings, {} failed, report at {}",
+        len(reports),
+        statuses.count("ok"),
+        statuses.count("warning"),
+        statuses.count("error"),
+        report_path,
+    )
+    for report in reports:
+        if not report["issues"]:
+            continue
+        # The first error, or the first warning, stands for the rest in the log.
+        first = min(report["issues"], key=lambda item: item["level"] != "error")
+        log = logger.error if report["status"] == "error" else logger.warning
+        log(
+            "Sample: {}{}: {}{}",
+            report["sample_name"],
+            ", field " + first["field_name"] if first["field_name"] else "",
+            first["detail"],
+            " and {} more issues".format(len(report["issues"]) - 1)
+            if len(report["issues"]) > 1
+            else "",
+        )
+    failed = statuses.count("error")
+    if failed and fail_fast:
+        raise ValidationError(
+            "{} samples failed validation, see {}".format(failed, report_path)
+        )
+    if failed:
+        logger.warning("Skipping the {} samples that failed validation", failed)
+    return [
+        sample
+        for sample, report in zip(plan["samples"], reports)
+        if report["status"] != "error"
+    ]
+
+
+def finish_project(plan: dict, sample_records, wall_s: float, processes: int) -> dict:
+    """Log the metrics of the samples of a project and return the record of the run.
+
+    The metrics are written to the metrics_path of the plan, if there is one.
+    """
+    run = run_record(sample_records, wall_s, processes, plan["parallelism"])
+    log_summary(run)
+    if plan["metrics_path"]:
+        write_metrics(plan["metrics_path"], sample_records, run)
+        logger.info("Metrics written to {}", plan["metrics_path"])
+    return run
+
+
+def read_project_samples(project_path: str):
+    """Find the samples of a TIMA 1.6+ or 1.4 project.
+
+    Returns the (dataset directory, sample name) pairs and the paths of the files and
+    directories that were read to find them.
+    """
+    project_name = Path(project_path).name
     guid_and_sample_name = []
 
     is_16 = False
@@ -108,6 +636,8 @@ def tima_mindif_processor(
             )
         logger.info(f"File {struct_file} exists")
         data_xml_path = os.path.join(project_path, data_file)
+        struct_xml_path = os.path.join(project_path, struct_file)
+        source_files = [project_path, data_xml_path, struct_xml_path]
         logger.info(f"File {data_xml_path} exists, configuring for TIMA 1.6+")
         data_xml = ET.parse(data_xml_path)
         project_data = data_xml.getroot()
@@ -116,7 +646,6 @@ def tima_mindif_processor(
         for dataset in project_data.iterfind("DataSet"):
             rep_to_dir[dataset.findtext("Parent")] = dataset.findtext("DirName")
 
-        struct_xml_path = os.path.join(project_path, struct_file)
         struct_xml = ET.parse(struct_xml_path)
         struct_data = struct_xml.getroot()
 
@@ -149,6 +678,7 @@ def tima_mindif_processor(
         surveys_xml_path = os.path.join(
             project_path, project_name + ".timaproj.Surveys", "Surveys.xml"
         )
+        source_files = [project_path, surveys_xml_path]
         surveys_xml = ET.parse(surveys_xml_path)
         survey_group = surveys_xml.getroot()
         for survey in survey_group.iterfind("Survey"):
@@ -157,225 +687,854 @@ def tima_mindif_processor(
                     guid_and_sample_name.append(
                         (dataset.get("guid")[1:37], replicate.get("caption"))
                     )
-    func = partial(
-        create_sample,
-        mindif_root,
-        output_root,
-        exclude_unclassified,
-        show_low_val,
-        create_thumbnail,
-        generate_id_array,
-        generate_bse,
-    )
+    return guid_and_sample_name, source_files
 
-    try:
-        pool = multiprocessing.Pool(initializer=set_global, initargs=(logger,))
-        pool.map(func, guid_and_sample_name)
-        end = time.time()
-        hours, rem = divmod(end - start, 3600)
-        minutes, seconds = divmod(rem, 60)
-        logger.info(
-            "Tima MinDif Processor completed in {:0>2}:{:0>2}:{:05.2f}",
-            int(hours),
-            int(minutes),
-            seconds,
-        )
-        logger.warning("Press Enter to terminate")
-        input("")
-    except KeyboardInterrupt:
-        logger.warning("Caught KeyboardInterrupt, terminating workers")
-        pool.terminate()
-    else:
-        logger.info("Sample processing complete")
-        pool.close()  # Marks the pool as closed.
-    finally:
-        pool.join()
 
+def find_xml_path(mindif_path: str) -> str:
+    """Return the directory below mindif_path that contains phases.xml, or ""."""
+    for root, dirs, files in os.walk(mindif_path):
+        if "phases.xml" in files:
+            return root
+    return ""
 
-def create_sample(
-    mindif_root: str,
-    output_root: str,
-    exclude_unclassified: bool,
-    show_low_val: bool,
-    create_thumbnail: bool,
-    generate_id_array: bool,
-    generate_bse: bool,
-    guid_and_sample_name,
-):
 
-    start = time.time()
-    guid = guid_and_sample_name[0]
-    sample_name = guid_and_sample_name[1]
+def xml_mtimes(xml_path: str) -> dict:
+    """Modification times of the dataset XML files, used to tell when they changed."""
+    mtimes = {}
+    for name in DATASET_XML_FILES:
+        try:
+            mtimes[name] = os.stat(os.path.join(xml_path, name)).st_mtime_ns
+        except OSError:
+            mtimes[name] = None
+    return mtimes
 
-    logger.debug("Sample: {} started processing", sample_name)
 
+def field_dir_state(field_path: str):
+    """The modification time of a field directory and which FIELD_IMAGES it holds.
+
+    One stat and one listing of the directory instead of a stat per image. Creating,
+    removing or renaming an image changes the modification time, so the existence can
+    be reused for as long as the time stays the same.
+    """
     try:
-        thumbnail_path = os.path.join(output_root, sample_name + ".thumbnail.png")
-        classification_path = os.path.join(output_root, sample_name + ".png")
+        mtime = os.stat(field_path).st_mtime_ns
+        names = set(os.listdir(field_path))
+    except OSError:
+        return None, [False] * len(FIELD_IMAGES)
+    return mtime, [name in names for name in FIELD_IMAGES]
+
+
+def parse_phases(data: bytes):
+    """Return the primary phases of the contents of a phases.xml file."""
+    phase_nodes = ET.fromstring(data).find("{0}PrimaryPhases".format(XML_NAMESPACE))
+    return [
+        {
+            "id": phase_node.get("id", None),
+            "name": phase_node.get("name"),
+            "color": phase_node.get("color"),
+            "background": phase_node.get("background"),
+            "mass": float(phase_node.get("mass")) if "mass" in phase_node else -1,
+        }
+        for phase_node in phase_nodes
+    ]
+
+
+def read_dataset(mindif_root: str, guid: str):
+    """Read phases.xml, measurement.xml and fields.xml of a MinDif dataset.
+
+    Returns a plain, JSON serialisable record of what the files contain, independent of
+    the processing options. xml_path is empty if the dataset has no phases.xml.
+    """
+    mindif_path = os.path.join(mindif_root, guid)
+
+    xml_path = find_xml_path(mindif_path)
+    if not xml_path:
+        try:
+            dir_mtime = os.stat(mindif_path).st_mtime_ns
+        except OSError:
+            dir_mtime = None
+        return {
+            "guid": guid,
+            "mindif_path": mindif_path,
+            "xml_path": "",
+            "dir_mtime": dir_mtime,
+        }
+
+    mtimes = xml_mtimes(xml_path)
+
+    # Extract the phases from phases.xml, the samples of a survey mostly share them:
+    phases = phase_table(os.path.join(xml_path, "phases.xml"), parse_phases)
+
+    # Extract information from measurement.xml:
+    measurement_xml = ET.parse(os.path.join(xml_path, "measurement.xml"))
+    measurement_nodes = measurement_xml.getroot()
+
+    software_version = measurement_nodes.findtext("{0}Origin".format(XML_NAMESPACE))
+    logger.debug("Tima Software Version: {}", software_version)
+
+    sample_def = measurement_nodes.find("{}SampleDef".format(XML_NAMESPACE))
+    measurement = {
+        "view_field_um": int(
+            measurement_nodes.findtext("{0}ViewField".format(XML_NAMESPACE))
+        ),
+        "image_width_px": int(
+            measurement_nodes.findtext("{0}ImageWidth".format(XML_NAMESPACE))
+        ),
+        "image_height_px": int(
+            measurement_nodes.findtext("{0}ImageHeight".format(XML_NAMESPACE))
+        ),
+        "sample_shape": sample_def.findtext("{0}SampleShape".format(XML_NAMESPACE)),
+    }
+    for name in ("SampleWidth", "SampleHeight", "SampleDiameter"):
+        value = sample_def.findtext("{0}{1}".format(XML_NAMESPACE, name))
+        measurement[name] = int(value) if value is not None else None
+
+    # Extract the field information from fields.xml:
+    fields_xml = ET.parse(os.path.join(xml_path, "fields.xml"))
+    fields_xml_root = fields_xml.getroot()
+    field_nodes = fields_xml_root.find("{}Fields".format(XML_NAMESPACE))
+    field_dir = fields_xml_root.findtext("{}FieldDir".format(XML_NAMESPACE))
+
+    fields = None
+    if field_nodes is not None:
+        fields = []
+        for field_node in field_nodes:
+            field_name = field_node.get("name")
+            # Which of phases.tif, mask.png and bse.png exist.
+            mtime, files = field_dir_state(
+                os.path.join(xml_path, field_dir or "", field_name)
+            )
+            fields.append(
+                {
+                    "name": field_name,
+                    "x": float(field_node.get("x")),
+                    "y": float(field_node.get("y")),
+                    "mtime": mtime,
+                    "files": files,
+                }
+            )
 
-        if os.path.exists(classification_path):
-            logger.info(
-                "skipping {} because an image already exists for it.", sample_name
+    return {
+        "guid": guid,
+        "mindif_path": mindif_path,
+        "xml_path": xml_path,
+        "mtimes": mtimes,
+        "phases": phases,
+        "measurement": measurement,
+        "field_dir": field_dir,
+        "fields": fields,
+    }
+
+
+def sample_canvas_size(measurement: dict):
+    """Size in pixels of the canvas that holds the whole sample."""
+    view_field_um = measurement["view_field_um"]
+    image_width_px = measurement["image_width_px"]
+    image_height_px = measurement["image_height_px"]
+
+    if measurement["sample_shape"] == "Rectangle":
+        sample_width_um = measurement["SampleWidth"]
+        sample_height_um = measurement["SampleHeight"]
+        sample_width_px = int((sample_width_um / float(view_field_um)) * image_width_px)
+        sample_height_px = int(
+            (sample_height_um / float(view_field_um)) * image_height_px
+        )
+        return (sample_width_px, sample_height_px)
+
+    # Must be a circle
+    sample_diameter_um = measurement["SampleDiameter"]
+    diameter_px = int((sample_diameter_um / float(view_field_um)) * image_width_px)
+    return (diameter_px, diameter_px)
+
+
+def sample_info_from_dataset(dataset: dict, sample_name: str, exclude_unclassified: bool):
+    """Work out the phases, the geometry of the sample and the position of every field
+    on the sample canvas from a record made by read_dataset.
+
+    Returns None if the dataset has no phases.xml.
+    """
+    guid = dataset["guid"]
+    xml_path = dataset["xml_path"]
+    if not xml_path:
+        logger.warning(
+            "phases.xml was not found in {} or the directory does not exist.",
+            dataset["mindif_path"],
+        )
+        return None
+
+    # Create the colour map from the phases:
+    phases_xml_path = os.path.join(xml_path, "phases.xml")
+    phase_map = {}
+
+    logger.debug("Extracting phases from {}", phases_xml_path)
+    for phase in dataset["phases"]:
+        mineral_name = phase["name"]
+
+        if (
+            mineral_name == "[Unclassified]" or phase["background"] == "yes"
+        ) and exclude_unclassified:
+            logger.debug("Excluding mineral {}", mineral_name)
+            continue
+
+        phase_id: str = phase["id"]
+        if phase_id is None:
+            logger.warning(f"Phase {mineral_name} is missing ID")
+            continue
+
+        colour_str = phase["color"]
+
+        phase_map[int(phase_id)] = {
+            "mineral_name": mineral_name,
+            "colour": (
+                int(colour_str[1:3], 16),
+                int(colour_str[3:5], 16),
+                int(colour_str[5:7], 16),
+            ),
+            "colour_hex": colour_str,
+            "mass": phase["mass"],
+            "histogram": 0,
+        }
+
+    # Every phase ID in phases.xml has to fit in the ID array, including the excluded ones.
+    max_phase_id = max(
+        (int(phase["id"]) for phase in dataset["phases"] if phase["id"] is not None),
+        default=0,
+    )
+
+    measurement = dataset["measurement"]
+    view_field_um = measurement["view_field_um"]
+    image_width_px = measurement["image_width_px"]
+    image_height_px = measurement["image_height_px"]
+    field_size = sample_canvas_size(measurement)
+
+    origin = (field_size[0] / 2, field_size[1] / 2)
+    pixel_spacing = float(view_field_um) / float(image_width_px)
+
+    fields = []
+    field_files = {}
+    if dataset["fields"] is not None:
+        for field in dataset["fields"]:
+            # The x and y values are the offset from the origin.
+            # TIMA uses +x to mean left, which is opposite to monitor coordinate system,
+            # so this value gets inverted.
+            # and       +y to mean down, which is the same as monitor coordinate system,
+            # so this value doesn't get inverted.
+            x = math.floor(
+                -field["x"] / pixel_spacing + origin[0] - (image_width_px / 2)
+            )
+            y = math.floor(
+                field["y"] / pixel_spacing + origin[1] - (image_height_px / 2)
             )
-            return
 
-        if generate_bse:
-            bse_path = os.path.join(output_root, sample_name + "_bse.png")
-            if os.path.exists(bse_path):
-                logger.info(
-                    "Not generating bse png for sample {} because a file already exists for it.",
-                    sample_name,
-                )
-                generate_bse = False
+            fields.append((field["name"], x, y))
+            field_files[field["name"]] = dict(zip(FIELD_IMAGES, field["files"]))
+    else:
+        logger.warning(
+            "{}, {}  does not have any Fields in the fields.xml file", guid, sample_name,
+        )
 
-        if generate_id_array:
-            id_array_path = os.path.join(output_root, sample_name + ".csv.gz")
-            if os.path.exists(id_array_path):
-                logger.info(
-                    "Not generating id_array for sample {} because a csv already exists for it.",
-                    sample_name,
-                )
-                generate_id_array = False
+    return {
+        "guid": guid,
+        "sample_name": sample_name,
+        "xml_path": xml_path,
+        "phases_xml_path": phases_xml_path,
+        "phase_map": phase_map,
+        "max_phase_id": max_phase_id,
+        "view_field_um": view_field_um,
+        "image_width_px": image_width_px,
+        "image_height_px": image_height_px,
+        "field_size": field_size,
+        "pixel_spacing": pixel_spacing,
+        "field_path_format": os.path.join(
+            xml_path, dataset["field_dir"] or "", "{0}", "{1}"
+        ),
+        "fields": fields,
+        "field_files": field_files,
+    }
+
+
+def read_sample_info(
+    mindif_root: str, guid: str, sample_name: str, exclude_unclassified: bool
+):
+    """Read phases.xml, measurement.xml and fields.xml of a MinDif dataset.
 
-        mindif_path = os.path.join(mindif_root, guid)
+    Returns a dict describing the phases, the geometry of the sample and the position of
+    every field on the sample canvas, or None if the dataset has no phases.xml.
+    """
+    return sample_info_from_dataset(
+        read_dataset(mindif_root, guid), sample_name, exclude_unclassified
+    )
 
-        white = (255, 255, 255)
-        black = (0, 0, 0)
 
-        sample_name_font_size = 36
-        font_size = 24
-        font_path = os.path.join(SCRIPT_PATH, "fonts")
-        sample_name_font = ImageFont.truetype(
-            os.path.join(font_path, "DejaVuSansMono.ttf"), sample_name_font_size
+def read_field_images(info: dict, field_name: str, generate_bse: bool):
+    """Decode phases.tif, mask.png and (optionally) bse.png of a field.
+
+    Returns (phases, mask, bse, missing, bytes_read), images that could not be read are
+    None and their names are listed in missing. Uncompressed TIFFs are returned as
+    read-only views of the file contents. Nothing is logged, so it is safe to call from
+    the read-ahead threads.
+    """
+    images = {}
+    missing = []
+    bytes_read = 0
+    for name in FIELD_IMAGES if generate_bse else FIELD_IMAGES[:2]:
+        try:
+            # The file is read whole and decoded from memory: one sequential read suits
+            # network mounts, and PIL's libtiff decoder closes the file descriptor it is
+            # given a second time, which breaks files opened by other threads.
+            with open(info["field_path_format"].format(field_name, name), "rb") as file:
+                data = file.read()
+            bytes_read += len(data)
+            images[name] = decode_image(data)
+        except Exception:
+            missing.append(name)
+    return (
+        images.get("phases.tif"),
+        images.get("mask.png"),
+        images.get("bse.png"),
+        missing,
+        bytes_read,
+    )
+
+
+def log_missing_images(info: dict, field_name: str, missing):
+    for name in missing:
+        logger.error(
+            "Error: {}, {}, field {} does not have {}",
+            info["guid"],
+            info["sample_name"],
+            field_name,
+            name,
         )
-        font = ImageFont.truetype(
-            os.path.join(font_path, "DejaVuSansMono.ttf"), font_size
+
+
+def load_field_images(info: dict, field_name: str, generate_bse: bool):
+    """Decode phases.tif, mask.png and (optionally) bse.png of a field.
+
+    Returns (phases, mask, bse, has_missing_file, has_missing_bse), missing images are
+    logged and returned as None.
+    """
+    phases, mask, bse, missing, _ = read_field_images(info, field_name, generate_bse)
+    log_missing_images(info, field_name, missing)
+    has_missing_file = "phases.tif" in missing or "mask.png" in missing
+    return phases, mask, bse, has_missing_file, "bse.png" in missing
+
+
+def composite_fields(
+    info: dict,
+    fields,
+    canvases: dict,
+    exclude_unclassified: bool,
+    generate_bse: bool,
+    scale: int = 1,
+    metrics: SampleMetrics = None,
+    read_ahead: int = 0,
+    read_ahead_mb: float = None,
+    bse_levels: bool = False,
+):
+    """Composite fields onto canvases, yielding (field_name, FieldStats) per field.
+
+    canvases maps "classification", "bse" and "id_array" to the canvas arrays, the last
+    two may be None. The stats are None for fields with missing images. With a scale
+    above 1 the fields are block reduced onto preview canvases. The time spent decoding
+    and compositing is recorded in metrics.
+
+    With read_ahead above 0 the images of up to that many of the next fields are decoded
+    by threads while a field is composited, as many as fit in read_ahead_mb. With
+    bse_levels the levels of the BSE fields are measured for normalise_bse().
+    """
+    metrics = metrics or SampleMetrics()
+    colour_lut, known_lut = colour_lut_cache(info["phase_map"], build_colour_lut)
+    image_size = (info["image_width_px"], info["image_height_px"])
+
+    def read(field):
+        return read_field_images(info, field[0], generate_bse)
+
+    if read_ahead > 0:
+        # Decoded size of the images of a field: int32 phases, uint8 mask, uint16 BSE.
+        field_bytes = image_size[0] * image_size[1] * (7 if generate_bse else 5)
+        decoded_fields = read_fields_ahead(
+            read,
+            fields,
+            read_ahead,
+            field_bytes,
+            int(read_ahead_mb * 1024 * 1024) if read_ahead_mb is not None else None,
         )
+    else:
+        decoded_fields = ((field,) + timed_read(read, field) for field in fields)
+
+    while True:
+        wait = time.perf_counter()
+        decoded = next(decoded_fields, None)
+        if decoded is None:
+            break
+        if read_ahead > 0:
+            metrics.add_stage("read_wait", time.perf_counter() - wait, 0.0)
+        (field_name, field_x, field_y), images, decode_wall, decode_cpu = decoded
+        phases, mask, bse, missing, bytes_read = images
+        del decoded, images
+        metrics.add_stage("decode", decode_wall, decode_cpu)
+        metrics.add("bytes_read", bytes_read)
+        # Logged here rather than by the read-ahead threads, so the errors appear in
+        # field order.
+        log_missing_images(info, field_name, missing)
+        has_missing_file = "phases.tif" in missing or "mask.png" in missing
+        has_missing_bse = "bse.png" in missing
 
-        sample_name_line_height = int(math.ceil(sample_name_font_size * 1.3))
-        legend_text_y_offset = int(math.ceil(sample_name_line_height * 1.5))
-        legend_line_height = int(math.ceil(font_size * 1.3))
-        legend_text_x_offset = legend_line_height * 2 - font_size
+        if has_missing_file:
+            metrics.add("missing_fields", 1)
+            yield field_name, None
+            continue
+
+        with metrics.stage("compositing"):
+            field_stats = composite_field(
+                phases,
+                mask,
+                field_x,
+                field_y,
+                image_size,
+                colour_lut,
+                known_lut,
+                exclude_unclassified,
+                canvases["classification"],
+                id_canvas=canvases["id_array"],
+                bse=bse if not has_missing_bse else None,
+                bse_canvas=canvases["bse"],
+                scale=scale,
+                bse_levels=bse_levels,
+            )
+        metrics.add("fields", 1)
+        metrics.add("pixels", phases.size)
+        yield field_name, field_stats
 
-        # Extract the phases from phases.xml and use it to create the colour map:
-        xml_path = ""
-        for root, dirs, files in os.walk(mindif_path):
-            for file in files:
-                if file == "phases.xml":
-                    xml_path = root
-                    break
 
-            if xml_path:
-                break
+def composite_field_chunk(
+    info: dict,
+    descriptors: dict,
+    exclude_unclassified: bool,
+    generate_bse: bool,
+    scale: int,
+    read_ahead: int,
+    read_ahead_mb: float,
+    bse_levels: bool,
+    fields,
+):
+    """Pool task compositing a chunk of fields onto canvases shared with the parent.
+
+    Returns the (field_name, FieldStats) pairs and the metrics of the chunk.
+    """
+    metrics = SampleMetrics()
+    handles = []
+    canvases = {}
+    for name, descriptor in descriptors.items():
+        if descriptor is None:
+            canvases[name] = None
+            continue
+        canvases[name], handle = attach_canvas(descriptor)
+        handles.append(handle)
 
-        if not xml_path:
-            logger.warning(
-                "phases.xml was not found in {} or the directory does not exist.",
-                mindif_path,
+    try:
+        results = list(
+            composite_fields(
+                info,
+                fields,
+                canvases,
+                exclude_unclassified,
+                generate_bse,
+                scale,
+                metrics,
+                read_ahead,
+                read_ahead_mb,
+                bse_levels,
             )
-            return
+        )
+        return results, metrics.worker_record()
+    finally:
+        del canvases
+        for handle in handles:
+            detach_canvas(handle)
+
+
+def composite_fields_in_pool(
+    pool,
+    processes: int,
+    info: dict,
+    fields,
+    store,
+    canvases: dict,
+    exclude_unclassified: bool,
+    generate_bse: bool,
+    scale: int = 1,
+    metrics: SampleMetrics = None,
+    read_ahead: int = 0,
+    read_ahead_mb: float = None,
+    bse_levels: bool = False,
+):
+    """Composite fields of a sample with the workers of pool.
+
+    The canvases must have been created by store in shared memory or as memory mapped
+    files. Yields the (field_name, FieldStats) pairs in fields.xml order, every field as
+    soon as it and all the fields before it are done. The metrics of the workers are
+    merged into metrics.
+    """
+    descriptors = {
+        name: store.describe(name) if canvas is not None else None
+        for name, canvas in canvases.items()
+    }
+    image_size = (info["image_width_px"], info["image_height_px"])
+    task = partial(
+        composite_field_chunk,
+        info,
+        descriptors,
+        exclude_unclassified,
+        generate_bse,
+        scale,
+        read_ahead,
+        read_ahead_mb,
+        bse_levels,
+    )
 
-        phases_xml_path = os.path.join(xml_path, "phases.xml")
-        phases_xml = ET.parse(phases_xml_path)
-        phase_nodes = phases_xml.getroot().find(
-            "{0}PrimaryPhases".format(XML_NAMESPACE)
+    chunk_results = {}
+    next_index = 0
+    for wave in field_waves(fields, image_size, processes * 4, scale):
+        indices = [index for index, _ in wave]
+        for index, (results, record) in zip(
+            indices, pool.map(task, [chunk for _, chunk in wave])
+        ):
+            chunk_results[index] = results
+            if metrics is not None:
+                metrics.merge(record)
+        while next_index in chunk_results:
+            yield from chunk_results.pop(next_index)
+            next_index += 1
+
+
+def field_waves(fields, image_size, chunk_count: int, scale: int = 1):
+    """Split fields into chunks and group the chunks into waves.
+
+    Chunks are runs of consecutive fields in fields.xml order. The chunks of one wave do
+    not overlap each other on the canvas, and a chunk is always in a later wave than any
+    earlier chunk it overlaps, so compositing the waves in order with the chunks of a wave
+    in parallel gives the same canvas as compositing the fields one after another. Every
+    wave is a list of (chunk index, chunk) pairs. Fields are compared by the blocks they
+    cover on a canvas reduced by scale.
+    """
+    chunk_size = max(1, int(math.ceil(len(fields) / float(max(1, chunk_count)))))
+    chunks = [fields[i : i + chunk_size] for i in range(0, len(fields), chunk_size)]
+    rects = [
+        np.array(
+            [
+                (
+                    x // scale,
+                    y // scale,
+                    -(-(x + image_size[0]) // scale),
+                    -(-(y + image_size[1]) // scale),
+                )
+                for _, x, y in chunk
+            ]
         )
-        largest_name_width = 0
-        phase_map = {}
+        for chunk in chunks
+    ]
+
+    levels = []
+    for index, rect in enumerate(rects):
+        level = 0
+        for other in range(index):
+            if levels[other] < level:
+                continue
+            overlaps = (
+                (rect[:, None, 0] < rects[other][None, :, 2])
+                & (rects[other][None, :, 0] < rect[:, None, 2])
+                & (rect[:, None, 1] < rects[other][None, :, 3])
+                & (rects[other][None, :, 1] < rect[:, None, 3])
+            )
+            if overlaps.any():
+                level = levels[other] + 1
+        levels.append(level)
 
-        logger.debug("Extracting phases from {}", phases_xml_path)
-        for phase_node in phase_nodes:
-            mineral_name = phase_node.get("name")
+    waves = [[] for _ in range(max(levels, default=-1) + 1)]
+    for index, (level, chunk) in enumerate(zip(levels, chunks)):
+        waves[level].append((index, chunk))
+    return waves
 
-            if (
-                mineral_name == "[Unclassified]"
-                or phase_node.get("background") == "yes"
-            ) and exclude_unclassified:
-                logger.debug("Excluding mineral {}", mineral_name)
-                continue
 
-            phase_id: str = phase_node.get("id", None)
-            if phase_id is None:
-                logger.wanring(f"Phase node {phase_node} is missing ID")
-                continue
+def estimate_sample(
+    dataset: dict,
+    generate_bse: bool,
+    generate_id_array: bool,
+    create_thumbnail: bool,
+    scale: int = 1,
+    memory_budget_mb: float = None,
+    read_ahead: int = DEFAULT_READ_AHEAD,
+    read_ahead_mb: float = DEFAULT_READ_AHEAD_MB,
+) -> dict:
+    """Estimate the work and the peak memory of a sample from a record of read_dataset.
+
+    Returns a dict with the cost, the number of pixels decoded and written, and
+    memory_mb, the rough peak memory in MB of the worker that processes the sample.
+    """
+    if dataset is None or not dataset["xml_path"]:
+        return {"cost": 0, "memory_mb": WORKER_BASE_MB}
+    measurement = dataset["measurement"]
+    width, height = sample_canvas_size(measurement)
+    mosaic_pixels = math.ceil(width / scale) * math.ceil(height / scale)
+    field_pixels = measurement["image_width_px"] * measurement["image_height_px"]
+    field_count = len(dataset["fields"] or [])
+
+    pixel_bytes = 3
+    if generate_bse:
+        pixel_bytes += 2
+    if generate_id_array:
+        max_phase_id = max(
+            (int(phase["id"]) for phase in dataset["phases"] if phase["id"] is not None),
+            default=0,
+        )
+        pixel_bytes += id_array_dtype(max_phase_id)[0].itemsize
+    canvas_bytes = mosaic_pixels * pixel_bytes
+    if memory_budget_mb is not None and canvas_bytes > memory_budget_mb * 1024 * 1024:
+        # The canvases are memory mapped, the worker keeps about its budget resident.
+        canvas_bytes = memory_budget_mb * 1024 * 1024
+    elif create_thumbnail:
+        # The thumbnail starts from a copy of the classified part of the canvas.
+        canvas_bytes += mosaic_pixels * 6
+
+    # The decoded fields read ahead, plus the current field and its temporaries.
+    field_bytes = field_pixels * (7 if generate_bse else 5)
+    fields_ahead = read_ahead
+    if read_ahead_mb is not None:
+        fields_ahead = min(fields_ahead, int(read_ahead_mb * 1024 * 1024 // field_bytes))
+    fields_bytes = field_bytes * (max(fields_ahead, 0) + 2)
+
+    return {
+        "cost": field_count * field_pixels + mosaic_pixels,
+        "memory_mb": WORKER_BASE_MB + (canvas_bytes + fields_bytes) / (1024 * 1024),
+    }
+
+
+def run_sample_task(task):
+    """Run the (index, func, sample) task of process_samples in a worker.
+
+    Returns the index and the metrics record of the sample. An unexpected error fails
+    the sample instead of the whole run.
+    """
+    index, func, sample = task
+    try:
+        return index, func(sample)
+    except Exception as error:
+        logger.exception("Sample: {} failed", sample[1])
+        record = SampleMetrics(sample[1], sample[0]).finish("failed")
+        record["error"] = repr(error)
+        return index, record
+
+
+def process_samples(pool, tasks, estimates, pool_memory_mb, processes: int):
+    """Run the (func, sample) tasks on pool, largest first and within pool_memory_mb.
+
+    pool_memory_mb defaults to a share of the physical memory. Returns the metrics
+    records of the samples, in the order of tasks.
+    """
+    if pool_memory_mb is None:
+        pool_memory_mb = default_pool_memory_mb()
+    if pool_memory_mb is not None:
+        logger.info("Scheduling samples largest first within {:.0f} MB", pool_memory_mb)
+    gate = MemoryGate(pool_memory_mb, processes)
+    records = [None] * len(tasks)
+    try:
+        for index, record in pool.imap_unordered(
+            run_sample_task,
+            gate.admit(
+                (
+                    (index, tasks[index][1][1]),
+                    (index,) + tuple(tasks[index]),
+                    estimates[index]["memory_mb"],
+                )
+                for index in largest_first(range(len(tasks)), estimates)
+            ),
+        ):
+            gate.release((index, record["sample_name"]))
+            records[index] = record
+    finally:
+        # Lets the task thread of the pool go if processing stopped early.
+        gate.close()
+    return records
 
-            largest_name_width = max(largest_name_width, font.getsize(mineral_name)[0])
 
-            colour_str = phase_node.get("color")
+def choose_parallelism(parallelism: str, sample_count: int, processes: int) -> str:
+    """Decide whether the pool works on whole samples or on the fields of one sample."""
+    if parallelism != "auto":
+        return parallelism
+    return "sample" if sample_count >= processes else "field"
 
-            phase_map[int(phase_id)] = {
-                "mineral_name": mineral_name,
-                "colour": (
-                    int(colour_str[1:3], 16),
-                    int(colour_str[3:5], 16),
-                    int(colour_str[5:7], 16),
-                ),
-                "colour_hex": colour_str,
-                "mass": float(phase_node.get("mass")) if "mass" in phase_node else -1,
-                "histogram": 0,
-            }
 
-        empty_phase_map = copy.deepcopy(phase_map)
+def create_sample(
+    mindif_root: str,
+    output_root: str,
+    exclude_unclassified: bool,
+    show_low_val: bool,
+    create_thumbnail: bool,
+    generate_id_array: bool,
+    generate_bse: bool,
+    guid_and_sample_name,
+    scratch_dir: str = None,
+    memory_budget_mb: float = None,
+    id_array_format: str = "csv",
+    field_pool=None,
+    field_processes: int = 1,
+    mosaic_format: str = "png",
+    pyramid: bool = False,
+    pyramid_resampling: str = "mode",
+    scale: int = 1,
+    modal_tables: bool = False,
+    checkpoint_every: int = 0,
+    index_path: str = None,
+    encoding: str = DEFAULT_ENCODING_PROFILE,
+    encode_threads: int = 1,
+    read_ahead: int = DEFAULT_READ_AHEAD,
+    read_ahead_mb: float = DEFAULT_READ_AHEAD_MB,
+    bse_normalise: bool = False,
+    roi=None,
+    roi_units: str = "um",
+):
+    """Process one sample and return the record of its metrics.
 
-        # Extract information from measurement.xml and create the mindif record:
-        measurement_xml_path = os.path.join(xml_path, "measurement.xml")
-        measurement_xml = ET.parse(measurement_xml_path)
-        measurement_nodes = measurement_xml.getroot()
+    With a roi, an (x, y, width, height) region in roi_units, only the fields in that
+    region are processed, into outputs named after it.
+    """
+    # The Sample API is built on this module.
+    from .sample import Sample
 
-        measurement_guid = measurement_nodes.findtext("{0}Id".format(XML_NAMESPACE))
-        measurement_guid = re.sub("[^[a-f0-9]", "", measurement_guid)
+    start = time.time()
+    guid = guid_and_sample_name[0]
+    sample_name = guid_and_sample_name[1]
+    metrics = SampleMetrics(sample_name, guid)
 
-        software_version = measurement_nodes.findtext("{0}Origin".format(XML_NAMESPACE))
-        logger.debug("Tima Software Version: {}", software_version)
+    logger.debug("Sample: {} started processing", sample_name)
 
-        view_field_um = int(
-            measurement_nodes.findtext("{0}ViewField".format(XML_NAMESPACE))
-        )
-        image_width_px = int(
-            measurement_nodes.findtext("{0}ImageWidth".format(XML_NAMESPACE))
-        )
-        image_height_px = int(
-            measurement_nodes.findtext("{0}ImageHeight".format(XML_NAMESPACE))
-        )
-        sample_shape = measurement_nodes.find(
-            "{}SampleDef".format(XML_NAMESPACE)
-        ).findtext("{0}SampleShape".format(XML_NAMESPACE))
-
-        if sample_shape == "Rectangle":
-            sample_width_um = int(
-                measurement_nodes.find("{}SampleDef".format(XML_NAMESPACE)).findtext(
-                    "{0}SampleWidth".format(XML_NAMESPACE)
-                )
-            )
-            sample_height_um = int(
-                measurement_nodes.find("{}SampleDef".format(XML_NAMESPACE)).findtext(
-                    "{0}SampleHeight".format(XML_NAMESPACE)
-                )
-            )
-            sample_width_px = int(
-                (sample_width_um / float(view_field_um)) * image_width_px
-            )
-            sample_height_px = int(
-                (sample_height_um / float(view_field_um)) * image_height_px
-            )
-            field_size = (sample_width_px, sample_height_px)
+    status = "completed"
+    store = None
+    keep_checkpoint = False
+    png_array = bse_png_array = phase_id_array = canvases = field_results = None
+    stream_writers = []
+    try:
+        # Previews and regions get names of their own, so they never stop the full
+        # resolution images of the whole sample from being generated later.
+        output_name = sample_name
+        if roi is not None:
+            output_name = roi_name(sample_name, roi, roi_units)
+        if scale != 1:
+            output_name = "{}_scale{}".format(output_name, scale)
+        thumbnail_path = os.path.join(output_root, output_name + ".thumbnail.png")
+        mosaic_extension = ".tif" if mosaic_format == "tiff" else ".png"
+        classification_path = os.path.join(output_root, output_name + mosaic_extension)
+        legend_path = os.path.join(output_root, output_name + ".legend.png")
+        bse_path = os.path.join(output_root, output_name + "_bse" + mosaic_extension)
+        id_path = id_array_path(output_root, output_name, id_array_format)
+        pyramid_path = os.path.join(output_root, output_name)
+        bse_pyramid_path = os.path.join(output_root, output_name + "_bse")
+        output_paths = {
+            "classification": [classification_path]
+            + ([legend_path] if mosaic_format == "tiff" else []),
+            "bse": [bse_path],
+            "id_array": id_array_paths(output_root, output_name, id_array_format),
+            "thumbnail": [thumbnail_path],
+            "pyramid": [pyramid_path + ".dzi", pyramid_path + "_files"],
+            "bse_pyramid": [bse_pyramid_path + ".dzi", bse_pyramid_path + "_files"],
+            "modal": list(modal_table_paths(output_root, output_name)),
+        }
 
-        else:
-            # Must be a circle
-            sample_diameter_um = int(
-                measurement_nodes.find("{}SampleDef".format(XML_NAMESPACE)).findtext(
-                    "{0}SampleDiameter".format(XML_NAMESPACE)
+        white = (255, 255, 255)
+        profile = encoding_profile(encoding)
+
+        layout = legend_layout(scale)
+        font = layout["font"]
+        font_size = layout["font_size"]
+        legend_text_y_offset = layout["text_y_offset"]
+        legend_line_height = layout["line_height"]
+        legend_text_x_offset = layout["text_x_offset"]
+
+        with metrics.stage("metadata"):
+            dataset = cached_dataset(index_path, guid) if index_path else None
+            if dataset is not None:
+                info = sample_info_from_dataset(
+                    dataset, sample_name, exclude_unclassified
                 )
-            )
-            diameter_px = int(
-                (sample_diameter_um / float(view_field_um)) * image_width_px
-            )
-            field_size = (diameter_px, diameter_px)
+            else:
+                info = read_sample_info(
+                    mindif_root, guid, sample_name, exclude_unclassified
+                )
+            if info is not None and roi is not None:
+                info = roi_info(info, roi_box(info, roi, roi_units))
+            if info is not None:
+                fingerprints = input_fingerprints(info)
+        if info is None:
+            return metrics.finish("missing")
+
+        # Work out from the manifest which of the requested outputs are missing or were
+        # made from other inputs or options.
+        options = {
+            "exclude_unclassified": exclude_unclassified,
+            "show_low_val": show_low_val,
+            "scale": scale,
+            "mosaic_format": mosaic_format,
+            "id_array_format": id_array_format,
+            "pyramid_resampling": pyramid_resampling,
+            "bse_normalise": bse_normalise,
+        }
+        requested = {
+            "classification": True,
+            "bse": generate_bse,
+            "id_array": generate_id_array,
+            "thumbnail": create_thumbnail,
+            "pyramid": pyramid,
+            "bse_pyramid": pyramid and generate_bse,
+            "modal": modal_tables,
+        }
+        output_keys = {
+            kind: output_key(kind, fingerprints, options)
+            for kind, wanted in requested.items()
+            if wanted
+        }
+        manifest = SampleManifest(output_root, output_name)
+        pending = [
+            kind for kind, key in output_keys.items() if not manifest.is_current(kind, key)
+        ]
+        if not pending:
+            logger.info("skipping {} because its outputs are up to date.", sample_name)
+            return metrics.finish("skipped")
+        if len(pending) < len(output_keys):
+            logger.info("Sample: {} generating {}", sample_name, ", ".join(pending))
+
+        write_classification = "classification" in pending
+        write_bse = "bse" in pending
+        generate_bse = write_bse or "bse_pyramid" in pending
+        generate_id_array = "id_array" in pending
+        create_thumbnail = "thumbnail" in pending
+        modal_tables = "modal" in pending
+
+        sample = Sample(
+            info,
+            exclude_unclassified,
+            scale,
+            generate_bse,
+            read_ahead,
+            read_ahead_mb,
+            bse_normalise,
+        )
+        phase_map = info["phase_map"]
+        # Size of the mosaic on the canvas, the fields themselves keep their full
+        # resolution positions.
+        field_size = sample.mosaic_size
+        pixel_spacing = sample.pixel_spacing
+        fields = sample.fields
+        largest_name_width = max(
+            (text_width(font, phase["mineral_name"]) for phase in phase_map.values()),
+            default=0,
+        )
 
         # To right-align the numeric values we use "< 0.01" as the longest string then work out the offset
         # from that.
-        max_numeric_width = font.getsize("<0.01")[0]
-        legend_start_x = int(math.ceil(field_size[0] + 30))
+        max_numeric_width = text_width(font, "<0.01")
+        legend_start_x = int(math.ceil(field_size[0] + 30 / scale))
 
         # this is the x value that the numeric value must STOP at.
         percent_right_x = (
@@ -387,192 +1546,239 @@ def create_sample(
             - font_size
         )
         canvas_size = (percent_right_x, field_size[1])
-        # outline_thickness = math.ceil(field_size[0] / 1000)
-        origin = (field_size[0] / 2, field_size[1] / 2)
-        pixel_spacing = float(view_field_um) / float(image_width_px)
 
-        # Extract the field information from fields.xml:
-        fields_xml_path = os.path.join(xml_path, "fields.xml")
-        fields_xml = ET.parse(fields_xml_path)
-        fields_xml_root = fields_xml.getroot()
-        field_nodes = fields_xml_root.find("{}Fields".format(XML_NAMESPACE))
-        field_dir = fields_xml_root.findtext("{}FieldDir".format(XML_NAMESPACE))
-
-        fields = []
-        if field_nodes is not None:
-            for field_node in field_nodes:
-                field_name = field_node.get("name")
-
-                # The x and y values are the offset from the origin.
-                # TIMA uses +x to mean left, which is opposite to monitor coordinate system,
-                # so this value gets inverted.
-                # and       +y to mean down, which is the same as monitor coordinate system,
-                # so this value doesn't get inverted.
-                x = math.floor(
-                    -float(field_node.get("x")) / pixel_spacing
-                    + origin[0]
-                    - (image_width_px / 2)
-                )
-                y = math.floor(
-                    float(field_node.get("y")) / pixel_spacing
-                    + origin[1]
-                    - (image_height_px / 2)
+        # Prepare new canvas:
+        if mosaic_format == "tiff":
+            # The legend goes into an image of its own next to the mosaic.
+            png_shape = (field_size[1], field_size[0], 3)
+        else:
+            png_shape = (canvas_size[1], canvas_size[0], 3)
+        mosaic_shape = (field_size[1], field_size[0])
+        canvas_bytes = canvas_nbytes(png_shape, np.uint8)
+        if generate_bse:
+            canvas_bytes += canvas_nbytes(mosaic_shape, sample.bse_dtype)
+        if generate_id_array:
+            id_dtype, id_nodata = sample.label_dtype, sample.label_nodata
+            canvas_bytes += canvas_nbytes(mosaic_shape, id_dtype)
+
+        done_fields = []
+        if checkpoint_every:
+            # Checkpointed canvases are always memory mapped, in a directory of their own
+            # that outlives a killed run.
+            checkpoint_path = os.path.join(
+                scratch_dir or os.path.join(output_root, ".checkpoints"), output_name
+            )
+            canvas_layout = {"classification": [png_shape, "uint8"]}
+            if generate_bse:
+                canvas_layout["bse"] = [mosaic_shape, sample.bse_dtype.name]
+            if generate_id_array:
+                canvas_layout["id_array"] = [mosaic_shape, id_dtype.name]
+            run_key = checkpoint_key(fingerprints, options, canvas_layout)
+            done_fields = load_checkpoint(checkpoint_path, run_key) or []
+            store = CanvasStore(path=checkpoint_path, shared=field_pool is not None)
+            keep_checkpoint = True
+            if done_fields:
+                logger.info(
+                    "Sample: {} resuming after {} of {} fields",
+                    sample_name,
+                    len(done_fields),
+                    len(fields),
                 )
-
-                fields.append((field_name, x, y))
         else:
-            logger.warning(
-                "{}, {}  does not have any Fields in the fields.xml file",
-                guid,
+            store = open_canvas_store(
+                canvas_bytes,
+                memory_budget_mb,
+                scratch_dir,
+                prefix="tima_{}_".format(guid),
+                shared=field_pool is not None,
+            )
+        if store.out_of_core:
+            logger.info(
+                "Sample: {} canvases need {:.0f} MB, using memory mapped files in {}",
                 sample_name,
+                canvas_bytes / (1024 * 1024),
+                store.scratch_path,
             )
 
-        # Prepare new canvas:
-        png = Image.new("RGB", canvas_size, white)
-        png_array = png.load()
+        # The canvases of a checkpoint are reused as they are.
+        resume = bool(done_fields)
+        png_array = store.full("classification", png_shape, white, np.uint8, resume)
 
         if generate_bse:
-            bse_png = Image.new("I;16", field_size, 65535)
-            bse_png_array = bse_png.load()
+            bse_png_array = store.full(
+                "bse", mosaic_shape, sample.bse_nodata, sample.bse_dtype, resume
+            )
 
         if generate_id_array:
-            phase_id_array = np.full(field_size, -1)
+            phase_id_array = store.full(
+                "id_array", mosaic_shape, id_nodata, id_dtype, resume
+            )
 
-        classified_pixel_count = 0
+        canvases = {
+            "classification": png_array,
+            "bse": bse_png_array,
+            "id_array": phase_id_array,
+        }
 
-        field_path_format = os.path.join(xml_path, field_dir, "{0}", "{1}")
+        if not os.path.exists(output_root):
+            os.makedirs(output_root)
 
-        thumbnail_x_min = 1000000000
-        thumbnail_x_max = -1
-        thumbnail_y_min = 1000000000
-        thumbnail_y_max = -1
+        if mosaic_format == "tiff":
+            tiff_metadata = {
+                "sample_name": sample_name,
+                "guid": guid,
+                "pixel_spacing_um": pixel_spacing,
+                "view_field_um": info["view_field_um"],
+                "image_width_px": info["image_width_px"],
+                "scale": scale,
+            }
+            if write_classification:
+                stream_writers.append(
+                    (
+                        "classification",
+                        TiledTiffWriter(
+                            classification_path,
+                            png_array,
+                            compress_level=profile["tiff_compress_level"],
+                            pixel_spacing_um=pixel_spacing,
+                            metadata=tiff_metadata,
+                            threads=encode_threads,
+                        ),
+                    )
+                )
+            if write_bse:
+                stream_writers.append(
+                    (
+                        "bse",
+                        TiledTiffWriter(
+                            bse_path,
+                            bse_png_array,
+                            compress_level=profile["tiff_compress_level"],
+                            pixel_spacing_um=pixel_spacing,
+                            metadata=tiff_metadata,
+                            threads=encode_threads,
+                        ),
+                    )
+                )
 
-        for field_name, field_x, field_y in fields:
-            field_phase_map = copy.deepcopy(empty_phase_map)
-            has_missing_file = False
-            has_missing_bse = False
-            try:
-                phases = Image.open(field_path_format.format(field_name, "phases.tif"))
-            except Exception:
-                logger.error(
-                    "Error: {}, {}, field {} does not have phases.tif",
-                    guid,
-                    sample_name,
-                    field_name,
+        if "pyramid" in pending:
+            # The pyramid covers the mosaic only, not the legend next to it.
+            stream_writers.append(
+                (
+                    "pyramid",
+                    DeepZoomWriter(
+                        pyramid_path,
+                        png_array[:, : field_size[0]],
+                        resampling=pyramid_resampling,
+                    ),
+                )
+            )
+        if "bse_pyramid" in pending:
+            stream_writers.append(
+                (
+                    "bse_pyramid",
+                    DeepZoomWriter(bse_pyramid_path, bse_png_array, categorical=False),
                 )
+            )
+
+        # Rows above the top of every field that is still to come are final and can be
+        # streamed out by the TIFF and pyramid writers. A normalised BSE mosaic is only
+        # final once the levels of all the fields are known.
+        streamed_kinds = [
+            kind
+            for kind, _ in stream_writers
+            if not (bse_normalise and kind in ("bse", "bse_pyramid"))
+        ]
+        final_rows = [field_size[1]] * len(fields)
+        for index in range(len(fields) - 2, -1, -1):
+            final_rows[index] = min(
+                final_rows[index + 1], max(0, fields[index + 1][2] // scale)
+            )
+
+        field_results = sample.composite(
+            canvases,
+            fields[len(done_fields) :],
+            metrics,
+            field_pool,
+            field_processes,
+            store,
+        )
+
+        sample_histogram = np.zeros(info["max_phase_id"] + 1, dtype=np.int64)
+        classified_pixel_count = 0
+        thumbnail_bbox = None
+        has_missing_file = False
+        # Kept for the checkpoints and the modal tables, the stats are small compared to
+        # the fields. The fields of a checkpoint are replayed from their stats.
+        completed_fields = []
+
+        for index, (field_name, field_stats) in enumerate(
+            itertools.chain(done_fields, field_results)
+        ):
+            completed_fields.append((field_name, field_stats))
+            if (
+                checkpoint_every
+                and index >= len(done_fields)
+                and (index + 1) % checkpoint_every == 0
+                and index + 1 < len(fields)
+            ):
+                with metrics.stage("checkpoint"):
+                    store.flush()
+                    save_checkpoint(store.scratch_path, run_key, completed_fields)
+
+            for kind, writer in stream_writers:
+                if kind in streamed_kinds:
+                    with metrics.stage("write_" + kind):
+                        writer.write_rows_until(final_rows[index])
+
+            if field_stats is None:
                 has_missing_file = True
+                continue
 
-            try:
-                mask = Image.open(field_path_format.format(field_name, "mask.png"))
-            except Exception:
+            if field_stats.unknown_count > 0:
                 logger.error(
-                    "Error: {}, {}, field {} does not have mask.png",
-                    guid,
-                    sample_name,
-                    field_name,
+                    f"Phase index {field_stats.unknown_ids[0]} is missing in sample: {sample_name}, guid: {guid}, field: {field_name}\nPlease Check your phases file {info['phases_xml_path']}\nNote you will only see this error once per sample"
                 )
-                has_missing_file = True
-
-            if generate_bse:
-                try:
-                    bse = Image.open(field_path_format.format(field_name, "bse.png"))
-                    bse_array = bse.load()
-                except Exception:
-                    logger.error(
-                        "Error: {}, {}, field {} does not have bse.png",
-                        guid,
-                        sample_name,
-                        field_name,
-                    )
-                    has_missing_bse = True
+                logger.debug(phase_map)
 
-            if has_missing_file:
-                continue
+                if field_stats.unknown_count > MAX_UNKNOWN_PHASE_PIXELS:
+                    raise SampleError()
 
-            phases_array = phases.load()
-            mask_array = mask.load()
-            # if field_y == 2050:
-            #     print("Mask is 0")
-            unk_count = 0
-            error_count = 0
-
-            for y in range(0, image_height_px):
-                for x in range(0, image_width_px):
-                    try:
-                        phase_index: int = int(phases_array[x, y])
-
-                        mask_index = mask_array[
-                            x, y
-                        ]  # For some reason mask is reversed
-                        png_x = x + field_x
-                        png_y = y + field_y
-
-                        if generate_bse and not has_missing_bse:
-                            bse_png_array[png_x, png_y] = bse_array[x, y]
-
-                        if phase_index == 0 and mask_index != 0:
-                            unk_count += 1
-
-                        if (
-                            phase_index != 0 or not exclude_unclassified
-                        ) and mask_index != 0:
-                            if phase_map.get(phase_index, None) is None:
-                                error_count += 1
-                                if error_count == 1:
-                                    logger.error(
-                                        f"Phase index {phase_index} is missing in sample: {sample_name}, guid: {guid}, field: {field_name}\nPlease Check your phases file {phases_xml_path}\nNote you will only see this error once per sample"
-                                    )
-
-                                if error_count == 1:
-                                    logger.debug(phase_map)
-
-                                if error_count > 25:
-                                    raise SampleError()
-
-                                continue
-
-                            png_array[png_x, png_y] = phase_map[phase_index]["colour"]
-
-                            if generate_id_array:
-                                phase_id_array[y + field_y, x + field_x] = phase_index
-
-                            thumbnail_x_min = min(thumbnail_x_min, png_x)
-                            thumbnail_x_max = max(thumbnail_x_max, png_x)
-                            thumbnail_y_min = min(thumbnail_y_min, png_y)
-                            thumbnail_y_max = max(thumbnail_y_max, png_y)
-
-                            classified_pixel_count += 1
-                            phase_map[phase_index]["histogram"] += 1
-                            field_phase_map[phase_index]["histogram"] += 1
-                    except IndexError:
-                        logger.error(
-                            "Index out of bounds in phase/mask loop x: {} y: {}", x, y
-                        )
-                        break
-
-            if error_count > 0:
                 logger.warning(
-                    f"Skipped {error_count} pixels for {sample_name} due to errors."
+                    f"Skipped {field_stats.unknown_count} pixels for {sample_name} due to errors."
                 )
+
+            sample_histogram[: len(field_stats.histogram)] += field_stats.histogram
+            classified_pixel_count += field_stats.classified_count
+            thumbnail_bbox = merge_bbox(thumbnail_bbox, field_stats.bbox)
+
             UNK_THRESHOLD_PC = 15
-            UNK_THRESHOLD = int(x * y * (UNK_THRESHOLD_PC / 100))  # 15%
-            if unk_count > UNK_THRESHOLD:
+            UNK_THRESHOLD = int(
+                (info["image_width_px"] - 1)
+                * (info["image_height_px"] - 1)
+                * (UNK_THRESHOLD_PC / 100)
+            )  # 15%
+            if field_stats.unclassified_count > UNK_THRESHOLD:
                 logger.debug(
                     f"Sample: {sample_name} Field: {field_name} GUID: {guid} contains greater than {UNK_THRESHOLD_PC}% of Unclassified."
                 )
-            # Once all the pixels have been dealt with we can create the insert commands for this field:
-            field_phase_map = {
-                k: v for k, v in field_phase_map.items() if v["histogram"] != 0
-            }
-
-            field_phase_map = sorted(
-                field_phase_map.items(), key=lambda x: x[1]["histogram"], reverse=True
-            )
 
         if has_missing_file:
             logger.warning("Warning: sample {} is missing fields.", sample_name)
             # return
 
+        if generate_bse and bse_normalise:
+            if checkpoint_every:
+                # The canvas stops holding the fields as the checkpoint has them.
+                discard_checkpoint(store.scratch_path)
+            with metrics.stage("bse_normalise"):
+                sample.normalise(
+                    bse_png_array, [field_stats for _, field_stats in completed_fields]
+                )
+
+        histogram_to_phase_map(phase_map, sample_histogram)
+        full_phase_map = phase_map
+
         # Remove phase_map entries where histogram == 0
         phase_map = {k: v for k, v in phase_map.items() if v["histogram"] != 0}
 
@@ -581,89 +1787,204 @@ def create_sample(
             phase_map.items(), key=lambda x: x[1]["histogram"], reverse=True
         )
 
-        draw = ImageDraw.Draw(png)
-        draw.text(
-            (legend_start_x, 5), sample_name, black, font=sample_name_font,
-        )
-        y = legend_text_y_offset
-        for id, phase_map_entry in phase_map:
-            if not show_low_val and (
-                (float(phase_map_entry["histogram"]) / classified_pixel_count * 100)
-                < 0.01
-            ):
-                continue
-
-            draw.rectangle(
-                [
-                    (legend_start_x, y),
-                    (legend_start_x + legend_line_height, y + legend_line_height),
-                ],
-                fill=phase_map_entry["colour"],
-            )
-            draw.text(
-                (legend_start_x + legend_text_x_offset, y),
-                phase_map_entry["mineral_name"],
-                black,
-                font=font,
+        with metrics.stage("legend"):
+            # The legend is drawn on a copy of the part of the canvas it covers, which
+            # is written back afterwards, so the canvas itself never has to become a
+            # PIL image.
+            legend_origin_x = field_size[0]
+            legend_height = min(
+                canvas_size[1],
+                legend_text_y_offset + (len(phase_map) + 1) * legend_line_height,
             )
-            text = get_percent_text(
-                float(phase_map_entry["histogram"]) / classified_pixel_count * 100
-            )
-            draw.text(
-                (percent_right_x - font.getsize(text)[0], y), text, black, font=font
+            if mosaic_format == "tiff":
+                legend_png = Image.new(
+                    "RGB", (canvas_size[0] - legend_origin_x, legend_height), white
+                )
+            else:
+                legend_png = Image.fromarray(
+                    np.array(png_array[:legend_height, legend_origin_x:]), "RGB"
+                )
+            legend_start_x -= legend_origin_x
+            percent_right_x -= legend_origin_x
+
+            draw_legend(
+                legend_png,
+                layout,
+                sample_name,
+                phase_map,
+                classified_pixel_count,
+                show_low_val,
+                legend_start_x,
+                percent_right_x,
             )
-            y += legend_line_height
 
-        if not os.path.exists(output_root):
-            os.makedirs(output_root)
+            if mosaic_format == "tiff":
+                if write_classification:
+                    write_atomically(legend_path, legend_png.save)
+                    logger.debug(
+                        "Sample: {} legend saved to {}", sample_name, legend_path
+                    )
+            else:
+                png_array[:legend_height, legend_origin_x:] = np.asarray(legend_png)
+            del legend_png
 
-        if create_thumbnail:
-            thumbnail_bbox = (
-                int(thumbnail_x_min),
-                int(thumbnail_y_min),
-                int(thumbnail_x_max),
-                int(thumbnail_y_max),
+        if create_thumbnail and thumbnail_bbox is None:
+            logger.warning(
+                "Sample: {} has no classified pixels, not creating a thumbnail",
+                sample_name,
             )
-            thumbnail_png = png.crop(thumbnail_bbox)
-            thumbnail_png.load()
-            thumbnail_png.thumbnail((300, 300), Image.ANTIALIAS)
-            thumbnail_png.save(thumbnail_path)
-            logger.debug(
-                "Sample: {} thumbnail saved to {}", sample_name, thumbnail_path
+        elif create_thumbnail:
+            with metrics.stage("write_thumbnail"):
+                thumbnail_array = png_array[
+                    thumbnail_bbox[1] : thumbnail_bbox[3],
+                    thumbnail_bbox[0] : thumbnail_bbox[2],
+                ]
+                if store.out_of_core:
+                    # Subsample before handing the crop to PIL, the full resolution crop
+                    # may not fit in memory. The step leaves plenty of pixels for the
+                    # antialias filter.
+                    step = max(1, min(thumbnail_array.shape[:2]) // 1200)
+                    thumbnail_array = thumbnail_array[::step, ::step]
+                thumbnail_png = Image.fromarray(np.array(thumbnail_array), "RGB")
+                del thumbnail_array
+                thumbnail_png.thumbnail((300, 300), Image.LANCZOS)
+                write_atomically(thumbnail_path, thumbnail_png.save)
+                logger.debug(
+                    "Sample: {} thumbnail saved to {}", sample_name, thumbnail_path
+                )
+                del thumbnail_png
+        if create_thumbnail:
+            manifest.record(
+                "thumbnail",
+                output_keys["thumbnail"],
+                output_paths["thumbnail"] if thumbnail_bbox is not None else [],
             )
-            del thumbnail_png
 
         # Add the circle to the original image and save
         # draw.arc([0, 0, field_size[0], field_size[1]], 0, 360, black)
-        png.save(classification_path)
-        logger.debug("Sample: {} image saved to {}", sample_name, classification_path)
-
-        if generate_bse:
-            bse_png.save(bse_path)
+        while stream_writers:
+            kind, writer = stream_writers.pop(0)
+            with metrics.stage("write_" + kind):
+                writer.close()
+            manifest.record(kind, output_keys[kind], output_paths[kind])
+        if mosaic_format != "tiff":
+            if write_classification:
+                with metrics.stage("write_classification"):
+                    write_atomically(
+                        classification_path,
+                        write_png,
+                        png_array,
+                        profile["png_compress_level"],
+                        encode_threads,
+                    )
+                manifest.record(
+                    "classification",
+                    output_keys["classification"],
+                    output_paths["classification"],
+                )
+            if write_bse:
+                with metrics.stage("write_bse"):
+                    write_atomically(
+                        bse_path,
+                        write_png,
+                        bse_png_array,
+                        profile["png_compress_level"],
+                        encode_threads,
+                    )
+                manifest.record("bse", output_keys["bse"], output_paths["bse"])
+        if write_classification:
+            logger.debug(
+                "Sample: {} image saved to {}", sample_name, classification_path
+            )
+        if write_bse:
             logger.debug("Sample: {} BSE image saved to {}", sample_name, bse_path)
-            del bse_png
-
-        if generate_id_array:
-            np.savetxt(
-                id_array_path,
-                phase_id_array,
-                fmt="%d",
-                delimiter=",",
-                newline="\n",
-                header="",
-                footer="",
+        if "pyramid" in pending:
+            logger.debug("Sample: {} tile pyramid saved to {}", sample_name, output_root)
+
+        if modal_tables:
+            with metrics.stage("write_modal"):
+                modal_path, field_modal_path = write_modal_tables(
+                    output_root,
+                    output_name,
+                    sample_name,
+                    full_phase_map,
+                    [
+                        (field_name, field_stats)
+                        for field_name, field_stats in completed_fields
+                        if field_stats is not None
+                    ],
+                    info["pixel_spacing"],
+                )
+            manifest.record("modal", output_keys["modal"], output_paths["modal"])
+            logger.debug(
+                "Sample: {} modal mineralogy saved to {} and {}",
+                sample_name,
+                modal_path,
+                field_modal_path,
             )
-            logger.debug("Sample: {} id array saved to {}", sample_name, id_array_path)
 
+        if generate_id_array:
+            id_metadata = {
+                "sample_name": sample_name,
+                "guid": guid,
+                "pixel_spacing_um": pixel_spacing,
+                "view_field_um": info["view_field_um"],
+                "image_width_px": info["image_width_px"],
+                "image_height_px": info["image_height_px"],
+                "scale": scale,
+                "phases": {
+                    str(phase_id): phase["mineral_name"]
+                    for phase_id, phase in full_phase_map.items()
+                },
+                "fields": [
+                    {"name": field_name, "x": field_x, "y": field_y}
+                    for field_name, field_x, field_y in fields
+                ],
+            }
+            with metrics.stage("write_id_array"):
+                write_id_array(
+                    output_root,
+                    output_name,
+                    phase_id_array,
+                    id_nodata,
+                    id_array_format,
+                    id_metadata,
+                )
+            manifest.record("id_array", output_keys["id_array"], output_paths["id_array"])
+            logger.debug("Sample: {} id array saved to {}", sample_name, id_path)
+
+        metrics.add(
+            "bytes_written",
+            path_bytes(
+                itertools.chain.from_iterable(output_paths[kind] for kind in pending)
+            ),
+        )
+        keep_checkpoint = False
         end = time.time()
         logger.info(
             "Sample: {} completed processing in {:.1f} Seconds",
             sample_name,
             end - start,
         )
-        del draw
-        del png
     except SampleError:
+        keep_checkpoint = False
+        status = "failed"
         logger.error(
             f"Exceeded error threshold on Sample: {sample_name} GUID: {guid}, skipping."
         )
+    finally:
+        # Writers still open here belong to a sample that failed.
+        for _, writer in stream_writers:
+            writer.abort()
+        # Drop the canvases before the store removes any scratch files behind them.
+        del png_array, bse_png_array, phase_id_array, canvases, field_results
+        if store is not None:
+            # The checkpoint of a run that was interrupted is kept to resume from.
+            store.close(remove=not keep_checkpoint)
+            if checkpoint_every and not keep_checkpoint and scratch_dir is None:
+                try:
+                    os.rmdir(os.path.join(output_root, ".checkpoints"))
+                except OSError:
+                    # Other samples still have checkpoints there.
+                    pass
+    return metrics.finish(status)
@@ -0,0 +1,194 @@
+# Validation of MinDif exports before they are processed.
+#
+# A field without phases.tif or mask.png, images of another size than measurement.xml
+# declares, fields that lie off the sample canvas and phase IDs missing from phases.xml
+# used to show up deep inside create_sample, the last only once more than
+# MAX_UNKNOWN_PHASE_PIXELS pixels of a field had been composited, throwing away the work
+# done on the sample so far. validate_fields() checks the fields of a sample up front:
+# only phases.tif and mask.png are decoded, the phase IDs under the mask are counted
+# with np.unique the way composite_field() counts them, and bse.png is only opened for
+# its size. Missing images are taken from the field_files of the sample info, which the
+# project index keeps, rather than found by opening them. tima_mindif_processor() runs
+# it for chunks of fields on the worker pool before any sample is processed.
+#
+# Every problem is an issue of level "error", the sample would fail, or "warning", the
+# sample is processed but may look wrong. Only more than MAX_UNKNOWN_PHASE_PIXELS pixels
+# of unknown phases are errors: create_sample leaves a field whose images are missing or
+# cannot be read blank, so those are warnings. The report holds one record per sample.
+
+import os
+import time
+import numpy as np
+from PIL import Image
+from .atomic import write_json
+from .compositing import MAX_UNKNOWN_PHASE_PIXELS, field_window
+from .tiff_reader import decode_image
+
+VALIDATION_CHUNK_FIELDS = 16
+
+
+class ValidationError(Exception):
+    pass
+
+
+def issue(level: str, detail: str, field_name: str = None) -> dict:
+    return {"level": level, "field_name": field_name, "detail": detail}
+
+
+def _read_image(path: str, decode: bool):
+    """The decoded image at path, or its (width, height) if not decode."""
+    if decode:
+        with open(path, "rb") as file:
+            return decode_image(file.read())
+    with Image.open(path) as image:
+        return image.size
+
+
+def validate_fields(info: dict, fields, images, exclude_unclassified: bool):
+    """Check the images of fields, (field_name, x, y) tuples of the sample info.
+
+    images are the names of the images every field needs, phases.tif and mask.png
+    first. Returns a {"field_name", "phase_ids", "unknown_count", "issues"} dict per
+    field, phase_ids being the IDs under the mask that the sample would show.
+    """
+    known = np.array(sorted(info["phase_map"]), dtype=np.int64)
+    image_size = (info["image_width_px"], info["image_height_px"])
+    canvas_width, canvas_height = info["field_size"]
+    results = []
+    for field_name, field_x, field_y in fields:
+        issues = []
+        decoded = {}
+        files = info["field_files"].get(field_name, {})
+        for name in images:
+            decode = name in ("phases.tif", "mask.png")
+            try:
+                if not files.get(name):
+                    raise FileNotFoundError(name)
+                image = _read_image(
+                    info["field_path_format"].format(field_name, name), decode
+                )
+            except FileNotFoundError:
+                detail = "{} is missing".format(name)
+                issues.append(issue("warning", detail, field_name))
+                continue
+            except Exception as error:
+                detail = "{} cannot be read: {}".format(name, error)
+                issues.append(issue("warning", detail, field_name))
+                continue
+            size = (image.shape[1], image.shape[0]) if decode else image
+            if decode:
+                decoded[name] = image
+            if tuple(size) != image_size:
+                issues.append(
+                    issue(
+                        "warning",
+                        "{} is {}x{} pixels, measurement.xml declares {}x{}".format(
+                            name, *size, *image_size
+                        ),
+                        field_name,
+                    )
+                )
+
+        # The fields of a region of interest are cut by its edges on purpose.
+        if "roi" not in info and (
+            field_x < 0
+            or field_y < 0
+            or field_x + image_size[0] > canvas_width
+            or field_y + image_size[1] > canvas_height
+        ):
+            issues.append(
+                issue(
+                    "warning",
+                    "lies partly or wholly outside the {}x{} canvas at {}, {}".format(
+                        canvas_width, canvas_height, field_x, field_y
+                    ),
+                    field_name,
+                )
+            )
+
+        phase_ids = []
+        unknown_count = 0
+        if len(decoded) == 2:
+            phases = decoded["phases.tif"]
+            mask = decoded["mask.png"]
+            height = min(image_size[1], phases.shape[0], mask.shape[0])
+            width = min(image_size[0], phases.shape[1], mask.shape[1])
+            window = field_window(
+                field_x, field_y, (height, width), (canvas_height, canvas_width)
+            )
+            if window is not None:
+                ids = np.asarray(phases[window[0]], dtype=np.int64)
+                candidates = np.asarray(mask[window[0]]) != 0
+                if exclude_unclassified:
+                    candidates &= ids != 0
+                values, counts = np.unique(ids[candidates], return_counts=True)
+                unknown = ~np.isin(values, known)
+                phase_ids = values[~unknown].tolist()
+                unknown_count = int(counts[unknown].sum())
+                if unknown_count:
+                    issues.append(
+                        issue(
+                            "error"
+                            if unknown_count > MAX_UNKNOWN_PHASE_PIXELS
+                            else "warning",
+                            "{} pixels of phases {} missing from phases.xml".format(
+                                unknown_count, values[unknown].tolist()
+                            ),
+                            field_name,
+                        )
+                    )
+        results.append(
+            {
+                "field_name": field_name,
+                "phase_ids": phase_ids,
+                "unknown_count": unknown_count,
+                "issues": issues,
+            }
+        )
+    return results
+
+
+def validate_field_chunk(task):
+    """Run the (position, info, fields, images, exclude_unclassified) task in a worker.
+
+    Returns the position and the results of validate_fields().
+    """
+    position, info, fields, images, exclude_unclassified = task
+    return position, validate_fields(info, fields, images, exclude_unclassified)
+
+
+def sample_report(guid: str, sample_name: str, field_results, issues=()) -> dict:
+    """The report of a sample from the results of its fields and issues of its own."""
+    issues = list(issues)
+    phase_ids = set()
+    for result in field_results:
+        issues.extend(result["issues"])
+        phase_ids.update(result["phase_ids"])
+    levels = {item["level"] for item in issues}
+    status = "ok"
+    if "error" in levels:
+        status = "error"
+    elif "warning" in levels:
+        status = "warning"
+    return {
+        "guid": guid,
+        "sample_name": sample_name,
+        "status": status,
+        "fields": len(field_results),
+        "phase_ids": sorted(phase_ids),
+        "unknown_count": sum(result["unknown_count"] for result in field_results),
+        "issues": issues,
+    }
+
+
+def default_report_path(output_root: str) -> str:
+    return os.path.join(
+        output_root, "tima_validation_{}.json".format(time.strftime("%Y%m%d_%H%M%S"))
+    )
+
+
+def write_report(path: str, reports):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    write_json(path, reports)
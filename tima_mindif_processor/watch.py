@@ -0,0 +1,236 @@
+# Watch mode: process MinDif exports as they land.
+#
+# The instruments export datasets into the MinDif root throughout the day, and every
+# run of the command line tool paid for a new pool and a rescan of the whole project.
+# watch_project() keeps one pool of workers warm and polls instead. The samples of the
+# project are read again only when the project files change (through the project
+# index), and a dataset is handed to the pool once its export is complete: phases.xml,
+# measurement.xml and fields.xml can be read, every field of fields.xml has its
+# phases.tif and mask.png, and none of these files nor the bse.png files changed for
+# settle_s seconds. Datasets that were processed are only looked at again when their
+# XML files change, a new export of them is then processed again.
+#
+# Polling rather than inotify works on network mounts, where the exports usually land.
+# A poll stats the XML files of the processed datasets, and the XML files and field
+# directories of the others. The XML files are parsed again only when they change, and
+# which images a field has is read from its directory only when that changes, the way
+# the project index does it. The images themselves are stat'ed when a field directory
+# changed and once more when the export settled, to tell whether any of them was still
+# being written.
+
+import multiprocessing
+import os
+import threading
+import time
+from loguru import logger
+from .tima_mindif_processor import (
+    FIELD_IMAGES,
+    finish_project,
+    plan_project,
+    read_dataset,
+    read_project_samples,
+    run_sample_task,
+    set_global,
+    set_xml_namespace,
+    xml_mtimes,
+)
+from .project_index import is_current_dataset
+
+DEFAULT_POLL_S = 2.0
+DEFAULT_SETTLE_S = 5.0
+# Images every field needs before its dataset counts as exported.
+REQUIRED_IMAGES = FIELD_IMAGES[:2]
+
+
+def _stat(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def export_complete(dataset: dict) -> bool:
+    """Whether every field of the dataset record has its REQUIRED_IMAGES."""
+    if not dataset["xml_path"] or not dataset.get("fields"):
+        return False
+    required = [FIELD_IMAGES.index(name) for name in REQUIRED_IMAGES]
+    return all(
+        all(field["files"][index] for index in required) for field in dataset["fields"]
+    )
+
+
+def export_layout(dataset: dict):
+    """The modification times of the XML files and field directories of a dataset."""
+    return dataset["mtimes"], [field["mtime"] for field in dataset["fields"]]
+
+
+def export_signature(dataset: dict):
+    """What the export of a dataset looks like on disk, None while it is incomplete."""
+    if not export_complete(dataset):
+        return None
+    field_path_format = os.path.join(
+        dataset["xml_path"], dataset["field_dir"] or "", "{0}", "{1}"
+    )
+    images = []
+    for field in dataset["fields"]:
+        stats = [
+            _stat(field_path_format.format(field["name"], name))
+            for name in FIELD_IMAGES
+        ]
+        if any(stats[FIELD_IMAGES.index(name)] is None for name in REQUIRED_IMAGES):
+            return None
+        images.append(stats)
+    return dataset["mtimes"], images
+
+
+class ExportWatcher:
+    """Tells which datasets below mindif_root have finished exporting.
+
+    A dataset is ready once its export is complete and unchanged for settle_s seconds,
+    and is ready again only after its XML files change.
+    """
+
+    def __init__(self, mindif_root: str, settle_s: float = DEFAULT_SETTLE_S):
+        self.mindif_root = mindif_root
+        self.settle_s = settle_s
+        # guid: dataset record of the exports not yet ready.
+        self.datasets = {}
+        # guid: (layout, signature, time the layout was first seen) of complete exports
+        # not yet ready.
+        self.settling = {}
+        # guid: (xml_path, XML mtimes) of the datasets that were ready.
+        self.processed = {}
+        set_xml_namespace()
+
+    def _dataset(self, guid: str):
+        """The dataset record of guid, read again only once its files changed."""
+        dataset = self.datasets.get(guid)
+        # Without XML files there is nothing to compare, the XML directory is looked
+        # for again.
+        if dataset is not None and dataset["xml_path"] and is_current_dataset(dataset):
+            return dataset
+        try:
+            dataset = read_dataset(self.mindif_root, guid)
+        except Exception:
+            # XML files that are still being written.
+            self.datasets.pop(guid, None)
+            return None
+        self.datasets[guid] = dataset
+        return dataset
+
+    def ready(self, guid: str):
+        """Return the dataset record of guid if it is ready, None otherwise."""
+        processed = self.processed.get(guid)
+        if processed is not None and xml_mtimes(processed[0]) == processed[1]:
+            return None
+        dataset = self._dataset(guid)
+        if dataset is None or not export_complete(dataset):
+            self.settling.pop(guid, None)
+            return None
+        now = time.monotonic()
+        layout = export_layout(dataset)
+        settling = self.settling.get(guid)
+        if settling is None or settling[0] != layout:
+            self.settling[guid] = (layout, export_signature(dataset), now)
+            return None
+        if now - settling[2] < self.settle_s:
+            return None
+        signature = export_signature(dataset)
+        if signature is None or signature != settling[1]:
+            # An image was still being written.
+            self.settling[guid] = (layout, signature, now)
+            return None
+        del self.settling[guid]
+        del self.datasets[guid]
+        self.processed[guid] = (dataset["xml_path"], dataset["mtimes"])
+        return dataset
+
+
+def watch_project(
+    project_path: str,
+    mindif_root: str,
+    output_root: str,
+    processes: int = None,
+    poll_s: float = DEFAULT_POLL_S,
+    settle_s: float = DEFAULT_SETTLE_S,
+    stop: threading.Event = None,
+    **options
+):
+    """Process the samples of a project as their exports complete, until stop is set.
+
+    The options are those of plan_project. Ctrl+C stops watching as well, the samples
+    handed to the pool are finished first. Returns the metrics records of the samples.
+    """
+    start = time.time()
+    processes = processes or os.cpu_count() or 1
+    options["parallelism"] = "sample"
+    plan = plan_project(project_path, mindif_root, output_root, processes, **options)
+    index = plan["index"]
+    watcher = ExportWatcher(mindif_root, settle_s)
+    stop = stop or threading.Event()
+    records = []
+    # Samples handed to the pool, the pool's result thread discards them when done.
+    pending = set()
+    pending_lock = threading.Lock()
+
+    def finished(result):
+        _, record = result
+        records.append(record)
+        with pending_lock:
+            pending.discard((record["guid"], record["sample_name"]))
+        logger.info(
+            "Sample: {} {} in {:.1f} s",
+            record["sample_name"],
+            record["status"],
+            record["wall_s"],
+        )
+
+    logger.info("Watching {} for new exports every {} s", mindif_root, poll_s)
+    pool = multiprocessing.Pool(processes, initializer=set_global, initargs=(logger,))
+    try:
+        while True:
+            try:
+                if index is not None:
+                    samples = index.samples(project_path, read_project_samples)
+                else:
+                    samples, _ = read_project_samples(project_path)
+            # A project file that is being written, it is read again next time.
+            except (Exception, SystemExit) as error:
+                logger.debug("Could not read {}: {!r}", project_path, error)
+                samples = []
+            ready = []
+            for guid in dict.fromkeys(guid for guid, _ in samples):
+                dataset = watcher.ready(guid)
+                if dataset is not None:
+                    ready.append(dataset)
+            if ready and index is not None:
+                # The workers take the datasets from the index.
+                index.update(ready)
+                index.save()
+            ready_guids = {dataset["guid"] for dataset in ready}
+            for sample in samples:
+                if sample[0] not in ready_guids:
+                    continue
+                with pending_lock:
+                    if tuple(sample) in pending:
+                        continue
+                    pending.add(tuple(sample))
+                logger.info("Sample: {} export complete", sample[1])
+                pool.apply_async(
+                    run_sample_task,
+                    ((0, plan["func"], tuple(sample)),),
+                    callback=finished,
+                )
+            if stop.wait(poll_s):
+                break
+    except KeyboardInterrupt:
+        with pending_lock:
+            count = len(pending)
+        logger.warning("Stopped watching, finishing {} samples", count)
+    finally:
+        pool.close()
+        pool.join()
+    if records:
+        finish_project(plan, records, time.time() - start, processes)
+    return records
@@ -0,0 +1,572 @@
+# Distributed processing of samples through a work queue in a shared directory.
+#
+# A pool only uses the cores of one machine. For campaigns of thousands of samples on a
+# shared filesystem, a coordinator writes one job file per sample into a queue directory
+# and any number of workers, on any host that sees the directory, work through them. No
+# service is needed beyond the filesystem:
+#
+#   QUEUE/pending/<job>.json   jobs waiting for a worker
+#   QUEUE/claimed/<job>.json   jobs being worked on, with <job>.owner naming the worker
+#   QUEUE/done/<job>.json      the result of every finished job
+#
+# A worker claims a job by renaming it from pending to claimed, a rename is atomic, so
+# only one worker gets it. While create_sample runs the worker touches the claim every
+# heartbeat. A claim that has not been touched for stale_after seconds belongs to a dead
+# worker and is put back in pending by whichever worker notices first, up to
+# max_attempts times before the job fails. Ages are measured against the clock of the
+# filesystem, so the clocks of the hosts do not matter.
+#
+# Job names start with the rank of the sample by its estimated cost, workers take them
+# in name order, so the largest samples start first. The options of a job are those of
+# a batch manifest (see batch.py), all paths must be the same on every host.
+#
+#   tima-mindif-queue enqueue /shared/queue jobs.json
+#   tima-mindif-queue work /shared/queue --processes 8       # on every node
+#   tima-mindif-queue status /shared/queue --results results.json
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from functools import partial
+from loguru import logger
+from .atomic import write_json
+from .batch import RESULT_STATUS, read_manifest
+from .cache import init_cache
+from .scheduler import largest_first
+from .tima_mindif_processor import (
+    create_sample,
+    estimate_project,
+    plan_project,
+    run_sample_task,
+    set_global,
+    set_xml_namespace,
+    update_project_index,
+)
+
+QUEUE_STATES = ("pending", "claimed", "done")
+DEFAULT_HEARTBEAT_S = 30.0
+# Claims untouched for this many heartbeats are taken to belong to dead workers.
+STALE_HEARTBEATS = 10
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_S = 5.0
+CLOCK_FILE = ".clock"
+# Fields of a job copied to its result.
+RESULT_FIELDS = ("job_id", "project_path", "output", "guid", "sample_name", "attempts")
+
+
+def queue_path(queue_dir: str, state: str, name: str = "") -> str:
+    return os.path.join(queue_dir, state, name)
+
+
+def init_queue(queue_dir: str):
+    for state in QUEUE_STATES:
+        os.makedirs(queue_path(queue_dir, state), exist_ok=True)
+
+
+def queue_clock(queue_dir: str) -> float:
+    """The current time of the filesystem the queue is on."""
+    path = os.path.join(queue_dir, CLOCK_FILE)
+    with open(path, "a"):
+        pass
+    os.utime(path)
+    return os.stat(path).st_mtime
+
+
+def job_names(queue_dir: str, state: str):
+    """Names of the job files in state, in the order they are claimed."""
+    try:
+        names = os.listdir(queue_path(queue_dir, state))
+    except FileNotFoundError:
+        return []
+    # Partial files and jobs being reclaimed start with a dot.
+    return sorted(
+        name for name in names if name.endswith(".json") and not name.startswith(".")
+    )
+
+
+def _key_of(name: str) -> str:
+    # Job file names are <rank>-<key>.json.
+    return name[: -len(".json")].split("-", 1)[1]
+
+
+def _job_key(job: dict) -> str:
+    return hashlib.sha1(
+        json.dumps(
+            [job[key] for key in ("output", "guid", "sample_name", "args", "kwargs")],
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()[:16]
+
+
+def _read_job(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def enqueue_jobs(queue_dir: str, jobs, processes: int = None):
+    """Write a job file for every sample of the batch jobs and return how many.
+
+    The jobs are those of a batch manifest. Samples that are pending or claimed already
+    are left alone, earlier results of the others are replaced.
+    """
+    init_queue(queue_dir)
+    processes = processes or os.cpu_count() or 1
+    queued = {
+        _key_of(name)
+        for state in ("pending", "claimed")
+        for name in job_names(queue_dir, state)
+    }
+    done = {_key_of(name): name for name in job_names(queue_dir, "done")}
+
+    sample_jobs = []
+    estimates = []
+    pool = multiprocessing.Pool(processes, initializer=set_global, initargs=(logger,))
+    try:
+        for job in jobs:
+            plan = plan_project(
+                job["project_path"],
+                job["mindif_root"],
+                job["output"],
+                processes,
+                parallelism="sample",
+                **job.get("options", {})
+            )
+            update_project_index(pool, plan)
+            estimates.extend(estimate_project(pool, plan))
+            func = plan["func"]
+            sample_jobs.extend(
+                {
+                    "project_path": job["project_path"],
+                    "output": job["output"],
+                    "guid": guid,
+                    "sample_name": sample_name,
+                    "args": list(func.args),
+                    "kwargs": func.keywords,
+                    "attempts": 0,
+                }
+                for guid, sample_name in plan["samples"]
+            )
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    count = 0
+    for rank, index in enumerate(largest_first(range(len(sample_jobs)), estimates)):
+        job = sample_jobs[index]
+        key = _job_key(job)
+        if key in queued:
+            continue
+        if key in done:
+            os.remove(queue_path(queue_dir, "done", done[key]))
+        job["job_id"] = "{:06d}-{}".format(rank, key)
+        job["enqueued"] = time.time()
+        write_json(queue_path(queue_dir, "pending", job["job_id"] + ".json"), job)
+        queued.add(key)
+        count += 1
+    logger.info("Queued {} samples in {}", count, queue_dir)
+    return count
+
+
+def _owner_path(queue_dir: str, name: str) -> str:
+    return queue_path(queue_dir, "claimed", name[: -len(".json")] + ".owner")
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def claim_job(queue_dir: str, worker_id: str):
+    """Claim the first pending job, returning its file name and the job, or None."""
+    for name in job_names(queue_dir, "pending"):
+        claimed = queue_path(queue_dir, "claimed", name)
+        try:
+            os.rename(queue_path(queue_dir, "pending", name), claimed)
+        except FileNotFoundError:
+            # Another worker was faster.
+            continue
+        try:
+            # The rename keeps the mtime of the pending job, which would make a job
+            # that waited longer than stale_after_s look stale the moment it is claimed.
+            os.utime(claimed)
+        except FileNotFoundError:
+            # Reclaimed before the mtime could be refreshed.
+            continue
+        if os.path.exists(queue_path(queue_dir, "done", name)):
+            # Finished by a worker whose claim had been taken for stale.
+            _remove(claimed)
+            continue
+        write_json(
+            _owner_path(queue_dir, name),
+            {"worker": worker_id, "claimed": time.time()},
+        )
+        return name, _read_job(claimed)
+    return None
+
+
+def release_job(queue_dir: str, name: str):
+    """Put a claimed job back in pending."""
+    try:
+        os.rename(
+            queue_path(queue_dir, "claimed", name),
+            queue_path(queue_dir, "pending", name),
+        )
+    except FileNotFoundError:
+        pass
+    _remove(_owner_path(queue_dir, name))
+
+
+def _job_result(job: dict, **fields) -> dict:
+    result = {key: job[key] for key in RESULT_FIELDS}
+    result.update(fields, finished=time.time())
+    return result
+
+
+def claim_owner(queue_dir: str, name: str):
+    """The worker ID that holds the claim of a job, None if nobody does."""
+    try:
+        return _read_job(_owner_path(queue_dir, name))["worker"]
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def finish_job(queue_dir: str, name: str, job: dict, record: dict, worker_id: str):
+    """Write the result of a claimed job and drop the claim.
+
+    Returns None without writing anything if the claim was taken for stale meanwhile,
+    the job then belongs to whichever worker claimed it again.
+    """
+    owner = claim_owner(queue_dir, name)
+    if owner != worker_id:
+        logger.warning(
+            "Worker {} lost the claim of {} to {}, dropping its result",
+            worker_id,
+            job["sample_name"],
+            owner,
+        )
+        return None
+    result = _job_result(
+        job,
+        status=RESULT_STATUS[record["status"]],
+        detail=record["status"],
+        wall_s=record["wall_s"],
+        cpu_s=record["cpu_s"],
+        worker=worker_id,
+        record=record,
+    )
+    if "error" in record:
+        result["error"] = record["error"]
+    write_json(queue_path(queue_dir, "done", name), result)
+    _remove(queue_path(queue_dir, "claimed", name))
+    _remove(_owner_path(queue_dir, name))
+    return result
+
+
+def reclaim_stale_jobs(
+    queue_dir: str, stale_after_s: float, max_attempts: int = DEFAULT_MAX_ATTEMPTS
+) -> int:
+    """Put claims untouched for stale_after_s seconds back in pending.
+
+    A job reclaimed max_attempts times fails instead. Returns the number of claims
+    taken.
+    """
+    now = queue_clock(queue_dir)
+    count = 0
+    for name in job_names(queue_dir, "claimed"):
+        claimed = queue_path(queue_dir, "claimed", name)
+        try:
+            if now - os.stat(claimed).st_mtime < stale_after_s:
+                continue
+            # Only one of the workers noticing the stale claim gets to rename it.
+            reclaimed = queue_path(queue_dir, "pending", ".reclaim." + name)
+            os.rename(claimed, reclaimed)
+        except FileNotFoundError:
+            continue
+        job = _read_job(reclaimed)
+        job["attempts"] += 1
+        _remove(_owner_path(queue_dir, name))
+        if job["attempts"] >= max_attempts:
+            logger.error(
+                "Sample: {} abandoned after {} stale claims",
+                job["sample_name"],
+                job["attempts"],
+            )
+            write_json(
+                queue_path(queue_dir, "done", name),
+                _job_result(
+                    job,
+                    status="failed",
+                    detail="abandoned",
+                    wall_s=0.0,
+                    cpu_s=0.0,
+                    error="The workers of {} attempts stopped heartbeating".format(
+                        job["attempts"]
+                    ),
+                ),
+            )
+        else:
+            logger.warning(
+                "Sample: {} reclaimed from a stale claim", job["sample_name"]
+            )
+            write_json(queue_path(queue_dir, "pending", name), job)
+        os.remove(reclaimed)
+        count += 1
+    return count
+
+
+class Heartbeat:
+    """Touch a claim file every interval seconds while in the with block."""
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                logger.warning("Lost the claim {}", self.path)
+                return
+
+    def __enter__(self):
+        os.utime(self.path)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def default_worker_id() -> str:
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def run_worker(
+    queue_dir: str,
+    worker_id: str = None,
+    heartbeat_s: float = DEFAULT_HEARTBEAT_S,
+    stale_after_s: float = None,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    poll_s: float = DEFAULT_POLL_S,
+    wait: bool = False,
+    max_jobs: int = None,
+):
+    """Work through the jobs of the queue and return the results of this worker.
+
+    The worker stops when nothing is pending or claimed any more, claims of other
+    workers may still have to be reclaimed until then. With wait it keeps polling for
+    new jobs instead. stale_after_s defaults to STALE_HEARTBEATS heartbeats.
+    """
+    worker_id = worker_id or default_worker_id()
+    stale_after_s = stale_after_s or heartbeat_s * STALE_HEARTBEATS
+    init_queue(queue_dir)
+    results = []
+    while max_jobs is None or len(results) < max_jobs:
+        reclaim_stale_jobs(queue_dir, stale_after_s, max_attempts)
+        claim = claim_job(queue_dir, worker_id)
+        if claim is None:
+            if not wait and not job_names(queue_dir, "claimed"):
+                break
+            time.sleep(poll_s)
+            continue
+        name, job = claim
+        logger.info("Worker {} processing {}", worker_id, job["sample_name"])
+        func = partial(create_sample, *job["args"], **job["kwargs"])
+        try:
+            with Heartbeat(queue_path(queue_dir, "claimed", name), heartbeat_s):
+                sample = (job["guid"], job["sample_name"])
+                _, record = run_sample_task((0, func, sample))
+        except FileNotFoundError:
+            # The claim was taken for stale before the heartbeat started.
+            logger.warning(
+                "Worker {} lost the claim of {}", worker_id, job["sample_name"]
+            )
+            continue
+        except KeyboardInterrupt:
+            release_job(queue_dir, name)
+            raise
+        result = finish_job(queue_dir, name, job, record, worker_id)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def _worker_process(queue_dir: str, options: dict):
+    set_xml_namespace()
+    init_cache()
+    run_worker(queue_dir, **options)
+
+
+def run_workers(queue_dir: str, processes: int = None, **options):
+    """Run processes workers on this machine until the queue is worked through.
+
+    The options are those of run_worker(). Returns the exit codes of the workers.
+    """
+    processes = processes or os.cpu_count() or 1
+    workers = [
+        multiprocessing.Process(target=_worker_process, args=(queue_dir, options))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        logger.warning("Caught KeyboardInterrupt, waiting for the workers to stop")
+        for worker in workers:
+            worker.join()
+        raise
+    return [worker.exitcode for worker in workers]
+
+
+def queue_status(queue_dir: str):
+    """Return the job counts by state and the results of the finished jobs."""
+    counts = {state: len(job_names(queue_dir, state)) for state in QUEUE_STATES}
+    results = [
+        _read_job(queue_path(queue_dir, "done", name))
+        for name in job_names(queue_dir, "done")
+    ]
+    return counts, results
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Process TIMA samples through a work queue in a shared directory."
+    )
+    parser.add_argument(
+        "--verbose", "-v", action="store_true", help="Enables verbose logging"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = commands.add_parser("enqueue", help="Queue the samples of a manifest.")
+    enqueue.add_argument("queue", type=str, help="Path to the queue directory")
+    enqueue.add_argument("manifest", type=str, help="Path to the JSON batch manifest")
+    enqueue.add_argument(
+        "--processes",
+        "-p",
+        dest="processes",
+        default=None,
+        type=int,
+        help="Processes reading the datasets, defaults to the number of cores.",
+    )
+
+    work = commands.add_parser("work", help="Process queued samples.")
+    work.add_argument("queue", type=str, help="Path to the queue directory")
+    work.add_argument(
+        "--processes",
+        "-p",
+        dest="processes",
+        default=None,
+        type=int,
+        help="Number of worker processes, defaults to the number of cores.",
+    )
+    work.add_argument(
+        "--heartbeat",
+        dest="heartbeat_s",
+        default=DEFAULT_HEARTBEAT_S,
+        type=float,
+        help="Seconds between the heartbeats of a worker.",
+    )
+    work.add_argument(
+        "--stale-after",
+        dest="stale_after_s",
+        default=None,
+        type=float,
+        help="Seconds without a heartbeat after which a claim is taken back, "
+        + "defaults to {} heartbeats.".format(STALE_HEARTBEATS),
+    )
+    work.add_argument(
+        "--max-attempts",
+        dest="max_attempts",
+        default=DEFAULT_MAX_ATTEMPTS,
+        type=int,
+        help="Stale claims of a job before it fails.",
+    )
+    work.add_argument(
+        "--wait",
+        action="store_true",
+        help="Keep waiting for new jobs when the queue is empty.",
+    )
+
+    status = commands.add_parser("status", help="Summarise the queue.")
+    status.add_argument("queue", type=str, help="Path to the queue directory")
+    status.add_argument(
+        "--results",
+        dest="results_path",
+        default=None,
+        type=str,
+        help="Path of the JSON file with the result of every finished sample.",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
+    logger.remove()
+    logger.add(
+        sys.stdout,
+        enqueue=True,
+        level="INFO" if not args.verbose else "DEBUG",
+        format="<green>{time:HH:mm:ss}</green> | <cyan>{process}</cyan> | <level>{message}</level>",
+    )
+
+    if args.command == "enqueue":
+        enqueue_jobs(args.queue, read_manifest(args.manifest), args.processes)
+        return 0
+    if args.command == "work":
+        exit_codes = run_workers(
+            args.queue,
+            args.processes,
+            heartbeat_s=args.heartbeat_s,
+            stale_after_s=args.stale_after_s,
+            max_attempts=args.max_attempts,
+            wait=args.wait,
+        )
+        return 1 if any(exit_codes) else 0
+
+    counts, results = queue_status(args.queue)
+    if args.results_path:
+        write_json(args.results_path, {"results": results})
+        logger.info("Results written to {}", args.results_path)
+    outcomes = {}
+    for result in results:
+        outcomes[result["status"]] = outcomes.get(result["status"], 0) + 1
+    logger.info(
+        "{} pending, {} claimed, {} done: {}",
+        counts["pending"],
+        counts["claimed"],
+        counts["done"],
+        ", ".join(
+            "{} {}".format(count, status) for status, count in sorted(outcomes.items())
+        )
+        or "none",
+    )
+    for result in results:
+        if result["status"] == "failed":
+            logger.error(
+                "Failed: {} {} ({})",
+                result["project_path"],
+                result["sample_name"],
+                result.get("error", result["detail"]),
+            )
+    return 1 if any(result["status"] == "failed" for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())